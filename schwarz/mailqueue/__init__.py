@@ -1,8 +1,15 @@
 
 from .app_helpers import *
+from .async_handler import *
+from .background_handler import *
+from .circuit_breaker import *
+from .concurrency import *
 from .maildir_utils import *
 from .mailer import *
 from .message_handler import *
 from .message_utils import *
 from .plugins import *
 from .queue_runner import *
+from .rate_limit import *
+from .relay_pool import *
+from .sharding import *
@@ -9,13 +9,19 @@ import sys
 from pathlib import Path
 from typing import Optional
 
+from .circuit_breaker import CIRCUIT_BREAKER_FILENAME, SharedCircuitBreaker
 from .mailer import SMTPMailer
+from .message_handler import RetryPolicy
 from .plugins import PluginLoader, parse_list_str, registry
+from .relay_pool import Relay, RelayPool, parse_relays
+from .sharding import parse_queue_dirs
 
 
 __all__ = [
     'guess_config_path',
     'init_app',
+    'init_retry_policy',
+    'init_shared_circuit_breaker',
     'init_smtp_mailer',
 ]
 
@@ -40,13 +46,51 @@ def init_app(config_path, options=None, settings=None):
 
 def init_smtp_mailer(settings, smtp_log=None):
     smtp_settings = _subdict(settings, prefix='smtp_')
-    if 'hostname' not in smtp_settings:
+    relays_str = smtp_settings.pop('relays', None)
+    pool_settings = _subdict(smtp_settings, prefix='relay_')
+    for key in pool_settings:
+        del smtp_settings['relay_' + key]
+    if ('hostname' not in smtp_settings) and (not relays_str):
         log = logging.getLogger('mailqueue')
         log.error('No SMTP host configured ("smtp_hostname = ...")')
         sys.exit(30)
     smtp_settings['smtp_log'] = smtp_log or logging.getLogger('mailqueue.smtp')
-    mailer = SMTPMailer(**smtp_settings)
-    return mailer
+    if 'partial_delivery' in smtp_settings:
+        smtp_settings['partial_delivery'] = _as_bool(smtp_settings['partial_delivery'])
+    if not relays_str:
+        return SMTPMailer(**smtp_settings)
+
+    relays = []
+    for hostname, port, weight in parse_relays(relays_str):
+        relay_settings = dict(smtp_settings, hostname=hostname)
+        if port:
+            relay_settings['port'] = port
+        relays.append(Relay(SMTPMailer(**relay_settings), weight=weight))
+    return RelayPool(relays, log=smtp_settings['smtp_log'], **pool_settings)
+
+def init_shared_circuit_breaker(settings, queue_dir):
+    # several queue dirs (shards): the state is stored in the first one
+    queue_dir = parse_queue_dirs(queue_dir)[0]
+    return SharedCircuitBreaker(
+        os.path.join(queue_dir, CIRCUIT_BREAKER_FILENAME),
+        failure_threshold = int(settings.get('circuit_breaker_threshold', 5)),
+        reset_timeout     = float(settings.get('circuit_breaker_reset_timeout', 60)),
+        allow_probes      = _as_bool(settings.get('circuit_breaker_probes', True)),
+    )
+
+def init_retry_policy(settings):
+    max_retries = settings.get('max_retries')
+    max_queue_age = settings.get('max_queue_age')
+    return RetryPolicy(
+        max_retries   = int(max_retries) if (max_retries is not None) else None,
+        max_queue_age = float(max_queue_age) if (max_queue_age is not None) else None,
+        retry_permanent_failures = _as_bool(settings.get('retry_permanent_failures', False)),
+    )
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return (value.strip().lower() in ('true', 'yes', 'on', '1'))
+    return bool(value)
 
 def _subdict(d, prefix):
     subdict = {}
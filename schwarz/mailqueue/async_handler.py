@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .maildir_utils import check_durability
+from .message_handler import InMemoryMsg, MessageHandler
+from .message_utils import SendResult
+from .queue_runner import MaildirBackend, _write_messages, enqueue_message
+from .sharding import queue_shards
+
+
+__all__ = ['AsyncMessageHandler', 'AsyncQueueWriter', 'enqueue_message_async']
+
+class AsyncQueueWriter(object):
+    """
+    Stores messages in a queue directory without blocking the event loop.
+
+    All file system operations run in a single worker thread. Messages which
+    are enqueued while the worker is busy (e.g. waiting for fsync) are
+    collected and written together (see "enqueue_messages()") so the
+    commits of all messages in a batch can be grouped.
+    """
+    def __init__(self, queue_path, durability='file', max_batch_size=100, log=None):
+        self.queue_path = queue_path
+        self.durability = check_durability(durability)
+        self.max_batch_size = int(max_batch_size)
+        self.log = log or logging.getLogger('mailqueue.queue_log')
+        self._pending = []
+        self._is_flushing = False
+        self._is_shut_down = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix='mailqueue-writer')
+
+    async def enqueue_message(self, msg, sender, recipients):
+        "Store the message in the queue and return the path of the queued message."
+        return await asyncio.wrap_future(self.submit(msg, sender, recipients))
+
+    def submit(self, msg, sender, recipients):
+        """
+        Add a message to the next batch and return a "concurrent.futures.Future"
+        (can be called from any thread). Raises a "RuntimeError" after
+        "shutdown()".
+        """
+        future = Future()
+        with self._lock:
+            if self._is_shut_down:
+                raise RuntimeError('AsyncQueueWriter was shut down, can not store messages')
+            self._pending.append((future, (msg, sender, recipients)))
+            if not self._is_flushing:
+                self._is_flushing = True
+                self._executor.submit(self._flush)
+        return future
+
+    def shutdown(self, wait=True):
+        "Stop the worker thread after all pending messages were stored."
+        with self._lock:
+            self._is_shut_down = True
+        self._executor.shutdown(wait=wait)
+
+    # --- internal functionality ----------------------------------------------
+    def _flush(self):
+        while True:
+            with self._lock:
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+                if not batch:
+                    self._is_flushing = False
+                    return
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        if len(batch) == 1:
+            # nothing to share with other messages
+            future, (msg, sender, recipients) = batch[0]
+            self._write_single_message(future, msg, sender, recipients)
+            return
+        futures = [future for future, _ in batch]
+        messages = [message for _, message in batch]
+        try:
+            staged_messages = _write_messages(messages, self.queue_path, self.durability)
+        except Exception:
+            # Nothing was queued after an error in this step. Store the
+            # messages one by one so only the broken message fails.
+            self.log.exception('unable to store %d messages in one batch', len(batch))
+            for future, (msg, sender, recipients) in batch:
+                self._write_single_message(future, msg, sender, recipients)
+            return
+        try:
+            msg_paths = staged_messages.publish('new')
+        except Exception as e:
+            # Some messages might be in the queue already: storing them again
+            # would queue them twice.
+            self.log.exception('unable to publish %d messages', len(batch))
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, msg_path in zip(futures, msg_paths):
+            future.set_result(msg_path)
+
+    def _write_single_message(self, future, msg, sender, recipients):
+        try:
+            msg_path = enqueue_message(msg, self.queue_path, sender, recipients,
+                durability=self.durability)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(msg_path)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def _shared_writer(queue_path, durability):
+    # a list of queue dirs is not hashable
+    queue_path = queue_shards(queue_path) or queue_path
+    key = (queue_path, durability)
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = AsyncQueueWriter(queue_path, durability=durability)
+            _writers[key] = writer
+    return writer
+
+async def enqueue_message_async(msg, queue_path, sender, recipients, durability='file'):
+    """
+    Async version of "enqueue_message()": The message is stored by a worker
+    thread (shared by all callers using the same queue_path) and concurrent
+    calls are committed together. Returns the path of the queued message.
+    """
+    writer = _shared_writer(queue_path, check_durability(durability))
+    return await writer.enqueue_message(msg, sender, recipients)
+
+
+class _BatchedMaildirBackend(object):
+    "Synchronous transport which stores messages via an \"AsyncQueueWriter\"."
+    def __init__(self, writer, log=None):
+        self.writer = writer
+        self.log = log or writer.log
+
+    def send(self, from_addr, to_addrs, msg_bytes):
+        self.writer.submit(msg_bytes, from_addr, to_addrs).result()
+        log_msg = '%s => %s' % (from_addr, ', '.join(to_addrs))
+        msg_id = InMemoryMsg(from_addr, to_addrs, msg_bytes).msg_id
+        if msg_id:
+            log_msg += ' <%s>' % msg_id
+        self.log.info(log_msg)
+        return SendResult(True, queued=True, transport='maildir')
+
+
+class AsyncMessageHandler(object):
+    """
+    Async version of "MessageHandler": Transports are called in a bounded
+    thread pool ("max_workers") so the event loop is never blocked by network
+    or file system operations.
+
+    Messages for a "MaildirBackend" transport are written via an
+    "AsyncQueueWriter" so concurrent messages share a single fsync.
+    """
+    def __init__(self, transports, delivery_log=None, plugins=None, max_workers=4,
+                 max_batch_size=100):
+        self._writers = []
+        transports = [self._wrap_transport(t, max_batch_size) for t in transports]
+        self._mh = MessageHandler(transports, delivery_log=delivery_log, plugins=plugins)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix='mailqueue-send')
+
+    async def send_message(self, msg, **kwargs):
+        loop = asyncio.get_running_loop()
+        send_message = functools.partial(self._mh.send_message, msg, **kwargs)
+        return await loop.run_in_executor(self._executor, send_message)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        for writer in self._writers:
+            writer.shutdown(wait=wait)
+
+    def _wrap_transport(self, transport, max_batch_size):
+        if not isinstance(transport, MaildirBackend):
+            return transport
+        writer = AsyncQueueWriter(transport.queue_path, durability=transport.durability,
+            max_batch_size=max_batch_size, log=transport.log)
+        self._writers.append(writer)
+        return _BatchedMaildirBackend(writer)
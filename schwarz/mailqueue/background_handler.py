@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import atexit
+import copy
+import logging
+import queue
+import threading
+import weakref
+
+from .message_handler import InMemoryMsg, MessageHandler
+from .message_utils import SendResult
+from .relay_pool import RelayPool
+
+
+__all__ = ['BackgroundMessageHandler']
+
+_STOP = object()
+
+# handlers which are shut down at process exit (weak references so a handler
+# can be garbage collected)
+_running_handlers = weakref.WeakSet()
+
+class BackgroundMessageHandler(object):
+    """
+    Accepts messages into a bounded in-memory queue and delivers them with
+    "mailer" from a worker thread so the calling (application) thread never
+    waits for the network.
+
+    Messages are stored with "queue_backend" (usually a "MaildirBackend")
+    - when the in-memory queue is full,
+    - when a delivery failed or
+    - when the handler is shut down (explicitly or at process exit) before
+      the message was delivered.
+    Use "mq-run" to deliver messages from the queue_backend later.
+
+    The connection of the mailer is kept open between messages
+    ("SMTPMailer.keep_alive"). If the mailer does not keep its connections
+    open, the handler uses a copy of it ("mailer" is not modified). The
+    same applies to the mailers of all relays of a "RelayPool".
+    """
+    def __init__(self, mailer, queue_backend, queue_size=100, delivery_log=None, plugins=None,
+                 log=None):
+        mailer = _keep_alive_mailer(mailer)
+        self.mailer = mailer
+        self.log = log or logging.getLogger('mailqueue.sending')
+        self._mh = MessageHandler([mailer, queue_backend], delivery_log=delivery_log,
+            plugins=plugins)
+        self._spill_mh = MessageHandler([queue_backend], delivery_log=delivery_log,
+            plugins=plugins)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._is_running = True
+        # ensures no message is added to the in-memory queue after shutdown
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._deliver_messages, daemon=True,
+            name='mailqueue-sender')
+        self._worker.start()
+        # spill messages to the queue_backend if the application does not
+        # call ".shutdown()" explicitly.
+        _running_handlers.add(self)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def send_message(self, msg, **kwargs):
+        """
+        Accept a message for delivery. Returns a "SendResult" with
+        "transport='background'" when the message will be sent by the worker
+        thread or the result of the queue_backend if the message had to be
+        stored immediately.
+        """
+        msg = self._build_msg(msg, **kwargs)
+        with self._lock:
+            was_accepted = self._is_running and self._enqueue(msg)
+        if was_accepted:
+            return SendResult(True, queued=True, transport='background')
+        return self._spill_mh.send_message(msg)
+
+    def shutdown(self, timeout=None):
+        """
+        Stop the worker thread. Messages which were not sent yet are stored
+        with the queue_backend.
+        """
+        with self._lock:
+            if not self._is_running:
+                return
+            self._is_running = False
+        _running_handlers.discard(self)
+        self._spill_pending_messages()
+        self._queue.put(_STOP)
+        self._worker.join(timeout)
+        if not self._worker.is_alive():
+            self._close_mailer()
+
+    # --- internal functionality ----------------------------------------------
+    def _build_msg(self, msg, **kwargs):
+        # Extract envelope data in the caller's thread so invalid parameters
+        # raise an exception in the application.
+        msg_wrapper = self._mh._wrap_msg(msg)
+        sender, recipients = self._mh._msg_metadata(msg_wrapper, **kwargs)
+        return InMemoryMsg(sender, recipients, msg_wrapper.msg_bytes)
+
+    def _enqueue(self, msg):
+        try:
+            self._queue.put_nowait(msg)
+        except queue.Full:
+            self.log.warning('background queue is full (%d messages), storing message in queue',
+                self._queue.maxsize)
+            return False
+        return True
+
+    def _deliver_messages(self):
+        while True:
+            msg = self._queue.get()
+            if msg is _STOP:
+                return
+            try:
+                self._mh.send_message(msg)
+            except Exception:
+                self.log.exception('unable to deliver message')
+                self._spill_mh.send_message(msg)
+
+    def _spill_pending_messages(self):
+        nr_messages = 0
+        while True:
+            try:
+                msg = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if msg is _STOP:
+                continue
+            self._spill_mh.send_message(msg)
+            nr_messages += 1
+        if nr_messages:
+            self.log.info('stored %d pending messages in queue', nr_messages)
+
+    def _close_mailer(self):
+        close = getattr(self.mailer, 'close', None)
+        if close is not None:
+            close()
+
+
+def _shutdown_running_handlers():
+    for handler in list(_running_handlers):
+        handler.shutdown()
+
+atexit.register(_shutdown_running_handlers)
+
+def _keep_alive_mailer(mailer):
+    if isinstance(mailer, RelayPool):
+        return _keep_alive_relay_pool(mailer)
+    if getattr(mailer, 'keep_alive', True):
+        # connections are kept open already (or not supported by the mailer)
+        return mailer
+    own_mailer = copy.copy(mailer)
+    own_mailer.keep_alive = True
+    return own_mailer
+
+def _keep_alive_relay_pool(relay_pool):
+    relays = []
+    for relay in relay_pool.relays:
+        relay_mailer = _keep_alive_mailer(relay.mailer)
+        if relay_mailer is not relay.mailer:
+            relay = copy.copy(relay)
+            relay.mailer = relay_mailer
+        relays.append(relay)
+    if relays == relay_pool.relays:
+        return relay_pool
+    own_pool = copy.copy(relay_pool)
+    own_pool.relays = relays
+    own_pool._lock = threading.Lock()
+    return own_pool
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import json
+import logging
+import os
+import threading
+import time
+
+from boltons.fileutils import atomic_save
+
+from .message_utils import SendResult
+
+
+__all__ = [
+    'is_connection_failure',
+    'CircuitBreaker',
+    'CircuitBreakerTransport',
+    'SharedCircuitBreaker',
+]
+
+CIRCUIT_BREAKER_FILENAME = 'circuit_breaker.json'
+
+def is_connection_failure(send_result):
+    "Return True if the SMTP server could not be reached at all."
+    if (send_result is None) or send_result:
+        return False
+    return (getattr(send_result, 'phase', None) == 'connect')
+
+
+class CircuitBreaker(object):
+    """
+    Opens after "failure_threshold" consecutive connection failures. Any
+    reply from the SMTP server (even a rejection) closes the breaker again
+    because the server is obviously reachable.
+    """
+    def __init__(self, failure_threshold=5):
+        self.failure_threshold = int(failure_threshold)
+        self.consecutive_failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        if self.failure_threshold <= 0:
+            return False
+        return (self.consecutive_failures >= self.failure_threshold)
+
+    def record(self, send_result):
+        if send_result is None:
+            # message was not processed (e.g. locked by another process)
+            return
+        with self._lock:
+            if is_connection_failure(send_result):
+                self.consecutive_failures += 1
+            elif send_result or (getattr(send_result, 'phase', None) is not None):
+                self.consecutive_failures = 0
+
+
+class SharedCircuitBreaker(object):
+    """
+    Circuit breaker which keeps its state in a (small) file so it is shared
+    by all processes using the same queue (e.g. "mq-sendmail" invocations
+    from different cron jobs).
+
+    The breaker opens after "failure_threshold" consecutive connection
+    failures. While it is open ".allow_request()" returns False so callers
+    can queue a message immediately instead of waiting for the connect
+    timeout. After "reset_timeout" seconds a single caller may probe the
+    server again (other callers keep queueing for another "reset_timeout").
+    Any reply from the server closes the breaker (the state file is removed).
+
+    The probe is the regular delivery attempt of the caller which happens to
+    submit a message at that time, so that caller might wait for the connect
+    timeout. With "allow_probes=False" ".allow_request()" never probes: the
+    breaker stays open until "mq-run" (which always tries to deliver its
+    messages) reaches the server.
+
+    Updates are not serialized across processes. In the worst case two
+    processes probe the server at the same time which is harmless.
+    """
+    def __init__(self, path, failure_threshold=5, reset_timeout=60, allow_probes=True, log=None,
+                 clock=time.time):
+        self.path = path
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.allow_probes = allow_probes
+        self.log = log or logging.getLogger('mailqueue.smtp')
+        self._clock = clock
+
+    @property
+    def consecutive_failures(self):
+        return self._read_state()['failures']
+
+    @property
+    def is_open(self):
+        if self.failure_threshold <= 0:
+            return False
+        return (self.consecutive_failures >= self.failure_threshold)
+
+    def allow_request(self):
+        if self.failure_threshold <= 0:
+            return True
+        state = self._read_state()
+        if state['failures'] < self.failure_threshold:
+            return True
+        now = self._clock()
+        if (not self.allow_probes) or (now < state['retry_at']):
+            return False
+        # "half open": this caller probes the server, everyone else should
+        # continue to skip the server until the probe has finished.
+        state['retry_at'] = now + self.reset_timeout
+        self._write_state(state)
+        return True
+
+    def record(self, send_result):
+        if (send_result is None) or (self.failure_threshold <= 0):
+            return
+        if is_connection_failure(send_result):
+            state = self._read_state()
+            state['failures'] += 1
+            if state['failures'] >= self.failure_threshold:
+                if state['failures'] == self.failure_threshold:
+                    self.log.warning('SMTP server unreachable (%d consecutive connection failures), queueing messages for %ss',  # noqa: E501 (line too long)
+                        state['failures'], self.reset_timeout)
+                state['retry_at'] = self._clock() + self.reset_timeout
+            self._write_state(state)
+        elif send_result or (getattr(send_result, 'phase', None) is not None):
+            self.reset()
+
+    def reset(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.log.warning('unable to reset circuit breaker state in %s: %s', self.path, e)
+            return
+        self.log.info('SMTP server is reachable again')
+
+    # --- internal functionality ----------------------------------------------
+    def _read_state(self):
+        state = {'failures': 0, 'retry_at': 0}
+        try:
+            with open(self.path, 'rb') as state_fp:
+                state.update(json.loads(state_fp.read()))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            # corrupt/empty state file: just start over
+            pass
+        return state
+
+    def _write_state(self, state):
+        # The breaker is just an optimization so it must never prevent
+        # message submission (e.g. because the queue dir is read-only).
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with atomic_save(self.path, text_mode=False) as state_fp:
+                state_fp.write(json.dumps(state).encode('ascii'))
+        except OSError as e:
+            self.log.warning('unable to store circuit breaker state in %s: %s', self.path, e)
+
+
+class CircuitBreakerTransport(object):
+    """
+    Wraps a transport (e.g. "SMTPMailer") and records all results in the
+    circuit breaker. If "skip_when_open" is true, ".send()" fails
+    immediately (as a connection failure) while the breaker is open so the
+    MessageHandler can fall back to the next transport (usually the queue).
+    """
+    def __init__(self, transport, breaker, skip_when_open=True, log=None):
+        self.transport = transport
+        self.breaker = breaker
+        self.skip_when_open = skip_when_open
+        self.log = log or logging.getLogger('mailqueue.smtp')
+
+    @property
+    def supports_deadline(self):
+        return getattr(self.transport, 'supports_deadline', False)
+
+    def send(self, fromaddr, toaddrs, message, **kwargs):
+        if self.skip_when_open and (not self.breaker.allow_request()):
+            self.log.info('circuit breaker open, not connecting to SMTP server')
+            return SendResult(False, queued=False, transport='smtp', phase='connect')
+        send_result = self.transport.send(fromaddr, toaddrs, message, **kwargs)
+        self.breaker.record(send_result)
+        return send_result
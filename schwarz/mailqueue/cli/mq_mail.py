@@ -27,10 +27,18 @@ import textwrap
 from argparse import ArgumentParser
 
 from schwarz.mailqueue.aliases_parser import _parse_aliases, lookup_adresses
-from schwarz.mailqueue.app_helpers import guess_config_path, init_app, init_smtp_mailer
+from schwarz.mailqueue.app_helpers import (
+    guess_config_path,
+    init_app,
+    init_retry_policy,
+    init_shared_circuit_breaker,
+    init_smtp_mailer,
+)
+from schwarz.mailqueue.circuit_breaker import CircuitBreakerTransport
 from schwarz.mailqueue.message_handler import InMemoryMsg, MessageHandler
 from schwarz.mailqueue.message_utils import autogenerate_headers, msg_as_bytes
 from schwarz.mailqueue.queue_runner import MaildirBackend
+from schwarz.mailqueue.sharding import parse_queue_dirs
 
 
 __all__ = ['mq_mail_main']
@@ -108,8 +116,14 @@ def mq_mail_main(argv=sys.argv, return_rc_code=False):
     transports = [init_smtp_mailer(settings)]
     queue_dir = settings.get('queue_dir')
     if queue_dir:
-        transports.append(MaildirBackend(queue_dir))
-    mh = MessageHandler(transports=transports)
+        # skip the SMTP server while it is known to be unreachable so we do
+        # not have to wait for the connect timeout before queueing a message
+        breaker = init_shared_circuit_breaker(settings, queue_dir)
+        transports = [CircuitBreakerTransport(transports[0], breaker)]
+        durability = settings.get('queue_durability', 'file')
+        transports.append(MaildirBackend(parse_queue_dirs(queue_dir), durability=durability))
+    # permanent failures (5xx) are stored in the "failed" folder of the queue
+    mh = MessageHandler(transports=transports, retry_policy=init_retry_policy(settings))
     send_result = mh.send_message(msg)
 
     if verbose:
@@ -13,18 +13,25 @@ __all__ = [
     'one_shot_queue_run_main',
 ]
 
+# same as "os.EX_TEMPFAIL" (not available on Windows)
+EX_TEMPFAIL = 75
+
 def one_shot_queue_run_main(argv=sys.argv, return_rc_code=False):
     """mq-run.
 
     Usage:
-        mq-run [options] [<queue_dir>]
+        mq-run [options] [<queue_dir>...]
 
     Options:
         -C, --config=<CFG>  Path to the config file
         --verbose -v        more verbose program output
+
+    Exit code 75 (EX_TEMPFAIL): the run was aborted because the SMTP server
+    was unreachable (circuit breaker), messages are left in the queue.
     """
     arguments = docopt.docopt(one_shot_queue_run_main.__doc__, argv=argv[1:])
     config_path = guess_config_path(arguments['--config'])
+    # several queue dirs: messages are distributed by "QueueShards"
     queue_dir = arguments['<queue_dir>']
 
     if not queue_dir:
@@ -37,6 +44,6 @@ def one_shot_queue_run_main(argv=sys.argv, return_rc_code=False):
     cli_options = {
         'verbose': arguments['--verbose'],
     }
-    one_shot_queue_run(queue_dir, config_path, options=cli_options)
-    exit_code = 0
+    was_completed = one_shot_queue_run(queue_dir, config_path, options=cli_options)
+    exit_code = 0 if was_completed else EX_TEMPFAIL
     return exit_code if return_rc_code else sys.exit(exit_code)
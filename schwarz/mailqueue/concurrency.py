@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+__all__ = ['AIMDConcurrency']
+
+# 421: service not available (closing connection)
+# 451: local error in processing (often used for rate limiting)
+# 452: insufficient system storage (also: too many recipients)
+THROTTLING_REPLY_CODES = frozenset((421, 451, 452))
+
+class AIMDConcurrency(object):
+    """
+    Limits the number of concurrent deliveries and adapts the limit based on
+    the observed SMTP replies (similar to TCP congestion control):
+
+    - additive increase: the limit grows by one after "limit" fast,
+      successful deliveries
+    - multiplicative decrease: the limit is multiplied with "backoff" if the
+      server throttles us (421/451/452 replies) or when the delivery latency
+      exceeds "latency_factor" times the baseline latency.
+
+    The baseline is a moving average (EWMA, weight "latency_smoothing" for
+    each new sample) of the SMTP latency. Time spent waiting for the rate
+    limits of the mailer ("SendResult.rate_limit_delay") is not included.
+
+    The current limit is available as ".limit" (see also ".stats()") and
+    every change is logged.
+    """
+    def __init__(self, max_limit, min_limit=1, initial_limit=None, backoff=0.5,
+                 latency_factor=3.0, latency_smoothing=0.2, log=None, clock=time.monotonic):
+        self.max_limit = int(max_limit)
+        self.min_limit = int(min_limit)
+        if not (1 <= self.min_limit <= self.max_limit):
+            raise ValueError('invalid concurrency limits: min=%r, max=%r' % (min_limit, max_limit))
+        self.backoff = float(backoff)
+        self.latency_factor = float(latency_factor)
+        self.latency_smoothing = float(latency_smoothing)
+        self.log = log or logging.getLogger('mailqueue.sending')
+        self._clock = clock
+        self._limit = int(initial_limit or self.min_limit)
+        # number of successful deliveries since the last change of the limit
+        self._successes = 0
+        self._in_flight = 0
+        self._baseline_latency = None
+        # Deliveries which were started before the last decrease must not
+        # decrease the limit again (one decrease per "window").
+        self._last_decrease = None
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def stats(self):
+        "Return the current state (e.g. for monitoring)."
+        return {
+            'limit'           : self._limit,
+            'min_limit'       : self.min_limit,
+            'max_limit'       : self.max_limit,
+            'in_flight'       : self._in_flight,
+            'baseline_latency': self._baseline_latency,
+        }
+
+    @contextmanager
+    def slot(self):
+        "Block until a delivery slot is available (yields the start time)."
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield self._clock()
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def record(self, send_result, started, smtp_code=None):
+        "Adapt the limit after a delivery which began at \"started\"."
+        latency = self._clock() - started
+        # the rate limits of the mailer are not a sign of congestion
+        latency -= getattr(send_result, 'rate_limit_delay', None) or 0
+        if smtp_code is None:
+            smtp_code = getattr(send_result, 'smtp_code', None)
+        with self._condition:
+            if smtp_code in THROTTLING_REPLY_CODES:
+                self._decrease(started, reason='server reply %s' % smtp_code)
+            elif send_result:
+                baseline = self._baseline_latency
+                if (baseline is not None) and (latency > baseline * self.latency_factor):
+                    self._decrease(started, reason='latency %.2fs' % latency)
+                else:
+                    self._increase()
+                self._update_baseline(latency)
+            self._condition.notify_all()
+
+    # --- internal functionality ----------------------------------------------
+    def _update_baseline(self, latency):
+        if self._baseline_latency is None:
+            self._baseline_latency = latency
+            return
+        self._baseline_latency += self.latency_smoothing * (latency - self._baseline_latency)
+
+    def _increase(self):
+        self._successes += 1
+        if (self._successes < self._limit) or (self._limit >= self.max_limit):
+            return
+        self._successes = 0
+        self._limit += 1
+        self.log.debug('delivery concurrency increased: %d -> %d', self._limit - 1, self._limit)
+
+    def _decrease(self, started, reason):
+        if (self._last_decrease is not None) and (started < self._last_decrease):
+            return
+        previous_limit = self._limit
+        self._limit = max(self.min_limit, int(self._limit * self.backoff))
+        self._successes = 0
+        self._last_decrease = self._clock()
+        if self._limit != previous_limit:
+            self.log.info('delivery concurrency decreased: %d -> %d (%s)',
+                previous_limit, self.limit, reason)
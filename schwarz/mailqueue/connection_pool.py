@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import threading
+import time
+from collections import deque
+
+
+__all__ = ['ConnectionPool']
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of idle connections.
+
+    A connection is removed from the pool by ".checkout()" so it is only
+    used by a single thread at a time and returned with ".checkin()" after
+    use. At most "max_size" idle connections are kept, connections which were
+    idle for more than "idle_timeout" seconds are closed (most servers drop
+    idle clients anyway).
+    """
+    def __init__(self, max_size, idle_timeout=30, close=None, clock=time.monotonic):
+        self.max_size = int(max_size)
+        self.idle_timeout = float(idle_timeout)
+        self._close = close or (lambda connection: connection.close())
+        self._clock = clock
+        # (connection, last_used), ordered by "last_used"
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def checkout(self):
+        "Return an idle connection (or None)."
+        expired = []
+        connection = None
+        with self._lock:
+            now = self._clock()
+            while self._idle and (now - self._idle[0][1] > self.idle_timeout):
+                expired.append(self._idle.popleft()[0])
+            if self._idle:
+                connection = self._idle.pop()[0]
+        for _connection in expired:
+            self._close(_connection)
+        return connection
+
+    def checkin(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((connection, self._clock()))
+                return
+        self._close(connection)
+
+    def close_all(self):
+        with self._lock:
+            connections = [c for c, _ in self._idle]
+            self._idle.clear()
+        for connection in connections:
+            self._close(connection)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+#
+# Claim protocol for queues on shared storage (e.g. NFS) which are used by
+# several hosts. File locks ("flock()") and boltons' "atomic_rename()"
+# (link + unlink) are not reliable on network file systems so this protocol
+# only uses "rename()" and "unlink()" which are atomic on the server.
+#
+# - A message is claimed by renaming "new/<name>" to "cur/<name>;<token>".
+#   Only one host can win the rename, the token is unique for each claim.
+# - The lease file "leases/<name>;<token>" stores owner, token and
+#   expiry. It is written before the rename and renewed by the owner while
+#   the message is being delivered.
+# - All further operations (delete after delivery, move back to "new") use
+#   the claimed path. If the lease expired and another host recovered the
+#   message, that path does not exist anymore so the operation fails
+#   (fencing) instead of modifying a message owned by someone else.
+#
+# Lease expiry uses the wall clock so the clocks of all hosts must be
+# synchronized (e.g. NTP) and "lease_timeout" should be much longer than
+# the expected clock skew.
+
+import json
+import os
+import socket
+import time
+
+from boltons.fileutils import atomic_save
+
+
+__all__ = [
+    'claim_message',
+    'node_id',
+    'recover_expired_leases',
+]
+
+LEASES_FOLDER = 'leases'
+TOKEN_SEPARATOR = ';'
+
+def node_id():
+    "Return the owner identity stored in lease files."
+    return '%s.%d' % (socket.gethostname(), os.getpid())
+
+
+def split_claimed_path(claimed_path):
+    "Return the queue dir, the message name and the token of a claimed message."
+    queue_dir = os.path.dirname(os.path.dirname(claimed_path))
+    filename = os.path.basename(claimed_path)
+    if TOKEN_SEPARATOR not in filename:
+        return queue_dir, filename, None
+    name, _, token = filename.rpartition(TOKEN_SEPARATOR)
+    return queue_dir, name, token
+
+
+def claim_message(msg_path, lease_timeout, owner=None, clock=time.time):
+    """
+    Claim the message at "msg_path" (in "new"). Returns the path of the
+    claimed message (in "cur") or None if another runner claimed it first.
+    """
+    queue_dir = os.path.dirname(os.path.dirname(msg_path))
+    name = os.path.basename(msg_path)
+    token = os.urandom(8).hex()
+    claimed_name = name + TOKEN_SEPARATOR + token
+    # Write the lease first: A claimed message without lease would be
+    # considered expired by other runners.
+    _write_lease(queue_dir, claimed_name, owner or node_id(), token,
+        expires=clock() + lease_timeout)
+    claimed_path = os.path.join(queue_dir, 'cur', claimed_name)
+    try:
+        os.rename(msg_path, claimed_path)
+    except FileNotFoundError:
+        _remove_lease(queue_dir, claimed_name)
+        return None
+    return claimed_path
+
+
+def renew_lease(claimed_path, lease_timeout, owner=None, clock=time.time):
+    "Extend the lease. Returns False if the claim was lost."
+    queue_dir, name, token = split_claimed_path(claimed_path)
+    if not os.path.exists(claimed_path):
+        return False
+    _write_lease(queue_dir, os.path.basename(claimed_path), owner or node_id(), token,
+        expires=clock() + lease_timeout)
+    return True
+
+
+def move_claimed_message(claimed_path, target_folder):
+    """
+    Move a claimed message to "target_folder", e.g. "tmp" (keeping the
+    claim) or "new" (releasing the claim). Returns the new path or None if
+    the claim was lost.
+    """
+    queue_dir, name, token = split_claimed_path(claimed_path)
+    claimed_name = os.path.basename(claimed_path)
+    keep_claim = (target_folder == 'tmp')
+    target_name = claimed_name if keep_claim else name
+    target_path = os.path.join(queue_dir, target_folder, target_name)
+    try:
+        os.rename(claimed_path, target_path)
+    except FileNotFoundError:
+        return None
+    if not keep_claim:
+        _remove_lease(queue_dir, claimed_name)
+    return target_path
+
+
+def remove_claimed_message(claimed_path):
+    "Delete a claimed message. Returns False if the claim was lost."
+    queue_dir = os.path.dirname(os.path.dirname(claimed_path))
+    try:
+        os.unlink(claimed_path)
+    except FileNotFoundError:
+        return False
+    _remove_lease(queue_dir, os.path.basename(claimed_path))
+    return True
+
+
+def recover_expired_leases(queue_dir, log, lease_timeout, clock=time.time):
+    """
+    Move all claimed messages with an expired lease (e.g. the host crashed)
+    back to "new" and remove orphaned lease files. Messages without lease
+    (claimed by a runner which does not use leases) are recovered after
+    "lease_timeout" seconds without modification.
+    """
+    now = clock()
+    # snapshot of all leases, messages claimed after this point are checked
+    # again below before recovering them
+    leases = _read_leases(queue_dir)
+    claimed_names = set()
+    for folder in ('cur', 'tmp'):
+        folder_path = os.path.join(queue_dir, folder)
+        try:
+            entries = list(os.scandir(folder_path))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            has_token = (TOKEN_SEPARATOR in entry.name)
+            if (folder == 'tmp') and not has_token:
+                # regular temporary file (message is being enqueued)
+                continue
+            claimed_names.add(entry.name)
+            if has_token:
+                is_expired = _is_expired(leases.get(entry.name), now)
+                if is_expired:
+                    # claimed (or renewed) by another runner after the leases
+                    # were read
+                    is_expired = _is_expired(_read_lease(queue_dir, entry.name), now)
+            else:
+                is_expired = _mtime(entry) + lease_timeout < now
+            if not is_expired:
+                continue
+            target_path = move_claimed_message(entry.path, 'new')
+            if target_path is not None:
+                log.warning('lease expired, moved message back to "new": %s', entry.name)
+    for claimed_name, lease in leases.items():
+        if (claimed_name not in claimed_names) and (lease['expires'] < now):
+            # e.g. runner crashed after delivering the message
+            _remove_lease(queue_dir, claimed_name)
+
+
+# --- internal helpers --------------------------------------------------------
+def _write_lease(queue_dir, claimed_name, owner, token, expires):
+    leases_path = os.path.join(queue_dir, LEASES_FOLDER)
+    os.makedirs(leases_path, 0o700, exist_ok=True)
+    lease = {'owner': owner, 'token': token, 'expires': expires}
+    lease_path = os.path.join(leases_path, claimed_name)
+    with atomic_save(lease_path, text_mode=False, overwrite_part=True) as lease_fp:
+        lease_fp.write(json.dumps(lease).encode('utf-8'))
+
+def _remove_lease(queue_dir, claimed_name):
+    try:
+        os.unlink(os.path.join(queue_dir, LEASES_FOLDER, claimed_name))
+    except FileNotFoundError:
+        pass
+
+def _read_leases(queue_dir):
+    leases = {}
+    leases_path = os.path.join(queue_dir, LEASES_FOLDER)
+    try:
+        filenames = os.listdir(leases_path)
+    except FileNotFoundError:
+        return leases
+    for filename in filenames:
+        if filename.endswith('.part'):
+            continue
+        # removed in the meantime: treat as expired
+        leases[filename] = _read_lease(queue_dir, filename) or {'expires': 0}
+    return leases
+
+def _read_lease(queue_dir, claimed_name):
+    "Return the lease of a claimed message (or None if there is no lease file)."
+    lease_path = os.path.join(queue_dir, LEASES_FOLDER, claimed_name)
+    try:
+        with open(lease_path, 'rb') as lease_fp:
+            return json.loads(lease_fp.read().decode('utf-8'))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        # garbled: treat as expired
+        return {'expires': 0}
+
+def _is_expired(lease, now):
+    return (lease is None) or (lease['expires'] < now)
+
+def _mtime(entry):
+    try:
+        return entry.stat().st_mtime
+    except OSError:
+        return 0
@@ -670,7 +670,7 @@ class SMTP(object):
         # We could not login successfully.  Return result of last attempt.
         raise last_exception
 
-    def starttls(self, keyfile=None, certfile=None, context=None):
+    def starttls(self, keyfile=None, certfile=None, context=None, session=None):
         """Puts the connection to the SMTP server into TLS mode.
 
         If there has been no previous EHLO or HELO command this session, this
@@ -709,7 +709,8 @@ class SMTP(object):
                 context = ssl._create_stdlib_context(certfile=certfile,
                                                      keyfile=keyfile)
             self.sock = context.wrap_socket(self.sock,
-                                            server_hostname=self._host)
+                                            server_hostname=self._host,
+                                            session=session)
             self.file = None
             # RFC 3207:
             # The client MUST discard any knowledge obtained from
@@ -1,23 +1,73 @@
 # -*- coding: utf-8 -*-
 # SPDX-License-Identifier: MIT
 
+import errno
+import itertools
 import os
+import socket
+import time
 
 import portalocker
 from boltons.fileutils import atomic_rename, atomic_save
 
+from . import syscalls
 from .compat import IS_WINDOWS
+from .syscalls import fsync_directory
 
 
 __all__ = ['create_maildir_directories', 'lock_file', 'move_message']
 
+# - "none": never fsync (e.g. queue on tmpfs, tests)
+# - "file": fsync message data before a message becomes visible in the queue
+# - "full": also fsync the directories after publishing/moving/deleting a
+#   message so the queue state survives power loss.
+DURABILITY_LEVELS = ('none', 'file', 'full')
+
+def check_durability(durability):
+    if durability not in DURABILITY_LEVELS:
+        raise ValueError('invalid durability level %r (expected one of %s)' % (durability, ', '.join(DURABILITY_LEVELS)))  # noqa: E501 (line too long)
+    return durability
+
+def sync_directories(*paths):
+    for path in paths:
+        fsync_directory(path)
+
+
+def write_buffers(fp, buffers):
+    """
+    Write all "buffers" to "fp" sequentially instead of concatenating them
+    first (which needs an extra copy of a possibly large message).
+    Large buffers are passed to the OS without being copied into the write
+    buffer of "fp".
+    """
+    for buffer in buffers:
+        fp.write(memoryview(buffer))
+
+def writev_all(fd, buffers):
+    "Write all \"buffers\" to the file descriptor \"fd\" (with as few syscalls as possible)."
+    views = [memoryview(buffer).cast('B') for buffer in buffers]
+    views = [view for view in views if view.nbytes]
+    if not hasattr(os, 'writev'):
+        for view in views:
+            while view.nbytes:
+                view = view[os.write(fd, view):]
+        return
+    while views:
+        # "writev()" may write only some of the data (e.g. when interrupted
+        # by a signal) so skip everything which was written already.
+        written = os.writev(fd, views)
+        while views and (written >= views[0].nbytes):
+            written -= views.pop(0).nbytes
+        if written:
+            views[0] = views[0][written:]
+
 
 class LockedFile(object):
     __slots__ = ('fp', 'lock', 'name')
-    def __init__(self, fp, lock=None):
+    def __init__(self, fp, lock=None, name=None):
         self.fp = fp
         self.lock = lock
-        self.name = fp.name
+        self.name = name or fp.name
 
     def close(self):
         self.fp.close()
@@ -26,6 +76,12 @@ class LockedFile(object):
     def is_locked(self):
         return (self.lock and (self.lock.fh is not None))
 
+    def fileno(self):
+        return self.fp.fileno()
+
+    def flush(self):
+        self.fp.flush()
+
     def read(self, *args, **kwargs):
         return self.fp.read(*args, **kwargs)
 
@@ -44,6 +100,18 @@ class LockedFile(object):
         self.fp.write(data)
 
 
+class FileHandleLock(object):
+    "Lock acquired directly on an open file (without a path)."
+    __slots__ = ('fh',)
+    def __init__(self, fh):
+        portalocker.lock(fh, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        self.fh = fh
+
+    def release(self):
+        portalocker.unlock(self.fh)
+        self.fh = None
+
+
 def create_maildir_directories(basedir, is_folder=False):
     os.makedirs(basedir, 0o700, exist_ok=True)
     new_path = None
@@ -72,13 +140,32 @@ def find_messages(queue_basedir, log, queue_folder='new'):
     else:
         path_new = os.path.join(queue_basedir, queue_folder)
         try:
-            filenames = os.listdir(path_new)
+            entries = list(os.scandir(path_new))
         except FileNotFoundError:
             pass
         else:
-            for filename in filenames:
-                path = os.path.join(path_new, filename)
-                yield path
+            for entry in entries:
+                # "cur" also contains the claim folders of queue workers
+                if entry.is_file():
+                    yield entry.path
+
+def find_queue_dir(msg_path):
+    "Return the queue dir which contains the message at \"msg_path\"."
+    folder_path = os.path.dirname(msg_path)
+    queue_base_dir = os.path.dirname(folder_path)
+    if os.path.basename(folder_path) not in ('new', 'cur', 'tmp'):
+        # message in a claim folder ("cur/<worker_id>")
+        queue_base_dir = os.path.dirname(queue_base_dir)
+    return queue_base_dir
+
+def find_claim_folders(queue_basedir):
+    "Return the paths of all claim folders (\"cur/<worker_id>\")."
+    path_cur = os.path.join(queue_basedir, 'cur')
+    try:
+        entries = list(os.scandir(path_cur))
+    except FileNotFoundError:
+        return []
+    return [entry.path for entry in entries if entry.is_dir()]
 
 
 def lock_file(path, timeout=None):
@@ -112,7 +199,7 @@ def lock_file(path, timeout=None):
         return None
     return LockedFile(fp, lock)
 
-def move_message(file_, target_folder, open_file=True):
+def move_message(file_, target_folder, open_file=True, durability='file'):
     if hasattr(file_, 'lock') and file_.is_locked():
         locked_file = file_
         file_path = file_.name
@@ -123,7 +210,7 @@ def move_message(file_, target_folder, open_file=True):
         # file-like object here.
         file_path = file_ if (not hasattr(file_, 'name')) else file_.name
     folder_path = os.path.dirname(file_path)
-    queue_base_dir = os.path.dirname(folder_path)
+    queue_base_dir = find_queue_dir(file_path)
     filename = os.path.basename(file_path)
     target_path = os.path.join(queue_base_dir, target_folder, filename)
     if file_path == target_path:
@@ -132,46 +219,231 @@ def move_message(file_, target_folder, open_file=True):
         return file_
 
     did_open_file = False
+    # "renameat2()" fails if another process moved the message already so
+    # the inode checks of "lock_file()" are only needed for the fallback.
+    needs_inode_check = False
     # no locking on Windows as you can not unlink/move open files there.
     if not IS_WINDOWS:
         if not locked_file:
             # acquire lock to ensure that no other process is handling this message
             # currently.
-            locked_file = lock_file(file_path, timeout=0)
+            if _can_rename_noreplace(os.path.dirname(target_path)):
+                locked_file = _open_and_lock(file_path)
+                needs_inode_check = True
+            else:
+                locked_file = lock_file(file_path, timeout=0)
             did_open_file = True
         if locked_file is None:
             return None
     try:
-        # Bolton's "atomic_rename()" is compatible with Windows.
-        # Under Linux "atomic_rename()" ensures that the "target_path" file
-        # contains the complete contents AND never overwrites an existing
-        # file (as long as it is not stored on an NFS filesystem).
-        # However the full operation is NOT atomic in Linux as it consists of
-        # two system calls (link(), unlink()) so it could happen that the file
-        # exists in the source folder AND the target folder (as hard link).
-        # The ideal solution would be to use "renameat2", a Linux-specific
-        # system call which can rename without overwriting. However that
-        # syscall comes with a number of caveats:
-        # - not all file systems are supported (though I guess ext4 should be
-        #   fine)
-        # - not exposed in Python: need to write custom code
-        # - only added in glibc 2.28 (released on 2018-08-01) so we would
-        #   have to do a raw syscall from Python (doable, e.g. with the
-        #   "execute-syscall" github project)
-        # - added in Linux 3.15 - we can not use that syscall in CentOS 7
-        #   (ships with kernel 3.10) which is pretty much a showstopper for me.
-        atomic_rename(file_path, target_path, overwrite=False)
-        if open_file:
-            if IS_WINDOWS:
-                return open(target_path, 'rb+')
-            # reflect the new location in LockedFile wrapper
-            locked_file.name = target_path
-            return locked_file
-        elif did_open_file:
-            # Closing the "LockedFile" will also release locks.
-            # Only close the file if we actually opened it.
-            locked_file.close()
-        return target_path
+        # The lock is still required (even with "renameat2()"): It signals
+        # that a process is handling the message (see
+        # "unblock_stale_messages()").
+        if not _rename_noreplace(file_path, target_path):
+            if needs_inode_check and not _is_same_file(locked_file, file_path):
+                raise FileNotFoundError(file_path)
+            # Bolton's "atomic_rename()" is compatible with Windows.
+            # Under Linux "atomic_rename()" ensures that the "target_path"
+            # file contains the complete contents AND never overwrites an
+            # existing file (as long as it is not stored on an NFS
+            # filesystem). However the full operation is NOT atomic in Linux
+            # as it consists of two system calls (link(), unlink()) so it
+            # could happen that the file exists in the source folder AND the
+            # target folder (as hard link).
+            atomic_rename(file_path, target_path, overwrite=False)
     except (IOError, OSError):
-        pass
-    return None
+        if did_open_file:
+            locked_file.close()
+        return None
+    if durability == 'full':
+        # The rename modified both directories. Without syncing the
+        # source folder the message could show up twice after a crash.
+        sync_directories(os.path.dirname(target_path), folder_path)
+    if open_file:
+        if IS_WINDOWS:
+            try:
+                return open(target_path, 'rb+')
+            except (IOError, OSError):
+                return None
+        # reflect the new location in LockedFile wrapper
+        locked_file.name = target_path
+        return locked_file
+    elif did_open_file:
+        # Closing the "LockedFile" will also release locks.
+        # Only close the file if we actually opened it.
+        locked_file.close()
+    return target_path
+
+
+def replace_file(file_, buffers, durability='file'):
+    """
+    Replace the contents of the open "file_" with "buffers": The data is
+    written to a new file in the queue's "tmp" folder which is then renamed
+    over "file_" so a crash can never leave a partially rewritten file.
+
+    Returns the new (open and locked) file, "file_" is closed. "file_" is
+    returned unchanged if it was deleted already (never resurrect a removed
+    file).
+    """
+    if os.fstat(file_.fileno()).st_nlink == 0:
+        return file_
+    file_path = file_.name
+    tmp_dir = os.path.join(find_queue_dir(file_path), 'tmp')
+    tmp_path = os.path.join(tmp_dir, unique_maildir_filename())
+    fp = open(tmp_path, 'xb+')
+    try:
+        # Lock the file before it replaces the original so the lock is held
+        # without interruption (same as "move_message()").
+        lock = None if IS_WINDOWS else FileHandleLock(fp)
+        write_buffers(fp, buffers)
+        fp.flush()
+        if durability != 'none':
+            os.fsync(fp.fileno())
+        if IS_WINDOWS:
+            # Windows can not replace open files
+            fp.close()
+            file_.close()
+        os.replace(tmp_path, file_path)
+    except:
+        fp.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    if durability == 'full':
+        # same as "move_message()": the rename modified both directories
+        sync_directories(os.path.dirname(file_path), tmp_dir)
+    if IS_WINDOWS:
+        return open(file_path, 'rb+')
+    file_.close()
+    fp.seek(0)
+    return LockedFile(fp, lock=lock, name=file_path)
+
+
+# "renameat2()" needs Linux 3.15+ and support by the file system. Remember
+# when the kernel does not provide it at all (ENOSYS) and which directories
+# rejected it (EINVAL/EOPNOTSUPP: not supported by the file system, EPERM:
+# blocked by a seccomp filter, e.g. in containers).
+_renameat2_works = syscalls.has_renameat2()
+_dirs_without_renameat2 = set()
+_RENAMEAT2_UNSUPPORTED_ERRORS = (errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM)
+
+def _can_rename_noreplace(dst_dir):
+    return _renameat2_works and (dst_dir not in _dirs_without_renameat2)
+
+def _rename_noreplace(src, dst):
+    """
+    Rename "src" to "dst" with a single "renameat2(RENAME_NOREPLACE)" call.
+    Returns False if that is not supported (the caller must use a different
+    method to rename the file).
+    """
+    global _renameat2_works
+    dst_dir = os.path.dirname(dst)
+    if not _can_rename_noreplace(dst_dir):
+        return False
+    try:
+        syscalls.rename_noreplace(src, dst)
+    except OSError as e:
+        if e.errno == errno.ENOSYS:
+            _renameat2_works = False
+            return False
+        elif e.errno in _RENAMEAT2_UNSUPPORTED_ERRORS:
+            # both directories are on the same file system (otherwise the
+            # error would be EXDEV)
+            _dirs_without_renameat2.update((dst_dir, os.path.dirname(src)))
+            return False
+        raise
+    return True
+
+def _open_and_lock(path):
+    "Open and lock \"path\" without the inode checks of \"lock_file()\"."
+    try:
+        fp = open(path, 'rb+')
+    except OSError:
+        return None
+    try:
+        lock = FileHandleLock(fp)
+    except portalocker.LockException:
+        fp.close()
+        return None
+    return LockedFile(fp, lock)
+
+def _is_same_file(locked_file, path):
+    try:
+        return (os.fstat(locked_file.fileno()).st_ino == os.stat(path).st_ino)
+    except OSError:
+        return False
+
+
+# same format as "mailbox.Maildir" but without calling "gethostname()" for
+# every message
+_hostname = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+_counter = itertools.count(1)
+
+def unique_maildir_filename():
+    now = time.time()
+    microseconds = int(now % 1 * 1e6)
+    return '%d.M%dP%dQ%d.%s' % (int(now), microseconds, os.getpid(), next(_counter), _hostname)
+
+
+def _supports_o_tmpfile():
+    # Linking an anonymous file requires "/proc" (linkat() with AT_EMPTY_PATH
+    # needs CAP_DAC_READ_SEARCH).
+    return hasattr(os, 'O_TMPFILE') and os.path.isdir('/proc/self/fd')
+
+HAS_O_TMPFILE = _supports_o_tmpfile()
+
+def publish_anonymous_file(queue_dir, target_folder, data, durability='file'):
+    """
+    Write "data" (bytes or a sequence of buffers) to an anonymous file
+    (O_TMPFILE, Linux only) and link it into "target_folder" when the data is
+    complete. Incomplete files are never visible and a crash can not leave orphaned files in "tmp".
+
+    Returns a locked (and open) "LockedFile" or None if O_TMPFILE is not
+    supported by the platform/file system.
+    """
+    if not HAS_O_TMPFILE:
+        return None
+    target_dir = os.path.join(queue_dir, target_folder)
+    dir_fd = os.open(target_dir, os.O_RDONLY)
+    try:
+        try:
+            fd = os.open('.', os.O_TMPFILE | os.O_RDWR, 0o600, dir_fd=dir_fd)
+        except OSError as e:
+            # EISDIR: kernel < 3.11, EOPNOTSUPP: not supported by the file system
+            if e.errno in (errno.EISDIR, errno.EOPNOTSUPP, errno.EINVAL):
+                return None
+            raise
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = (data,)
+        fp = os.fdopen(fd, 'rb+')
+        try:
+            writev_all(fd, data)
+            if durability != 'none':
+                os.fsync(fd)
+            # Lock the file before it becomes visible so "mq-run" can not
+            # pick it up while the caller still needs it (same as
+            # "move_message()").
+            lock = FileHandleLock(fp)
+            filename = _link_anonymous_file(fd, dir_fd)
+            if durability == 'full':
+                os.fsync(dir_fd)
+        except:
+            fp.close()
+            raise
+    finally:
+        os.close(dir_fd)
+    fp.seek(0)
+    return LockedFile(fp, lock=lock, name=os.path.join(target_dir, filename))
+
+def _link_anonymous_file(fd, dir_fd):
+    src_path = '/proc/self/fd/%d' % fd
+    while True:
+        filename = unique_maildir_filename()
+        try:
+            # Passing "dst_dir_fd" ensures CPython uses "linkat()" so
+            # "follow_symlinks" is respected (plain "link()" would try to
+            # link the "/proc" symlink itself).
+            os.link(src_path, filename, dst_dir_fd=dir_fd, follow_symlinks=True)
+        except FileExistsError:
+            continue
+        return filename
@@ -2,68 +2,373 @@
 # SPDX-License-Identifier: MIT
 
 import socket
+import ssl
+import time
+from functools import lru_cache
 from io import BytesIO
 from smtplib import SMTPException
 
+from .connection_pool import ConnectionPool
 from .message_utils import MsgInfo, SendResult
-from .smtpclient import SMTPClient
+from .rate_limit import TokenBucket
+from .smtpclient import SMTPClient, SMTPDataError, SMTPRecipientRefused, SMTPSenderRefused
 
 
-__all__ = ['DebugMailer', 'SMTPMailer']
+__all__ = ['build_ssl_context', 'DebugMailer', 'SMTPMailer']
+
+# - "implicit": TLS from the start ("SMTPS", usually port 465)
+# - "starttls": plain connection, use STARTTLS if supported by the server
+# - "none": never use TLS
+TLS_MODES = ('implicit', 'starttls', 'none')
 
 class SMTPMailer(object):
+    # ".send()" accepts a "deadline" parameter (see MessageHandler)
+    supports_deadline = True
+
     def __init__(self, hostname=None, **kwargs):
         if (hostname is None) and ('client' not in kwargs):
             raise TypeError('not enough parameters for __init__(): please specify at least "hostname" or "client"')  # noqa: E501 (line too long)
         self.hostname = hostname
-        self.port = int(kwargs.pop('port', 25))
+        self.tls = kwargs.pop('tls', 'starttls')
+        if self.tls not in TLS_MODES:
+            raise ValueError('invalid TLS mode %r (expected one of %s)' % (self.tls, ', '.join(TLS_MODES)))  # noqa: E501 (line too long)
+        default_port = 465 if (self.tls == 'implicit') else 25
+        self.port = int(kwargs.pop('port', default_port))
         self.username = kwargs.pop('username', None)
         self.password = kwargs.pop('password', None)
         self.connect_timeout = kwargs.pop('timeout', 10)
         self.smtp_log = kwargs.pop('smtp_log', None)
         self._client = kwargs.pop('client', None)
+        self.tls_cafile = kwargs.pop('tls_cafile', None)
+        self.tls_certfile = kwargs.pop('tls_certfile', None)
+        self.tls_keyfile = kwargs.pop('tls_keyfile', None)
+        self.tls_min_version = kwargs.pop('tls_min_version', None)
+        self._ssl_context = kwargs.pop('ssl_context', None)
+        # deliver the message to all accepted recipients even if the server
+        # refused some of them (see "SendResult.refused_recipients")
+        self.partial_delivery = kwargs.pop('partial_delivery', False)
+        # Max. number of recipients per SMTP transaction (None: no limit).
+        # Lowered automatically if the server replies "452 too many recipients".
+        max_recipients = kwargs.pop('max_recipients', None)
+        self.max_recipients = int(max_recipients) if max_recipients else None
+        max_messages_per_second = kwargs.pop('max_messages_per_second', None)
+        max_recipients_per_minute = kwargs.pop('max_recipients_per_minute', None)
+        self.message_rate = _build_bucket(max_messages_per_second, period=1)
+        self.recipient_rate = _build_bucket(max_recipients_per_minute, period=60)
+        # TLS session of the previous connection, passed to the next STARTTLS
+        # so the server can resume the session (abbreviated handshake).
+        self._tls_session = None
+        # Connections are kept open after sending a message so the next
+        # message can reuse them. "keep_alive" is a shortcut for "pool_size=1".
+        pool_size = int(kwargs.pop('pool_size', 0))
+        if kwargs.pop('keep_alive', False):
+            pool_size = max(pool_size, 1)
+        self.pool_idle_timeout = float(kwargs.pop('pool_idle_timeout', 30))
+        self.pool = None
+        if pool_size:
+            self.pool = self._build_pool(pool_size)
         if kwargs:
             extra_name = tuple(kwargs)[0]
             raise TypeError("__init__() got an unexpected keyword argument '%s'" % extra_name)
 
-    def init_smtp_client(self):
+    @property
+    def ssl_context(self):
+        if self._ssl_context is None:
+            self._ssl_context = build_ssl_context(
+                cafile      = self.tls_cafile,
+                certfile    = self.tls_certfile,
+                keyfile     = self.tls_keyfile,
+                min_version = self.tls_min_version,
+            )
+        return self._ssl_context
+
+    @property
+    def keep_alive(self):
+        return (self.pool is not None)
+
+    @keep_alive.setter
+    def keep_alive(self, value):
+        if value and (self.pool is None):
+            self.pool = self._build_pool(1)
+        elif (not value) and (self.pool is not None):
+            self.close()
+            self.pool = None
+
+    def _build_pool(self, pool_size):
+        return ConnectionPool(pool_size, idle_timeout=self.pool_idle_timeout, close=_quit_quietly)
+
+    def init_smtp_client(self, expires_at=None):
+        tls_kwargs = {}
+        if self.tls == 'implicit':
+            tls_kwargs = {'ssl_context': self.ssl_context, 'tls_session': self._tls_session}
         smtp_client = SMTPClient(
             self.hostname,
             self.port,
             timeout=self.connect_timeout,
             smtp_log=self.smtp_log,
+            deadline=expires_at,
+            **tls_kwargs
         )
         return smtp_client
 
-    def send(self, fromaddr, toaddrs, message):
+    def send(self, fromaddr, toaddrs, message, deadline=None):
+        # "deadline": max. number of seconds for the whole SMTP session. The
+        # only exception is the final reply after the message was transmitted
+        # (otherwise the caller might queue a message which was delivered).
         msg_was_sent = SendResult(False, queued=False, transport='smtp')
+        expires_at = None
+        if deadline is not None:
+            expires_at = time.monotonic() + deadline
+        # waiting for the rate limits counts against the deadline
+        rate_limit_delay = self._wait_for_rate_limits(toaddrs, max_wait=deadline)
+        if rate_limit_delay is None:
+            # Fail fast so the next transport (e.g. the queue) can take over.
+            # No "phase": this is not a problem of the SMTP server.
+            if self.smtp_log:
+                self.smtp_log.info('rate limit: not sending, waiting would exceed the deadline')
+            return msg_was_sent
+        msg_was_sent.rate_limit_delay = rate_limit_delay
+        phase = 'connect'
+        connection = None
         try:
-            if self._client is None:
-                connection = self.init_smtp_client()
-            else:
-                client = self._client
-                is_connected = (getattr(client, 'sock', None) is not None)
-                if not is_connected:
-                    client.connect()
-                connection = client
-            connection.ehlo()
-
-            is_tls_supported = connection.has_extn('starttls')
-            if is_tls_supported:
-                connection.starttls()
+            if (expires_at is not None) and (expires_at <= time.monotonic()):
+                raise socket.timeout('SMTP deadline exceeded')
+            connection = self._reusable_connection(expires_at)
+            if connection is None:
+                if self._client is None:
+                    connection = self.init_smtp_client(expires_at=expires_at)
+                else:
+                    client = self._client
+                    _set_deadline(client, expires_at)
+                    is_connected = (getattr(client, 'sock', None) is not None)
+                    if not is_connected:
+                        client.connect()
+                    connection = client
                 connection.ehlo()
-            if (self.username is not None) and (self.password is not None):
-                connection.login(self.username, self.password)
 
-            connection.sendmail(fromaddr, toaddrs, message)
+                use_starttls = (self.tls == 'starttls') and connection.has_extn('starttls')
+                if use_starttls:
+                    connection.starttls(context=self.ssl_context, session=self._tls_session)
+                    connection.ehlo()
+                if (self.username is not None) and (self.password is not None):
+                    phase = 'auth'
+                    connection.login(self.username, self.password)
+
+            phase = 'sender'
+            refused = self._sendmail_in_batches(connection, fromaddr, toaddrs, message)
             msg_was_sent.value = True
-            connection.quit()
+            msg_was_sent.refused_recipients = _refused_recipients(refused)
+            # TLS 1.3 servers send the session ticket after the handshake so
+            # the session is only complete after some data was exchanged.
+            self._remember_tls_session(connection)
+            if connection.sock is None:
+                # closed after a failed batch, never return it to the pool
+                pass
+            elif self.pool is not None:
+                self.pool.checkin(connection)
+            else:
+                connection.quit()
         except (SMTPException, OSError, socket.error) as e:
+            msg_was_sent.smtp_code = getattr(e, 'smtp_code', None)
+            msg_was_sent.smtp_reply = _smtp_reply(e)
+            if not msg_was_sent:
+                msg_was_sent.phase = _failure_phase(e, phase)
+                msg_was_sent.refused_recipients = _refused_recipients(
+                    getattr(e, 'refused_recipients', None))
             if self.smtp_log:
                 log_msg = '%s (%s)' % (str(e), e.__class__.__name__)
                 self.smtp_log.warning(log_msg)
+            if connection is not None:
+                # connection state is unknown (e.g. deadline exceeded), never
+                # return it to the pool
+                _close_quietly(connection)
         return msg_was_sent
 
+    def _sendmail_in_batches(self, connection, fromaddr, toaddrs, message):
+        """
+        Send the message in several SMTP transactions (over the same
+        connection) if there are more recipients than the server accepts in
+        one transaction. Returns the refused recipients.
+
+        If a batch fails after the message was delivered to earlier batches,
+        the recipients of that batch (and all later ones) are returned as
+        refused so only these are retried.
+        """
+        if isinstance(toaddrs, str):
+            toaddrs = [toaddrs]
+        pending = list(toaddrs)
+        refused = {}
+        is_first_batch = True
+        while pending:
+            batch_size = self.max_recipients or len(pending)
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            try:
+                batch_refused = connection.sendmail(fromaddr, batch, message,
+                    allow_partial=(self.partial_delivery or not is_first_batch))
+            except (SMTPException, OSError) as e:
+                if is_first_batch:
+                    raise
+                reply = (getattr(e, 'smtp_code', None), _smtp_reply(e) or str(e))
+                batch_refused = getattr(e, 'refused_recipients', None)
+                if not batch_refused:
+                    batch_refused = dict((recipient, reply) for recipient in batch)
+                refused.update(batch_refused)
+                refused.update((recipient, reply) for recipient in pending)
+                if self.smtp_log:
+                    self.smtp_log.warning('%s (%s), message not sent to %d recipients',
+                        str(e), e.__class__.__name__, len(batch_refused) + len(pending))
+                _close_quietly(connection)
+                break
+            refused.update(batch_refused)
+            deferred = connection.deferred_recipients
+            if deferred:
+                nr_accepted = len(batch) - len(deferred) - len(batch_refused)
+                self._learn_recipient_limit(nr_accepted)
+                pending = deferred + pending
+            is_first_batch = False
+        return refused
+
+    def _learn_recipient_limit(self, nr_accepted):
+        if (self.max_recipients is not None) and (self.max_recipients <= nr_accepted):
+            return
+        self.max_recipients = nr_accepted
+        if self.smtp_log:
+            self.smtp_log.info('server accepts only %d recipients per message', nr_accepted)
+
+    def close(self):
+        "Close all connections kept open by the connection pool."
+        if self.pool is not None:
+            self.pool.close_all()
+
+    def _reusable_connection(self, expires_at):
+        if self.pool is None:
+            return None
+        while True:
+            connection = self.pool.checkout()
+            if connection is None:
+                return None
+            # The server might have closed the connection in the meantime
+            # (idle timeout). "NOOP" is much cheaper than a new connection
+            # (TCP, TLS, EHLO, AUTH) and reconnecting after "MAIL FROM" would
+            # be harder.
+            _set_deadline(connection, expires_at)
+            try:
+                code, _ = connection.noop()
+            except (SMTPException, OSError):
+                code = None
+            if code == 250:
+                return connection
+            _close_quietly(connection)
+
+    def _wait_for_rate_limits(self, toaddrs, max_wait=None):
+        # pace deliveries instead of provoking "421"/"451" replies from
+        # servers which throttle clients sending too fast.
+        # Returns None if the caller would have to wait more than "max_wait"
+        # seconds.
+        waited_s = 0
+        if self.message_rate is not None:
+            waited_s = self.message_rate.acquire(1, max_wait=max_wait)
+            if waited_s is None:
+                return None
+        if self.recipient_rate is not None:
+            nr_recipients = 1 if isinstance(toaddrs, str) else len(toaddrs)
+            remaining = (max_wait - waited_s) if (max_wait is not None) else None
+            recipient_wait = self.recipient_rate.acquire(nr_recipients, max_wait=remaining)
+            if recipient_wait is None:
+                # the message is not sent so it must not use up the message rate
+                if self.message_rate is not None:
+                    self.message_rate.release(1)
+                return None
+            waited_s += recipient_wait
+        if waited_s and self.smtp_log:
+            self.smtp_log.debug('rate limit: waited %.2fs before sending', waited_s)
+        return waited_s
+
+    def _remember_tls_session(self, connection):
+        tls_session = getattr(connection.sock, 'session', None)
+        if tls_session is not None:
+            self._tls_session = tls_session
+
+
+def _set_deadline(connection, expires_at):
+    # only "SMTPClient" supports deadlines (custom clients might not)
+    if hasattr(connection, 'set_deadline'):
+        connection.set_deadline(expires_at)
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except OSError:
+        pass
+
+def _quit_quietly(connection):
+    try:
+        connection.quit()
+    except (SMTPException, OSError):
+        _close_quietly(connection)
+
+
+def _failure_phase(exc, phase):
+    # "SMTPClient.sendmail()" handles MAIL FROM, RCPT TO and DATA
+    if isinstance(exc, SMTPSenderRefused):
+        return 'sender'
+    elif isinstance(exc, SMTPRecipientRefused):
+        return 'recipient'
+    elif isinstance(exc, SMTPDataError):
+        return 'data'
+    return phase
+
+
+def _smtp_reply(exc):
+    smtp_error = getattr(exc, 'smtp_error', None)
+    if isinstance(smtp_error, bytes):
+        smtp_error = smtp_error.decode('utf-8', 'replace')
+    return smtp_error
+
+
+def _refused_recipients(refused):
+    if not refused:
+        return None
+    refused_recipients = {}
+    for recipient, (smtp_code, smtp_reply) in refused.items():
+        if isinstance(smtp_reply, bytes):
+            smtp_reply = smtp_reply.decode('utf-8', 'replace')
+        refused_recipients[recipient] = (smtp_code, smtp_reply)
+    return refused_recipients
+
+
+def _build_bucket(rate, period):
+    if not rate:
+        return None
+    return TokenBucket(float(rate), period=period)
+
+
+def build_ssl_context(cafile=None, certfile=None, keyfile=None, min_version=None):
+    """
+    Return an SSLContext for SMTP connections. The context is only built once
+    per process for each set of parameters as loading the CA bundle is
+    expensive and sharing the context is required for TLS session resumption.
+
+    Server certificates are only verified if "cafile" was given (this matches
+    the behavior of previous versions which did not verify certificates).
+    """
+    # "lru_cache" treats positional and keyword arguments differently
+    return _build_ssl_context(cafile, certfile, keyfile, min_version)
+
+@lru_cache(maxsize=None)
+def _build_ssl_context(cafile, certfile, keyfile, min_version):
+    if cafile:
+        context = ssl.create_default_context(cafile=cafile)
+    else:
+        context = ssl._create_stdlib_context()
+    if certfile:
+        context.load_cert_chain(certfile, keyfile=keyfile)
+    if min_version:
+        # accept "TLSv1.2" as well as "TLSv1_2" (name of the enum member)
+        version_name = min_version.replace('.', '_')
+        context.minimum_version = ssl.TLSVersion[version_name]
+    return context
+
 
 class DebugMailer(object):
     def __init__(self, simulate_failed_sending=False, send_callback=None):
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: MIT
 
 import logging
+import time
 from io import BytesIO
 from typing import Optional
 
@@ -9,15 +10,89 @@ from .message_utils import MsgInfo, SendResult, dt_now, msg_as_bytes
 from .plugins import MQAction, MQSignal
 
 
-__all__ = ['BaseMsg', 'InMemoryMsg', 'MessageHandler']
+__all__ = ['BaseMsg', 'InMemoryMsg', 'MessageHandler', 'RetryPolicy']
+
+# 5xx replies in these phases are about the message itself (sender,
+# recipient or content). 5xx replies while connecting/authenticating are
+# caused by the configuration or the server and might be fixed later.
+PERMANENT_FAILURE_PHASES = ('sender', 'recipient', 'data')
+
+class RetryPolicy(object):
+    """
+    Decides if the delivery of a message should be given up after a failed
+    delivery attempt:
+    - permanent failures: 5xx replies to MAIL FROM, RCPT TO or DATA (unless
+      "retry_permanent_failures" is set), 4xx replies are always temporary.
+      A refused recipient is only permanent for the whole message if all
+      recipients were refused.
+    - "max_retries": number of failed delivery attempts ("X-Retries")
+    - "max_queue_age": seconds since the message was queued
+
+    Queued messages are moved to the "failed" folder of the queue when the
+    delivery was given up so "mq-run" does not try them again. The limits
+    ("max_retries", "max_queue_age") are also checked before each delivery
+    attempt.
+    """
+    def __init__(self, max_retries=None, max_queue_age=None, retry_permanent_failures=False,
+                 clock=dt_now):
+        self.max_retries = max_retries
+        self.max_queue_age = max_queue_age
+        self.retry_permanent_failures = retry_permanent_failures
+        self._clock = clock
+
+    def is_permanent_failure(self, send_result, recipients=None):
+        smtp_code = getattr(send_result, 'smtp_code', None)
+        phase = getattr(send_result, 'phase', None)
+        if (phase == 'recipient') and (recipients is not None) and (len(recipients) > 1):
+            # Without partial delivery the server only rejected the first
+            # refused recipient, the others might be fine.
+            refused_recipients = getattr(send_result, 'refused_recipients', None) or ()
+            if not all((recipient in refused_recipients) for recipient in recipients):
+                return False
+        return self.is_permanent_reply(smtp_code, phase)
+
+    def is_permanent_reply(self, smtp_code, phase):
+        if self.retry_permanent_failures:
+            return False
+        if (smtp_code is None) or (phase not in PERMANENT_FAILURE_PHASES):
+            return False
+        return (500 <= smtp_code < 600)
+
+    def give_up_reason(self, msg, send_result) -> Optional[str]:
+        "Return why the delivery should be given up (or None to retry later)."
+        if self.is_permanent_failure(send_result, msg.to_addrs):
+            reason = 'permanent failure (%s): %d' % (send_result.phase, send_result.smtp_code)
+            smtp_reply = getattr(send_result, 'smtp_reply', None)
+            if smtp_reply:
+                reason += ' ' + smtp_reply
+            return reason
+        return self.expired_reason(msg)
+
+    def expired_reason(self, msg) -> Optional[str]:
+        "Return why the message exceeded the limits of the policy (or None)."
+        has_failed = (msg.retries > 0)
+        if has_failed and (self.max_retries is not None) and (msg.retries >= self.max_retries):
+            return 'too many failed delivery attempts (%d)' % msg.retries
+        if self.max_queue_age is not None:
+            queue_date = msg.queue_date
+            queue_age = (self._clock() - queue_date).total_seconds() if queue_date else 0
+            if queue_age > self.max_queue_age:
+                return 'message too old (queued %d seconds ago)' % queue_age
+        return None
+
 
 class MessageHandler(object):
-    def __init__(self, transports, delivery_log=None, plugins=None):
+    def __init__(self, transports, delivery_log=None, plugins=None, retry_policy=None):
         self.transports = transports
         self.delivery_log = delivery_log or logging.getLogger('mailqueue.delivery_log')
         self.plugins = plugins
+        self.retry_policy = retry_policy
 
-    def send_message(self, msg, **kwargs) -> Optional[SendResult]:
+    def send_message(self, msg, deadline=None, **kwargs) -> Optional[SendResult]:
+        # "deadline" (seconds) limits the time spent in transports which
+        # support it (e.g. "SMTPMailer"). The message is passed to the next
+        # transport (e.g. the queue) when the deadline was exceeded.
+        expires_at = (time.monotonic() + deadline) if (deadline is not None) else None
         msg_wrapper = self._wrap_msg(msg)
         result = msg_wrapper.start_delivery()
         if not result:
@@ -29,34 +104,124 @@ class MessageHandler(object):
             msg_wrapper.to_addrs = recipients
         msg_bytes = msg_wrapper.msg_bytes
 
+        failure_reason = None
+        if self.retry_policy is not None:
+            # e.g. the policy changed or the message waited too long for the
+            # next queue run: do not even try to deliver it
+            failure_reason = self.retry_policy.expired_reason(msg_wrapper)
+        if failure_reason:
+            self._abandon_delivery(msg_wrapper, sender, recipients, failure_reason)
+            send_result = SendResult(False)
+            send_result.failure_reason = failure_reason
+            return send_result
+
         send_result = SendResult(False)
+        # result of a transport which delivered the message to some recipients
+        partial_result = None
         for transport in self.transports:
-            send_result = transport.send(sender, recipients, msg_bytes)
+            if (expires_at is not None) and getattr(transport, 'supports_deadline', False):
+                remaining = expires_at - time.monotonic()
+                send_result = transport.send(sender, recipients, msg_bytes, deadline=remaining)
+            else:
+                send_result = transport.send(sender, recipients, msg_bytes)
             if (send_result is True) or (send_result is False):
                 send_result = SendResult(send_result)
+            # partial delivery: some recipients were refused by the server
+            pending_recipients = self._pending_recipients(sender, recipients, send_result)
+            if send_result and pending_recipients:
+                # The next transport (e.g. the queue) only gets the recipients
+                # which were refused temporarily.
+                self._log_successful_delivery(msg_wrapper, sender,
+                    _accepted_recipients(recipients, send_result))
+                partial_result = send_result
+                send_result = SendResult(False)
+                recipients = msg_wrapper.to_addrs = pending_recipients
+                continue
             if send_result:
                 self._notify_plugins(MQSignal.delivery_successful, msg_wrapper, send_result)
                 msg_wrapper.delivery_successful()
                 was_queued = (send_result.queued is not False)
                 if not was_queued:
-                    self._log_successful_delivery(msg_wrapper, sender, recipients)
+                    self._log_successful_delivery(msg_wrapper, sender,
+                        _accepted_recipients(recipients, send_result))
+                break
+            if pending_recipients:
+                recipients = msg_wrapper.to_addrs = pending_recipients
+            if self._is_permanent_failure(send_result, recipients):
+                # retrying later (e.g. via the queue) would not help
                 break
 
         if not send_result:
             msg_wrapper.retries += 1
             msg_wrapper.last_delivery_attempt = dt_now()
             discard_message = self._notify_plugins(MQSignal.delivery_failed, msg_wrapper, send_result)  # noqa: E501 (line too long)
-            msg_wrapper.delivery_failed(discard=discard_message)
+            failure_reason = None
+            if (not discard_message) and (self.retry_policy is not None):
+                failure_reason = self.retry_policy.give_up_reason(msg_wrapper, send_result)
+            if failure_reason:
+                self._abandon_delivery(msg_wrapper, sender, recipients, failure_reason)
+            else:
+                msg_wrapper.delivery_failed(discard=discard_message)
             send_result.discarded = discard_message
+            send_result.failure_reason = failure_reason
+            if partial_result is not None:
+                return partial_result
         return send_result
 
     # --- internal functionality ----------------------------------------------
+    def _is_permanent_failure(self, send_result, recipients):
+        if self.retry_policy is None:
+            return False
+        return self.retry_policy.is_permanent_failure(send_result, recipients)
+
+    def _abandon_delivery(self, msg, sender, recipients, failure_reason):
+        self._log_abandoned_delivery(msg, sender, recipients, failure_reason)
+        msg.delivery_abandoned(failure_reason)
+        if not msg.is_queued:
+            self._store_failed_message(msg, failure_reason)
+
+    def _store_failed_message(self, msg, failure_reason):
+        # messages which were not queued yet (e.g. "mq-sendmail") are kept in
+        # the "failed" folder of the queue (if there is one)
+        for transport in self.transports:
+            store_failed_message = getattr(transport, 'store_failed_message', None)
+            if store_failed_message is not None:
+                store_failed_message(msg.from_addr, msg.to_addrs, msg.msg_bytes, failure_reason)
+                break
+
+    def _pending_recipients(self, sender, recipients, send_result):
+        """
+        Return the recipients which were refused temporarily (if the transport
+        reported refused recipients, otherwise None). Recipients which were
+        refused permanently are dropped.
+        """
+        refused_recipients = getattr(send_result, 'refused_recipients', None)
+        if not refused_recipients:
+            return None
+        pending_recipients = []
+        for recipient in recipients:
+            if recipient not in refused_recipients:
+                continue
+            smtp_code, smtp_reply = refused_recipients[recipient]
+            if (self.retry_policy is not None) and self.retry_policy.is_permanent_reply(smtp_code, 'recipient'):  # noqa: E501 (line too long)
+                self.delivery_log.warning('%s => %s: recipient refused permanently (%s %s)',
+                    sender, recipient, smtp_code, smtp_reply)
+                continue
+            pending_recipients.append(recipient)
+        return tuple(pending_recipients)
+
     def _log_successful_delivery(self, msg, sender, recipients):
         log_msg = '%s => %s' % (sender, ', '.join(recipients))
         if msg.msg_id:
             log_msg += ' <%s>' % msg.msg_id
         self.delivery_log.info(log_msg)
 
+    def _log_abandoned_delivery(self, msg, sender, recipients, failure_reason):
+        log_msg = '%s => %s' % (sender, ', '.join(recipients))
+        if msg.msg_id:
+            log_msg += ' <%s>' % msg.msg_id
+        self.delivery_log.warning('%s: delivery given up, %s', log_msg, failure_reason)
+
     def _notify_plugins(self, signal, msg, send_result):
         if self.plugins is None:
             return
@@ -103,7 +268,18 @@ class MessageHandler(object):
 
 
 
+def _accepted_recipients(recipients, send_result):
+    refused_recipients = getattr(send_result, 'refused_recipients', None)
+    if not refused_recipients:
+        return recipients
+    return tuple(recipient for recipient in recipients if recipient not in refused_recipients)
+
+
+
 class BaseMsg(object):
+    # True if the message is stored in the queue already
+    is_queued = False
+
     def __init__(self, msg: Optional[MsgInfo]=None):
         self._msg = msg
         self._from = None
@@ -121,6 +297,10 @@ class BaseMsg(object):
     def delivery_successful(self):
         pass
 
+    def delivery_abandoned(self, reason):
+        "The delivery was given up (see \"RetryPolicy\")."
+        pass
+
     @property
     def msg(self):
         return self._msg
@@ -153,6 +333,10 @@ class BaseMsg(object):
     def msg_id(self):
         return self.msg.msg_id
 
+    @property
+    def queue_date(self):
+        return self.msg.queue_date
+
     @property
     def retries(self):
         return self._retries or 0
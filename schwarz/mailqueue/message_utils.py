@@ -20,8 +20,26 @@ from .lib import Result
 __all__ = ['autogenerate_headers', 'dt_now', 'parse_message_envelope', 'MsgInfo', 'SendResult']
 
 class SendResult(Result):
-    def __init__(self, was_sent, queued=None, transport=None):
-        super().__init__(was_sent, queued=queued, transport=transport, discarded=None)
+    def __init__(self, was_sent, queued=None, transport=None, smtp_code=None, phase=None,
+                 smtp_reply=None, refused_recipients=None):
+        # "smtp_code": reply code of the SMTP command which failed (if any)
+        # "smtp_reply": text of that reply (e.g. "5.1.1 user unknown")
+        # "phase": SMTP stage where the delivery failed ("connect", "auth",
+        #          "sender", "recipient", "data")
+        # "refused_recipients": partial delivery, "{recipient: (smtp_code, smtp_reply)}"
+        # "rate_limit_delay": seconds spent waiting for the mailer's rate limits
+        # "failure_reason": set if the delivery was given up (see "RetryPolicy")
+        super().__init__(was_sent,
+            queued             = queued,
+            transport          = transport,
+            discarded          = None,
+            smtp_code          = smtp_code,
+            smtp_reply         = smtp_reply,
+            phase              = phase,
+            refused_recipients = refused_recipients,
+            rate_limit_delay   = None,
+            failure_reason     = None,
+        )
 
 
 def parse_message_envelope(fp):
@@ -31,6 +49,7 @@ def parse_message_envelope(fp):
         'X-Queue-Date',
         'X-Last-Attempt',
         'X-Retries',
+        'X-Failure-Reason',
         'X-Queue-Meta-End',
     }
 
@@ -57,10 +76,12 @@ def parse_message_envelope(fp):
     last = parse_datetime(queue_meta.pop('X-Last-Attempt', None))
 
     retries = parse_number(queue_meta.pop('X-Retries', None))
+    failure_reason = queue_meta.pop('X-Failure-Reason', None)
 
     msg_fp = BytesIO(fp.read())
     msg_fp.seek(0)
-    msg_info = MsgInfo(from_addr, tuple(to_addrs), msg_fp, queue_date, last=last, retries=retries)
+    msg_info = MsgInfo(from_addr, tuple(to_addrs), msg_fp, queue_date, last=last, retries=retries,
+        failure_reason=failure_reason)
     return msg_info
 
 
@@ -69,23 +90,26 @@ def dt_now():
 
 
 class _MsgInfo(NamedTuple):
-    from_addr  : str
-    to_addrs   : Sequence
-    msg_fp     : BinaryIO
-    queue_date : Optional[DateTime]
-    last       : Optional[DateTime]
-    retries    : int = 0
+    from_addr      : str
+    to_addrs       : Sequence
+    msg_fp         : BinaryIO
+    queue_date     : Optional[DateTime]
+    last           : Optional[DateTime]
+    retries        : int = 0
+    failure_reason : Optional[str] = None
 
 
 class MsgInfo(_MsgInfo):
-    def __new__(cls, from_addr, to_addrs, msg_fp, queue_date=None, last=None, retries=None):
+    def __new__(cls, from_addr, to_addrs, msg_fp, queue_date=None, last=None, retries=None,
+                failure_reason=None):
         self = _MsgInfo.__new__(cls,
-            from_addr  = from_addr,
-            to_addrs   = to_addrs,
-            msg_fp     = msg_fp,
-            queue_date = queue_date or DateTime.now(tz=LocalTZ),
-            last       = last,
-            retries    = retries or 0,
+            from_addr      = from_addr,
+            to_addrs       = to_addrs,
+            msg_fp         = msg_fp,
+            queue_date     = queue_date or DateTime.now(tz=LocalTZ),
+            last           = last,
+            retries        = retries or 0,
+            failure_reason = failure_reason,
         )
         return self
 
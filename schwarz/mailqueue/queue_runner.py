@@ -2,49 +2,214 @@
 # SPDX-License-Identifier: MIT
 
 import email.utils
+import functools
 import logging
 import os
 import queue
+import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from mailbox import Maildir, _sync_close
 
-from .app_helpers import init_app, init_smtp_mailer
+from .app_helpers import (
+    init_app,
+    init_retry_policy,
+    init_shared_circuit_breaker,
+    init_smtp_mailer,
+)
+from .circuit_breaker import CircuitBreaker, CircuitBreakerTransport
 from .compat import IS_WINDOWS
-from .maildir_utils import create_maildir_directories, find_messages, move_message
+from .concurrency import AIMDConcurrency
+from .leases import (
+    claim_message,
+    move_claimed_message,
+    recover_expired_leases,
+    remove_claimed_message,
+    renew_lease,
+)
+from .maildir_utils import (
+    check_durability,
+    create_maildir_directories,
+    find_claim_folders,
+    find_messages,
+    find_queue_dir,
+    move_message,
+    publish_anonymous_file,
+    replace_file,
+    sync_directories,
+    write_buffers,
+)
 from .message_handler import BaseMsg, MessageHandler
 from .message_utils import SendResult, dt_now, msg_as_bytes, parse_message_envelope
 from .plugins import registry
+from .runner_group import RunnerGroup
+from .sharding import message_key, parse_queue_dirs, queue_dir_for_message, queue_shards
 
 
 __all__ = [
     'enqueue_message',
+    'enqueue_messages',
     'send_all_queued_messages',
     'serialize_message_with_queue_data',
+    'serialize_message_buffers',
     'MaildirBackend',
 ]
 
+# "enqueue_messages()": max. number of open tmp files waiting for fsync
+MAX_UNSYNCED_FILES = 256
+
+# Maildir sub-folder for messages which will not be delivered anymore
+# (see "RetryPolicy").
+FAILED_FOLDER = 'failed'
+
 def enqueue_message(msg, queue_path, sender, recipients, return_msg=False,
-                    in_progress=False, **queue_args):
-    msg_bytes = serialize_message_with_queue_data(
+                    in_progress=False, durability='file', **queue_args):
+    """
+    Store a message in the queue. "queue_path" might also be a list of queue
+    dirs (or "QueueShards") to distribute messages over several queue dirs.
+    """
+    msg_buffers = serialize_message_buffers(
         msg,
         sender=sender,
         recipients=recipients,
         **queue_args
     )
+    queue_path = queue_dir_for_message(queue_path, msg_buffers[1])
     create_maildir_directories(queue_path)
 
     mailbox = Maildir(queue_path)
     sub_dir = 'cur' if in_progress else 'new'
     msg = inject_message_into_maildir(
-        msg_bytes,
+        msg_buffers,
         mailbox,
         sub_dir=sub_dir,
         return_msg=return_msg,
+        durability=durability,
     )
     return msg
 
+def enqueue_messages(messages, queue_path, in_progress=False, durability='file'):
+    """
+    Store many messages (iterable of "(msg, sender, recipients)") in the
+    queue. Returns the paths of the queued messages.
+
+    All files are written first and fsync'ed afterwards (one by one, so
+    each call reports I/O errors for its own file). The file system can
+    group the resulting journal commits instead of waiting for a commit
+    after every single message. The messages are moved to "new" afterwards
+    (so "mq-run" never sees incomplete messages) and the "new" directory is
+    fsync'ed once (unless durability is "none").
+    No message is queued if an exception occurs before that step.
+
+    "queue_path" might also be a list of queue dirs (or "QueueShards"). In
+    that case each queue dir is handled separately (as described above).
+    """
+    staged_messages = _write_messages(messages, queue_path, durability)
+    sub_dir = 'cur' if in_progress else 'new'
+    return staged_messages.publish(sub_dir)
+
+def _write_messages(messages, queue_path, durability):
+    """
+    Write (and fsync) all messages to the "tmp" folder(s) of the queue.
+    Nothing is left behind if an exception occurs. Use ".publish()" of the
+    returned "_StagedMessages" to move the messages into the queue.
+    """
+    check_durability(durability)
+    shards = queue_shards(queue_path)
+    batches = {}
+    if shards is None:
+        batches[queue_path] = _EnqueueBatch(queue_path, durability)
+    # (queue dir, index in batch) for each message (in the original order)
+    msg_locations = []
+    try:
+        for msg, sender, recipients in messages:
+            msg_buffers = serialize_message_buffers(msg, sender=sender, recipients=recipients)
+            if shards is None:
+                queue_dir = queue_path
+            else:
+                queue_dir = shards.shard_for_message(message_key(msg_buffers[1]))
+            batch = batches.get(queue_dir)
+            if batch is None:
+                batch = batches[queue_dir] = _EnqueueBatch(queue_dir, durability)
+            msg_idx = batch.add(msg_buffers)
+            msg_locations.append((queue_dir, msg_idx))
+        for batch in batches.values():
+            batch.sync()
+    except:
+        for batch in batches.values():
+            batch.discard()
+        raise
+    return _StagedMessages(batches, msg_locations)
+
+
+class _StagedMessages(object):
+    def __init__(self, batches, msg_locations):
+        self.batches = batches
+        self.msg_locations = msg_locations
+
+    def publish(self, sub_dir):
+        "Move all messages to \"sub_dir\" and return their paths (in the original order)."
+        paths_by_dir = {}
+        for queue_dir, batch in self.batches.items():
+            paths_by_dir[queue_dir] = batch.publish(sub_dir)
+        return [paths_by_dir[queue_dir][msg_idx] for queue_dir, msg_idx in self.msg_locations]
+
+
+class _EnqueueBatch(object):
+    "Messages of \"enqueue_messages()\" which are stored in a single queue dir."
+    def __init__(self, queue_dir, durability):
+        create_maildir_directories(queue_dir)
+        self.queue_dir = queue_dir
+        self.mailbox = Maildir(queue_dir)
+        self.needs_sync = (durability != 'none')
+        self.tmp_paths = []
+        # written but not fsync'ed yet (still open)
+        self._unsynced_files = []
+
+    def add(self, msg_buffers):
+        "Write the message to \"tmp\" and return its index in the batch."
+        tmp_fp = _write_tmp_file(self.mailbox, msg_buffers, sync=False, close=not self.needs_sync)
+        self.tmp_paths.append(tmp_fp.name)
+        if self.needs_sync:
+            self._unsynced_files.append(tmp_fp)
+            if len(self._unsynced_files) >= MAX_UNSYNCED_FILES:
+                self.sync()
+        return len(self.tmp_paths) - 1
 
-def inject_message_into_maildir(msg_bytes, maildir, sub_dir='new', return_msg=False):
+    def sync(self):
+        unsynced_files = self._unsynced_files
+        self._unsynced_files = []
+        try:
+            for tmp_fp in unsynced_files:
+                _sync_close(tmp_fp)
+        finally:
+            for tmp_fp in unsynced_files:
+                tmp_fp.close()
+
+    def discard(self):
+        for tmp_fp in self._unsynced_files:
+            tmp_fp.close()
+        self._unsynced_files = []
+        for tmp_path in self.tmp_paths:
+            os.remove(tmp_path)
+        self.tmp_paths = []
+
+    def publish(self, sub_dir):
+        "Move all messages to \"sub_dir\" and return their paths."
+        msg_paths = []
+        for tmp_path in self.tmp_paths:
+            msg_paths.append(move_message(tmp_path, target_folder=sub_dir, open_file=False))
+        if msg_paths and self.needs_sync:
+            sync_directories(
+                os.path.join(self.queue_dir, sub_dir),
+                os.path.join(self.queue_dir, 'tmp'),
+            )
+        return msg_paths
+
+
+def _write_tmp_file(maildir, msg_buffers, sync=True, close=True):
     tmp_fp = maildir._create_tmp()
     try:
         # Unfortunately, Python's `mailbox.Maildir._dump_message()` provides a
@@ -53,21 +218,63 @@ def inject_message_into_maildir(msg_bytes, maildir, sub_dir='new', return_msg=Fa
         # `\r\r\n` on Windows). This happens even when passing a `bytes` value.
         # Thankfully, that function does not do anything special so we can just
         # write to the tmp_fp directly.
-        tmp_fp.write(msg_bytes)
+        write_buffers(tmp_fp, _as_buffers(msg_buffers))
     except:
         tmp_fp.close()
         os.remove(tmp_fp.name)
         raise
-    _sync_close(tmp_fp)
+    if sync:
+        _sync_close(tmp_fp)
+    elif close:
+        tmp_fp.close()
+    return tmp_fp
+
+
+def inject_message_into_maildir(msg_bytes, maildir, sub_dir='new', return_msg=False,
+                                durability='file'):
+    # "msg_bytes" might also be a sequence of buffers (header, body) to avoid
+    # concatenating large messages in memory.
+    msg_buffers = _as_buffers(msg_bytes)
+    locked_file = publish_anonymous_file(maildir._path, sub_dir, msg_buffers, durability)
+    if locked_file is not None:
+        if return_msg:
+            return MaildirBackedMsg(locked_file.name, fp=locked_file, durability=durability)
+        locked_file.close()
+        return locked_file.name
+
+    tmp_fp = _write_tmp_file(maildir, msg_buffers, sync=(durability != 'none'))
     open_file = bool(return_msg)
-    target_ = move_message(tmp_fp, target_folder=sub_dir, open_file=open_file)
+    target_ = move_message(tmp_fp, target_folder=sub_dir, open_file=open_file,
+        durability=durability)
     if not return_msg:
         return target_
-    return MaildirBackedMsg(target_.name, fp=target_)
+    return MaildirBackedMsg(target_.name, fp=target_, durability=durability)
+
+
+def _as_buffers(msg_bytes):
+    if isinstance(msg_bytes, (bytes, bytearray, memoryview)):
+        return (msg_bytes,)
+    return msg_bytes
 
 
 def serialize_message_with_queue_data(msg, sender, recipients, queue_date=None,
-                                      last=None, retries=None):
+                                      last=None, retries=None, failure_reason=None):
+    return b''.join(serialize_message_buffers(msg, sender, recipients,
+        queue_date=queue_date, last=last, retries=retries, failure_reason=failure_reason))
+
+def serialize_message_buffers(msg, sender, recipients, queue_date=None,
+                              last=None, retries=None, failure_reason=None):
+    """
+    Return the queue metadata block and the message as separate buffers
+    ("(meta_bytes, msg_bytes)") so a (large) message can be written to the
+    queue without copying it.
+    """
+    meta_bytes = serialize_queue_metadata(sender, recipients,
+        queue_date=queue_date, last=last, retries=retries, failure_reason=failure_reason)
+    return (meta_bytes, msg_as_bytes(msg))
+
+def serialize_queue_metadata(sender, recipients, queue_date=None, last=None, retries=None,
+                             failure_reason=None):
     sender_bytes = _email_address_as_bytes(sender)
     b_recipients = [_email_address_as_bytes(recipient) for recipient in recipients]
     queue_lines = [
@@ -81,12 +288,15 @@ def serialize_message_with_queue_data(msg, sender, recipients, queue_date=None,
     if retries:
         retries_b = b'X-Retries: ' + str(retries).encode('ASCII')
         queue_lines.append(retries_b)
+    if failure_reason:
+        # e.g. a SMTP error message: must fit into a single header line
+        reason_str = ' '.join(failure_reason.split())
+        queue_lines.append(b'X-Failure-Reason: ' + reason_str.encode('ASCII', 'backslashreplace'))
     queue_lines.extend([
         b'X-Queue-Meta-End: end',
-        msg_as_bytes(msg)
+        b'',
     ])
-    queue_bytes = b'\r\n'.join(queue_lines)
-    return queue_bytes
+    return b'\r\n'.join(queue_lines)
 
 def _email_address_as_bytes(address):
     if isinstance(address, bytes):
@@ -100,12 +310,15 @@ def _dt_to_str(dt):
 
 
 class MaildirBackend(object):
-    def __init__(self, queue_path, log=None):
-        self.queue_path = queue_path
+    def __init__(self, queue_path, log=None, durability='file'):
+        # several queue dirs: messages are distributed by "QueueShards"
+        self.queue_path = queue_shards(queue_path) or queue_path
         self.log = log or logging.getLogger('mailqueue.queue_log')
+        self.durability = check_durability(durability)
 
     def send(self, from_addr, to_addrs, msg_bytes):
-        msg = enqueue_message(msg_bytes, self.queue_path, from_addr, to_addrs, return_msg=True)
+        msg = enqueue_message(msg_bytes, self.queue_path, from_addr, to_addrs, return_msg=True,
+            durability=self.durability)
         log_msg = '%s => %s' % (from_addr, ', '.join(to_addrs))
         if msg.msg_id:
             log_msg += ' <%s>' % msg.msg_id
@@ -114,13 +327,29 @@ class MaildirBackend(object):
             msg.fp.close()
         return SendResult(True, queued=True, transport='maildir')
 
+    def store_failed_message(self, from_addr, to_addrs, msg_bytes, failure_reason):
+        "Store a message which will not be delivered in the \"failed\" folder."
+        queue_dir = queue_dir_for_message(self.queue_path, msg_bytes)
+        failed_path = create_failed_folder(queue_dir)
+        msg_path = enqueue_message(msg_bytes, failed_path, from_addr, to_addrs,
+            durability=self.durability, failure_reason=failure_reason)
+        self.log.warning('%s => %s: stored in "%s" (%s)',
+            from_addr, ', '.join(to_addrs), FAILED_FOLDER, failure_reason)
+        return msg_path
+
 
 
 class MaildirBackedMsg(BaseMsg):
-    def __init__(self, file_path, fp=None):
+    is_queued = True
+
+    def __init__(self, file_path, fp=None, durability='file', claim_folder='cur'):
         super(MaildirBackedMsg, self).__init__()
         self.file_path = file_path
         self.fp = fp
+        self.durability = durability
+        # messages are moved to this folder during delivery
+        self.claim_folder = claim_folder
+        self.failure_reason = None
         self._msg = None
 
     def start_delivery(self):
@@ -135,25 +364,50 @@ class MaildirBackedMsg(BaseMsg):
             self._delete_message(self.fp)
             return
 
+        self._rewrite_queue_data()
+        self._move_message_back_to_new()
+
+    def delivery_abandoned(self, reason):
+        """
+        Move the message to the "failed" folder. The message file is moved
+        as it is (the reason is logged by the "MessageHandler").
+        """
+        self.failure_reason = reason
+        create_failed_folder(find_queue_dir(self.fp.name))
+        self._move_message(os.path.join(FAILED_FOLDER, 'new'))
+
+    def _rewrite_queue_data(self):
         msg_bytes = self.msg_bytes
-        queue_bytes = serialize_message_with_queue_data(
+        msg_buffers = serialize_message_buffers(
             msg_bytes,
             self.from_addr,
             self.to_addrs,
-            queue_date = self.queue_date,
-            last       = self.last_delivery_attempt,
-            retries    = self.retries,
+            queue_date     = self.queue_date,
+            last           = self.last_delivery_attempt,
+            retries        = self.retries,
+            failure_reason = self.failure_reason,
         )
-        self.fp.seek(0)
-        self.fp.write(queue_bytes)
-        self.fp.truncate()
-        self.fp.seek(0)
+        self.fp = replace_file(self.fp, msg_buffers, durability=self.durability)
         self._msg = None
-        self._move_message_back_to_new()
 
     def delivery_successful(self):
         self._remove_message(self.fp)
 
+    def release(self):
+        "Move a claimed message back to \"new\" without a delivery attempt."
+        self._move_message_back_to_new()
+
+    def renew_lease(self):
+        "Update the modification time so the claim does not expire."
+        fp = self.fp
+        if fp is None:
+            return
+        try:
+            os.utime(fp.name)
+        except OSError:
+            # message was delivered/moved in the meantime
+            pass
+
     @property
     def msg(self):
         if self._msg is None:
@@ -178,10 +432,6 @@ class MaildirBackedMsg(BaseMsg):
     def from_addr(self):
         return self.msg.from_addr
 
-    @property
-    def to_addrs(self):
-        return self.msg.to_addrs
-
     @property
     def msg_bytes(self):
         return self.msg.msg_bytes
@@ -216,18 +466,24 @@ class MaildirBackedMsg(BaseMsg):
 
     # --- internal helpers ----------------------------------------------------
     def _mark_message_as_in_progress(self):
-        return move_message(self.fp or self.file_path, target_folder='cur')
+        return move_message(self.fp or self.file_path, target_folder=self.claim_folder,
+            durability=self.durability)
 
     def _delete_message(self, fp):
         if IS_WINDOWS:
             fp.close()
         file_path = fp if (not hasattr(fp, 'name')) else fp.name
         os.unlink(file_path)
+        self._sync_removal(file_path)
 
     def _move_message_back_to_new(self):
+        self._move_message('new')
+
+    def _move_message(self, target_folder):
         if IS_WINDOWS:
             self.fp.close()
-        move_message(self.fp, target_folder='new', open_file=False)
+        move_message(self.fp, target_folder=target_folder, open_file=False,
+            durability=self.durability)
         if not IS_WINDOWS:
             # this ensures all locks will be released and we don't keep open files
             # around for no reason.
@@ -245,13 +501,29 @@ class MaildirBackedMsg(BaseMsg):
             os.unlink(file_path)
         except OSError:
             pass
+        else:
+            self._sync_removal(file_path)
         if not IS_WINDOWS:
             # This will also release the lock
             fp.close()
 
+    def _sync_removal(self, file_path):
+        # Otherwise a delivered message might be sent again after a crash.
+        if self.durability == 'full':
+            sync_directories(os.path.dirname(file_path))
+
+
 
+# A message in "cur" is locked by the process which delivers it (see
+# "move_message()") so a message which can be locked was abandoned (e.g.
+# mq-run crashed) and can be moved back to "new" immediately.
+# Windows does not lock messages. Instead the claim is a lease (modification
+# time of the message file) which the delivering process renews every
+# "lease_timeout / 3" seconds ("LeaseRenewer").
+DEFAULT_LEASE_TIMEOUT = 5 * 60
 
-def is_stale_msg(msg_path):
+def is_stale_msg(msg_path, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+    "Return True if the lease on the message (in \"cur\") expired."
     stat = os.stat(msg_path)
     # Unix:
     #  - mtime: last modification of file contents
@@ -260,16 +532,239 @@ def is_stale_msg(msg_path):
     #  - ctime: file creation
     timestamp = max([stat.st_mtime, stat.st_ctime])
     now = time.time()
-    STALE_TIMEOUT_s = 30 * 60
-    is_stale = (timestamp + STALE_TIMEOUT_s < now)
+    is_stale = (timestamp + lease_timeout < now)
     return is_stale
 
-def unblock_stale_messages(queue_basedir, log):
-    for msg_path in find_messages(queue_basedir, queue_folder='cur', log=log):
-        if is_stale_msg(msg_path):
+def unblock_stale_messages(queue_basedir, log, durability='file',
+                           lease_timeout=DEFAULT_LEASE_TIMEOUT):
+    claim_folders = find_claim_folders(queue_basedir)
+    msg_paths = list(find_messages(queue_basedir, queue_folder='cur', log=log))
+    for claim_folder in claim_folders:
+        folder = os.path.relpath(claim_folder, queue_basedir)
+        msg_paths.extend(find_messages(queue_basedir, queue_folder=folder, log=log))
+    for msg_path in msg_paths:
+        if IS_WINDOWS and not is_stale_msg(msg_path, lease_timeout=lease_timeout):
+            continue
+        # "move_message()" probes the lock: messages which are being
+        # delivered are never moved.
+        target_path = move_message(msg_path, target_folder='new', open_file=False,
+            durability=durability)
+        if target_path is not None:
             filename = os.path.basename(msg_path)
-            log.warning('stale message detected, moving back to "new": %s', filename)
-            move_message(msg_path, target_folder='new', open_file=False)
+            log.warning('stale message detected, moved back to "new": %s', filename)
+    for claim_folder in claim_folders:
+        # A running worker might have just created its (empty) claim folder
+        # and is about to move messages into it.
+        if not _is_active_worker(os.path.basename(claim_folder)):
+            _remove_claim_folder(claim_folder)
+
+
+class LeaseRenewer(object):
+    "Renews the leases of messages while they are being delivered."
+    def __init__(self, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        self.interval = lease_timeout / 3
+        self._messages = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._renew_periodically, daemon=True,
+            name='mailqueue-lease-renewer')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @contextmanager
+    def renewing(self, msg):
+        with self._lock:
+            self._messages.add(msg)
+        try:
+            yield msg
+        finally:
+            with self._lock:
+                self._messages.discard(msg)
+
+    def renew_all(self):
+        with self._lock:
+            messages = list(self._messages)
+        for msg in messages:
+            msg.renew_lease()
+
+    def _renew_periodically(self):
+        while not self._stopped.wait(self.interval):
+            self.renew_all()
+
+
+class LeasedMsg(MaildirBackedMsg):
+    """
+    Message which is claimed with a lease instead of a file lock so several
+    hosts can share a queue (e.g. on NFS), see "leases.py".
+    The message file is not kept open during delivery.
+    """
+    def __init__(self, file_path, durability='file', lease_timeout=DEFAULT_LEASE_TIMEOUT,
+                 log=None):
+        super(LeasedMsg, self).__init__(file_path, durability=durability)
+        self.lease_timeout = lease_timeout
+        self.log = log or logging.getLogger('mailqueue.sending')
+        self.claimed_path = None
+
+    def start_delivery(self):
+        claimed_path = claim_message(self.file_path, self.lease_timeout)
+        if claimed_path is None:
+            return None
+        self._sync_move(self.file_path, claimed_path)
+        self.file_path = claimed_path
+        self.claimed_path = claimed_path
+        return True
+
+    def delivery_failed(self, discard=False):
+        if discard:
+            self._remove_claimed_message()
+            return
+        if self._rewrite_claimed_message():
+            self._move_message_back_to_new()
+
+    def delivery_abandoned(self, reason):
+        self.failure_reason = reason
+        create_failed_folder(find_queue_dir(self.claimed_path))
+        self._move_message(os.path.join(FAILED_FOLDER, 'new'))
+
+    def delivery_successful(self):
+        self._remove_claimed_message()
+
+    def renew_lease(self):
+        # called by "LeaseRenewer" (in a different thread)
+        claimed_path = self.claimed_path
+        if claimed_path is None:
+            return
+        if not renew_lease(claimed_path, self.lease_timeout):
+            self.log.warning('unable to renew lease, message was taken over by another runner: %s',
+                os.path.basename(claimed_path))
+
+    # --- internal helpers ----------------------------------------------------
+    def _rewrite_claimed_message(self):
+        # Move the message to "tmp" before modifying it: this fails if the
+        # lease expired and another runner took over the message.
+        tmp_path = move_claimed_message(self.claimed_path, 'tmp')
+        if tmp_path is None:
+            self._claim_lost()
+            return False
+        self.file_path = tmp_path
+        self.claimed_path = tmp_path
+        with open(tmp_path, 'rb+') as fp:
+            self.fp = fp
+            try:
+                self._rewrite_queue_data()
+            finally:
+                # "_rewrite_queue_data()" replaced the file
+                self.fp.close()
+                self.fp = None
+        return True
+
+    def _move_message(self, target_folder):
+        # releases the claim (unless the target folder is "tmp")
+        target_path = move_claimed_message(self.claimed_path, target_folder)
+        if target_path is None:
+            self._claim_lost()
+            return
+        self._sync_move(self.claimed_path, target_path)
+        self.file_path = target_path
+        self.claimed_path = None
+
+    def _remove_claimed_message(self):
+        if not remove_claimed_message(self.claimed_path):
+            self._claim_lost()
+            return
+        self._sync_removal(self.claimed_path)
+        self.claimed_path = None
+
+    def _claim_lost(self):
+        self.log.warning('lease expired, message was taken over by another runner: %s',
+            os.path.basename(self.claimed_path))
+        self.claimed_path = None
+
+    def _sync_move(self, source_path, target_path):
+        if self.durability == 'full':
+            sync_directories(os.path.dirname(target_path), os.path.dirname(source_path))
+
+
+def create_failed_folder(queue_dir):
+    failed_path = os.path.join(queue_dir, FAILED_FOLDER)
+    if not os.path.isdir(os.path.join(failed_path, 'new')):
+        create_maildir_directories(failed_path)
+    return failed_path
+
+
+def claim_messages(queue_basedir, message_paths, worker_id, durability='file'):
+    """
+    Move the messages to the claim folder of the worker ("cur/<worker_id>")
+    so other workers/processes do not try to deliver them. Returns the
+    claimed messages (as "MaildirBackedMsg", locked until delivered or
+    released). Messages claimed by someone else are skipped.
+    """
+    claim_folder = os.path.join('cur', worker_id)
+    claim_path = os.path.join(queue_basedir, claim_folder)
+    os.makedirs(claim_path, 0o700, exist_ok=True)
+    claimed = []
+    for msg_path in message_paths:
+        # A claim is never lost in a crash (the message is either in "new"
+        # or in the claim folder) so with "full" durability the directories
+        # can be synced once for the whole batch.
+        move_durability = ('file' if durability == 'full' else durability)
+        fp = move_message(msg_path, target_folder=claim_folder, durability=move_durability)
+        if (fp is None) and not os.path.isdir(claim_path):
+            # claim folder was removed by another runner (crashed worker)
+            os.makedirs(claim_path, 0o700, exist_ok=True)
+            fp = move_message(msg_path, target_folder=claim_folder, durability=move_durability)
+        if fp is None:
+            continue
+        msg = MaildirBackedMsg(fp.name, fp=fp, durability=durability, claim_folder=claim_folder)
+        claimed.append(msg)
+    if claimed and (durability == 'full'):
+        sync_directories(claim_path, os.path.join(queue_basedir, 'new'))
+    return claimed
+
+def release_messages(messages):
+    "Move claimed (but undelivered) messages back to \"new\"."
+    for msg in messages:
+        msg.release()
+
+def _remove_claim_folder(claim_path):
+    try:
+        os.rmdir(claim_path)
+    except OSError:
+        # not empty (messages still claimed) or removed by another process
+        pass
+
+def _worker_id(worker_nr):
+    return '%s.%d.%d' % (_worker_hostname(), os.getpid(), worker_nr)
+
+def _worker_hostname():
+    return socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+
+def _is_active_worker(worker_id):
+    "Return True if the worker (see \"_worker_id()\") is a running process on this host."
+    parts = worker_id.rsplit('.', 2)
+    if (len(parts) != 3) or (not parts[1].isdigit()):
+        return False
+    hostname, pid_str, _ = parts
+    if IS_WINDOWS or (hostname != _worker_hostname()):
+        # "os.kill()" terminates the process on Windows, "claim_messages()"
+        # recreates the claim folder if necessary.
+        return False
+    try:
+        os.kill(int(pid_str), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process of another user
+        return True
+    return True
 
 def assemble_queue_with_new_messages(queue_basedir, log):
     message_queue = queue.Queue()
@@ -277,36 +772,285 @@ def assemble_queue_with_new_messages(queue_basedir, log):
         message_queue.put(path)
     return message_queue
 
-def send_all_queued_messages(queue_dir, mailer=None, plugins=None, mh=None):
+def send_all_queued_messages(queue_dir, mailer=None, plugins=None, mh=None, concurrency=None,
+                             circuit_breaker=None, durability='file', claim_batch_size=1,
+                             lease_timeout=DEFAULT_LEASE_TIMEOUT, runner_group=None,
+                             claim_mode='lock', retry_policy=None):
+    """
+    Try to deliver all messages in the "new" folder of the queue.
+
+    With "claim_batch_size" > 1 each worker claims that many messages at
+    once (moving them to its own folder "cur/<worker_id>") and delivers
+    them one after another. Messages which were not delivered when the run
+    ends are moved back to "new".
+
+    If a "runner_group" is given, only messages owned by this runner (see
+    "RunnerGroup.owns()") are delivered. Other messages are delivered at the
+    end of the run if their runner stopped in the meantime.
+
+    "claim_mode" selects how messages are claimed:
+    - lock: file locks (flock), only safe if all runners use the same host
+    - lease: lease files and "rename()" (see "leases.py") so runners on
+      several hosts can share a queue on network storage. Messages are
+      always claimed one by one ("claim_batch_size" is ignored).
+
+    Messages are moved to the "failed" folder if the "retry_policy" (see
+    "RetryPolicy", only used if no "mh" is given) gives up their delivery.
+
+    Returns False if the run was aborted because the circuit breaker opened
+    (i.e. the SMTP server was unreachable), True otherwise.
+    """
     assert (mailer is None) ^ (mh is None)
     log = logging.getLogger('mailqueue.sending')
-    unblock_stale_messages(queue_dir, log)
+    check_durability(durability)
+    if claim_mode not in CLAIM_MODES:
+        raise ValueError('invalid claim mode %r (expected one of %s)' % (claim_mode, ', '.join(CLAIM_MODES)))  # noqa: E501 (line too long)
+    if claim_mode == 'lease':
+        recover_expired_leases(queue_dir, log, lease_timeout=lease_timeout)
+    else:
+        unblock_stale_messages(queue_dir, log, durability=durability, lease_timeout=lease_timeout)
     message_queue = assemble_queue_with_new_messages(queue_dir, log)
     if message_queue.qsize() == 0:
         log.info('no unsent messages in queue dir')
-        return
+        return True
     log.debug('%d unsent messages in queue dir', message_queue.qsize())
     if mh is None:
-        mh = MessageHandler([mailer], plugins=plugins)
-    while True:
-        try:
-            message_path = message_queue.get(block=False)
-        except queue.Empty:
-            break
-        else:
-            msg = MaildirBackedMsg(message_path)
-            mh.send_message(msg)
+        mh = MessageHandler([mailer], plugins=plugins, retry_policy=retry_policy)
+    if circuit_breaker is None:
+        circuit_breaker = CircuitBreaker(failure_threshold=0)
+    if claim_mode == 'lease':
+        msg_factory = functools.partial(LeasedMsg, durability=durability,
+            lease_timeout=lease_timeout, log=log)
+        claim_batch_size = 1
+    else:
+        msg_factory = functools.partial(MaildirBackedMsg, durability=durability)
+    claims = _MessageClaims(queue_dir, message_queue, claim_batch_size, durability,
+        runner_group=runner_group, msg_factory=msg_factory)
+    lease_renewer = LeaseRenewer(lease_timeout).start()
+    try:
+        while True:
+            if concurrency is not None:
+                _send_messages_concurrently(mh, claims, concurrency, circuit_breaker, lease_renewer)
+            else:
+                _deliver_messages(mh, claims.for_worker(0), circuit_breaker, lease_renewer)
+            if circuit_breaker.is_open or not claims.requeue_skipped_messages():
+                break
+    finally:
+        lease_renewer.stop()
+
+    if circuit_breaker.is_open:
+        log.error('relay unavailable (%d consecutive connection failures), %d messages left in queue',  # noqa: E501 (line too long)
+            circuit_breaker.consecutive_failures, message_queue.qsize())
+        return False
+    return True
+
+def _deliver_messages(mh, worker_claims, circuit_breaker, lease_renewer, concurrency=None):
+    with worker_claims:
+        while not circuit_breaker.is_open:
+            msg = worker_claims.next_message()
+            if msg is None:
+                return
+            if concurrency is None:
+                with lease_renewer.renewing(msg):
+                    send_result = mh.send_message(msg)
+                circuit_breaker.record(send_result)
+                continue
+            with concurrency.slot() as started, lease_renewer.renewing(msg):
+                send_result = mh.send_message(msg)
+                circuit_breaker.record(send_result)
+                if send_result is not None:
+                    concurrency.record(send_result, started)
+
+def _send_messages_concurrently(mh, claims, concurrency, circuit_breaker, lease_renewer):
+    # The transports must be thread-safe. "SMTPMailer" uses a new
+    # connection for each message or a thread-safe pool ("smtp_pool_size").
+    workers = []
+    for worker_nr in range(concurrency.max_limit):
+        worker_claims = claims.for_worker(worker_nr)
+        worker = threading.Thread(target=_deliver_messages, daemon=True,
+            args=(mh, worker_claims, circuit_breaker, lease_renewer, concurrency))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+
+class _MessageClaims(object):
+    "Hands out messages from the queue (claimed in batches if requested)."
+    def __init__(self, queue_dir, message_queue, batch_size, durability, runner_group=None,
+                 msg_factory=MaildirBackedMsg):
+        self.queue_dir = queue_dir
+        self.message_queue = message_queue
+        self.batch_size = max(int(batch_size), 1)
+        self.durability = durability
+        self.runner_group = runner_group
+        self.msg_factory = msg_factory
+        # messages owned by other runners (when this runner started)
+        self.skipped_paths = []
+        self._lock = threading.Lock()
+
+    def for_worker(self, worker_nr):
+        return _WorkerClaims(self, _worker_id(worker_nr))
+
+    def next_paths(self, nr_paths):
+        paths = []
+        while len(paths) < nr_paths:
+            try:
+                path = self.message_queue.get(block=False)
+            except queue.Empty:
+                break
+            if (self.runner_group is None) or self.runner_group.owns(path):
+                paths.append(path)
+            else:
+                with self._lock:
+                    self.skipped_paths.append(path)
+        return paths
+
+    def requeue_skipped_messages(self):
+        """
+        Add skipped messages to the queue again if this runner owns them
+        now (e.g. because another runner stopped). Returns True if messages
+        were added.
+        """
+        if not self.skipped_paths:
+            return False
+        self.runner_group.refresh()
+        skipped_paths = self.skipped_paths
+        self.skipped_paths = []
+        for path in skipped_paths:
+            if not self.runner_group.owns(path):
+                self.skipped_paths.append(path)
+            elif os.path.exists(path):
+                self.message_queue.put(path)
+        return (self.message_queue.qsize() > 0)
+
+
+class _WorkerClaims(object):
+    def __init__(self, claims, worker_id):
+        self.claims = claims
+        self.worker_id = worker_id
+        self.batch = []
+        self.has_claim_folder = False
+
+    def next_message(self):
+        claims = self.claims
+        if claims.batch_size == 1:
+            # claim message right before the delivery (no claim folder)
+            paths = claims.next_paths(1)
+            if not paths:
+                return None
+            return claims.msg_factory(paths[0])
+        while not self.batch:
+            paths = claims.next_paths(claims.batch_size)
+            if not paths:
+                return None
+            self.has_claim_folder = True
+            self.batch = claim_messages(claims.queue_dir, paths, self.worker_id,
+                durability=claims.durability)
+        return self.batch.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # return unfinished messages (e.g. circuit breaker opened)
+        release_messages(self.batch)
+        self.batch = []
+        if self.has_claim_folder:
+            _remove_claim_folder(os.path.join(self.claims.queue_dir, 'cur', self.worker_id))
 
 # --------------------------------------------
 
+CLAIM_MODES = ('lock', 'lease')
+
+# How "mq-run" handles other active runners for the same queue dir:
+# - share: messages are partitioned between all runners
+# - exit: only the runner which was started first delivers messages
+CONCURRENT_RUN_MODES = ('share', 'exit')
+
 def one_shot_queue_run(queue_dir, config_path=None, options=None, settings=None):
+    """
+    Deliver all queued messages. "queue_dir" might also contain several
+    queue dirs (shards, see "QueueShards"): each shard is processed by its
+    own group of workers.
+    """
     # ability to pass "settings" so callers can use a custom configuration
     # mechanism (including ability to inject preconfigured MessageHandler).
     assert (config_path is not None) ^ (settings is not None)
     settings = init_app(config_path, options=options, settings=settings)
+    queue_dirs = parse_queue_dirs(queue_dir)
     mh = (settings or {}).get('mh')
-    mailer = init_smtp_mailer(settings) if (not mh) else None
+    mailer = None
+    if not mh:
+        # Always try to deliver queued messages (even if the submission
+        # breaker is open) but share the results so a successful run
+        # closes the breaker for "mq-sendmail"/"mq-mail".
+        shared_breaker = init_shared_circuit_breaker(settings, queue_dirs)
+        mailer = CircuitBreakerTransport(init_smtp_mailer(settings), shared_breaker,
+            skip_when_open=False)
     plugin_loader = settings['plugin_loader']
-    send_all_queued_messages(queue_dir, mailer, plugins=registry, mh=mh)
+    max_concurrency = int(settings.get('delivery_concurrency', 1))
+    concurrency = AIMDConcurrency(max_concurrency) if (max_concurrency > 1) else None
+    failure_threshold = int(settings.get('circuit_breaker_threshold', 5))
+    circuit_breaker = CircuitBreaker(failure_threshold=failure_threshold)
+    concurrent_runs = settings.get('concurrent_runs', 'share')
+    if concurrent_runs not in CONCURRENT_RUN_MODES:
+        raise ValueError('invalid value for "concurrent_runs": %r (expected one of %s)' % (concurrent_runs, ', '.join(CONCURRENT_RUN_MODES)))  # noqa: E501 (line too long)
+    claim_mode = settings.get('claim_mode', 'lock')
+    if claim_mode not in CLAIM_MODES:
+        raise ValueError('invalid value for "claim_mode": %r (expected one of %s)' % (claim_mode, ', '.join(CLAIM_MODES)))  # noqa: E501 (line too long)
+    retry_policy = init_retry_policy(settings)
+    # All shards use the same SMTP server(s) so they share the concurrency
+    # limit and the circuit breaker.
+    run_shard = functools.partial(_run_queue_shard,
+        mailer          = mailer,
+        mh              = mh,
+        concurrency     = concurrency,
+        circuit_breaker = circuit_breaker,
+        settings        = settings,
+        concurrent_runs = concurrent_runs,
+        claim_mode      = claim_mode,
+        retry_policy    = retry_policy,
+    )
+    if len(queue_dirs) == 1:
+        was_completed = run_shard(queue_dirs[0])
+    else:
+        with ThreadPoolExecutor(max_workers=len(queue_dirs),
+                                thread_name_prefix='mailqueue-shard') as executor:
+            was_completed = all(list(executor.map(run_shard, queue_dirs)))
+    if concurrency is not None:
+        log = logging.getLogger('mailqueue.sending')
+        stats = concurrency.stats()
+        log.info('delivery concurrency: limit %d (min %d, max %d)',
+            stats['limit'], stats['min_limit'], stats['max_limit'])
     if plugin_loader is not None:
         plugin_loader.terminate_all_activated_plugins()
+    return was_completed
+
+def _run_queue_shard(queue_dir, mailer, mh, concurrency, circuit_breaker, settings,
+                     concurrent_runs, claim_mode, retry_policy):
+    # Runners on other hosts can not be detected via file locks so the
+    # runner group is only used in "lock" mode (an unjoined group owns all
+    # messages).
+    runner_group = RunnerGroup(queue_dir)
+    if claim_mode == 'lock':
+        runner_group.join()
+    try:
+        if (concurrent_runs == 'exit') and not runner_group.started_first():
+            log = logging.getLogger('mailqueue.sending')
+            log.info('another mq-run is active for queue dir "%s", exiting', queue_dir)
+            return True
+        return send_all_queued_messages(queue_dir, mailer,
+            plugins          = registry,
+            mh               = mh,
+            concurrency      = concurrency,
+            circuit_breaker  = circuit_breaker,
+            durability       = settings.get('queue_durability', 'file'),
+            claim_batch_size = int(settings.get('claim_batch_size', 1)),
+            lease_timeout    = float(settings.get('lease_timeout', DEFAULT_LEASE_TIMEOUT)),
+            runner_group     = runner_group if (claim_mode == 'lock') else None,
+            claim_mode       = claim_mode,
+            retry_policy     = retry_policy,
+        )
+    finally:
+        runner_group.leave()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import threading
+import time
+
+
+__all__ = ['TokenBucket']
+
+class TokenBucket(object):
+    """
+    Token bucket which refills with "rate" tokens per "period" seconds and
+    holds at most "capacity" tokens (default: "rate", i.e. one period worth
+    of tokens).
+
+    ".acquire(n)" never rejects a request. Instead it reserves the tokens
+    immediately and blocks the caller until enough tokens were refilled.
+    Requests for more than "capacity" tokens (e.g. a message with many
+    recipients) wait for a full bucket and leave the bucket in debt so the
+    following requests are delayed accordingly. Reserving tokens first keeps
+    the bucket fair when multiple threads share it.
+    """
+    def __init__(self, rate, period=1.0, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError('rate must be positive (got %r)' % rate)
+        self.rate = float(rate)
+        self.period = float(period)
+        self.capacity = float(capacity if (capacity is not None) else rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def acquire(self, n=1, max_wait=None):
+        """
+        Take n tokens from the bucket, returns the number of seconds waited.
+        Returns None (without taking any tokens) if the caller would have to
+        wait longer than "max_wait" seconds.
+        """
+        with self._lock:
+            self._refill()
+            missing_tokens = min(n, self.capacity) - self._tokens
+            wait_s = max(0, missing_tokens) * self.period / self.rate
+            if (max_wait is not None) and (wait_s > max_wait):
+                return None
+            self._tokens -= n
+        if wait_s > 0:
+            self._sleep(wait_s)
+        return wait_s
+
+    def release(self, n=1):
+        "Return n (unused) tokens which were taken by \".acquire()\"."
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + n)
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        refill = elapsed * self.rate / self.period
+        self._tokens = min(self.capacity, self._tokens + refill)
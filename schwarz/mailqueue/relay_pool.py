@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import logging
+import re
+import threading
+import time
+
+from .message_utils import SendResult
+
+
+__all__ = ['parse_relays', 'Relay', 'RelayPool']
+
+BALANCING_STRATEGIES = ('round-robin', 'least-outstanding')
+# Only failures to establish a usable connection count against the health
+# of a relay (and trigger failover). Replies to the message itself (sender,
+# recipient, data) come from a working relay and other relays would most
+# likely reply the same way (or deliver a duplicate after DATA). Failures
+# without phase are caused by the mailer itself (e.g. rate limits).
+RELAY_FAILURE_PHASES = ('connect', 'auth')
+
+class Relay(object):
+    def __init__(self, mailer, weight=1, name=None):
+        self.mailer = mailer
+        self.weight = _parse_weight(weight)
+        self.name = name or '%s:%s' % (mailer.hostname, mailer.port)
+        self.consecutive_failures = 0
+        self.unhealthy_until = None
+        self.outstanding = 0
+        # state for "smooth weighted round-robin" (as used by nginx)
+        self.current_weight = 0
+
+    def is_healthy(self, now):
+        return (self.unhealthy_until is None) or (self.unhealthy_until <= now)
+
+    def __repr__(self):
+        return '<Relay %s weight=%d>' % (self.name, self.weight)
+
+
+class RelayPool(object):
+    """
+    Transport which distributes messages across several SMTP relays.
+
+    Each relay is an independent mailer (with its own connections). A relay
+    is taken out of rotation for "retry_after" seconds after "max_failures"
+    consecutive failed deliveries. A failed delivery is retried with the
+    next healthy relay before giving up.
+
+    Only failures without a usable server reply (connect, TLS, auth) count
+    as relay failures. Refused senders/recipients or a rejected message are
+    returned to the caller directly.
+    """
+    def __init__(self, relays, balancing='round-robin', max_failures=3, retry_after=60,
+                 log=None, clock=time.monotonic):
+        if not relays:
+            raise ValueError('RelayPool requires at least one relay')
+        if balancing not in BALANCING_STRATEGIES:
+            raise ValueError('invalid balancing strategy %r (expected one of %s)' % (balancing, ', '.join(BALANCING_STRATEGIES)))  # noqa: E501 (line too long)
+        self.relays = list(relays)
+        self.balancing = balancing
+        self.max_failures = int(max_failures)
+        self.retry_after = float(retry_after)
+        self.log = log or logging.getLogger('mailqueue.smtp')
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @property
+    def supports_deadline(self):
+        return all(getattr(r.mailer, 'supports_deadline', False) for r in self.relays)
+
+    def send(self, fromaddr, toaddrs, message, deadline=None):
+        # no healthy relay is the same as a connection failure
+        send_result = SendResult(False, queued=False, transport='smtp', phase='connect')
+        expires_at = (time.monotonic() + deadline) if (deadline is not None) else None
+        tried_relays = set()
+        while True:
+            send_kwargs = {}
+            if expires_at is not None:
+                send_kwargs['deadline'] = expires_at - time.monotonic()
+                if send_kwargs['deadline'] <= 0:
+                    break
+            relay = self._acquire_relay(exclude=tried_relays)
+            if relay is None:
+                break
+            tried_relays.add(relay)
+            relay_failed = True
+            try:
+                send_result = relay.mailer.send(fromaddr, toaddrs, message, **send_kwargs)
+                relay_failed = _is_relay_failure(send_result)
+            finally:
+                self._release_relay(relay, failed=relay_failed)
+            if not relay_failed:
+                break
+        return send_result
+
+    def close(self):
+        "Close the connections of all relays (if the mailers keep them open)."
+        for relay in self.relays:
+            close = getattr(relay.mailer, 'close', None)
+            if close is not None:
+                close()
+
+    def healthy_relays(self):
+        now = self._clock()
+        return [relay for relay in self.relays if relay.is_healthy(now)]
+
+    # --- internal functionality ----------------------------------------------
+    def _acquire_relay(self, exclude=()):
+        with self._lock:
+            now = self._clock()
+            candidates = [r for r in self.relays if r.is_healthy(now) and (r not in exclude)]
+            if not candidates:
+                return None
+            if self.balancing == 'least-outstanding':
+                relay = min(candidates, key=lambda r: r.outstanding / r.weight)
+            else:
+                relay = self._next_weighted_relay(candidates)
+            relay.outstanding += 1
+            return relay
+
+    def _next_weighted_relay(self, candidates):
+        total_weight = 0
+        best_relay = None
+        for relay in candidates:
+            relay.current_weight += relay.weight
+            total_weight += relay.weight
+            if (best_relay is None) or (relay.current_weight > best_relay.current_weight):
+                best_relay = relay
+        best_relay.current_weight -= total_weight
+        return best_relay
+
+    def _release_relay(self, relay, failed):
+        with self._lock:
+            relay.outstanding -= 1
+            if not failed:
+                if relay.unhealthy_until is not None:
+                    self.log.info('relay %s is healthy again', relay.name)
+                relay.consecutive_failures = 0
+                relay.unhealthy_until = None
+                return
+            relay.consecutive_failures += 1
+            if relay.consecutive_failures >= self.max_failures:
+                relay.unhealthy_until = self._clock() + self.retry_after
+                self.log.warning('relay %s failed %d times in a row, taking it out of rotation for %ss',  # noqa: E501 (line too long)
+                    relay.name, relay.consecutive_failures, self.retry_after)
+
+
+def _is_relay_failure(send_result):
+    if send_result:
+        return False
+    return (getattr(send_result, 'phase', None) in RELAY_FAILURE_PHASES)
+
+def _parse_weight(weight):
+    weight = int(weight)
+    if weight < 1:
+        raise ValueError('invalid relay weight %r (must be 1 or greater)' % weight)
+    return weight
+
+
+_re_relay_separator = re.compile(r'[\s,]+')
+
+def parse_relays(relays_str):
+    """
+    Parse a relay specification like "mx1.example:587:3, mx2.example" into
+    a list of (hostname, port, weight) tuples. Port and weight are optional
+    (None/1 if not specified).
+    """
+    relays = []
+    for relay_str in _re_relay_separator.split(relays_str.strip()):
+        if not relay_str:
+            continue
+        parts = relay_str.split(':')
+        if len(parts) > 3:
+            raise ValueError('invalid relay %r (expected "host[:port[:weight]]")' % relay_str)
+        hostname = parts[0]
+        port = int(parts[1]) if (len(parts) > 1 and parts[1]) else None
+        weight = _parse_weight(parts[2]) if (len(parts) > 2) else 1
+        relays.append((hostname, port, weight))
+    return relays
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import os
+import socket
+import time
+import zlib
+
+from .compat import IS_WINDOWS
+from .maildir_utils import FileHandleLock, lock_file, unique_maildir_filename
+
+
+__all__ = ['RunnerGroup']
+
+RUNNERS_FOLDER = 'runners'
+
+class RunnerGroup(object):
+    """
+    Tracks all "mq-run" processes which are active for a queue directory.
+
+    Each runner holds a lock on its own file in "<queue_dir>/runners". Files
+    which are not locked belong to crashed runners and are removed.
+    The runner ids start with the start time so sorting the ids returns the
+    runners in the order they were started.
+
+    Messages are partitioned between all active runners by a hash of the
+    message filename (".owns()"). Runners which start/stop are noticed
+    after at most "refresh_interval" seconds.
+
+    Windows can not rename/remove locked files: each runner works alone.
+    """
+    def __init__(self, queue_dir, refresh_interval=1.0, clock=time.monotonic):
+        self.queue_dir = queue_dir
+        self.refresh_interval = refresh_interval
+        hostname = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+        self.runner_id = '%016x.%s.%d' % (int(time.time() * 1000000), hostname, os.getpid())
+        self._clock = clock
+        self._fp = None
+        self._lock = None
+        self._runners = (self.runner_id,)
+        self._refreshed_at = None
+
+    @property
+    def runners_path(self):
+        return os.path.join(self.queue_dir, RUNNERS_FOLDER)
+
+    def join(self):
+        if IS_WINDOWS or not os.path.isdir(self.queue_dir):
+            return self
+        os.makedirs(self.runners_path, 0o700, exist_ok=True)
+        # The file must be locked before it becomes visible. Otherwise
+        # another runner might consider it stale and remove it.
+        tmp_path = os.path.join(self.runners_path, '.' + unique_maildir_filename())
+        self._fp = open(tmp_path, 'wb')
+        self._lock = FileHandleLock(self._fp)
+        os.rename(tmp_path, os.path.join(self.runners_path, self.runner_id))
+        self.refresh()
+        return self
+
+    def leave(self):
+        if self._fp is None:
+            return
+        try:
+            os.unlink(os.path.join(self.runners_path, self.runner_id))
+        except OSError:
+            pass
+        self._lock.release()
+        self._fp.close()
+        self._fp = None
+
+    def __enter__(self):
+        return self.join()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.leave()
+
+    def active_runners(self):
+        "Return the ids of all active runners (sorted by start time)."
+        if self._fp is None:
+            return (self.runner_id,)
+        runner_ids = []
+        for runner_id in os.listdir(self.runners_path):
+            if runner_id.startswith('.'):
+                continue
+            if (runner_id == self.runner_id) or not self._remove_if_stale(runner_id):
+                runner_ids.append(runner_id)
+        return tuple(sorted(runner_ids))
+
+    def refresh(self):
+        self._runners = self.active_runners()
+        self._refreshed_at = self._clock()
+        return self._runners
+
+    def started_first(self):
+        "Return True if no other active runner was started before this one."
+        return (self.refresh()[0] == self.runner_id)
+
+    def owns(self, msg_path):
+        "Return True if this runner should deliver the message."
+        now = self._clock()
+        if (self._refreshed_at is None) or (now - self._refreshed_at >= self.refresh_interval):
+            self.refresh()
+        runners = self._runners
+        if len(runners) == 1:
+            return True
+        filename = os.path.basename(msg_path).encode('utf-8', 'surrogateescape')
+        runner_idx = zlib.crc32(filename) % len(runners)
+        return (runners[runner_idx] == self.runner_id)
+
+    def _remove_if_stale(self, runner_id):
+        runner_path = os.path.join(self.runners_path, runner_id)
+        locked_file = lock_file(runner_path, timeout=0)
+        if locked_file is None:
+            # locked by an active runner (or removed already)
+            return not os.path.exists(runner_path)
+        try:
+            os.unlink(runner_path)
+        except OSError:
+            pass
+        locked_file.close()
+        return True
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import bisect
+import functools
+import hashlib
+import os
+import random
+import re
+from email.parser import BytesHeaderParser
+
+from .maildir_utils import find_claim_folders, find_messages
+
+
+__all__ = [
+    'parse_queue_dirs',
+    'queue_dir_for_message',
+    'QueueShards',
+]
+
+def parse_queue_dirs(queue_path):
+    """
+    Return the queue directories in "queue_path" as a tuple: a single path,
+    a string with several paths (separated by commas or newlines, e.g. from
+    the config file), an iterable of paths or a "QueueShards" instance.
+    """
+    if isinstance(queue_path, QueueShards):
+        return queue_path.queue_dirs
+    if isinstance(queue_path, str):
+        queue_dirs = re.split(r'[,\n]', queue_path)
+    elif isinstance(queue_path, os.PathLike):
+        queue_dirs = [queue_path]
+    else:
+        queue_dirs = queue_path
+    unique_dirs = []
+    for queue_dir in queue_dirs:
+        queue_dir = os.fspath(queue_dir).strip()
+        if queue_dir and (queue_dir not in unique_dirs):
+            unique_dirs.append(queue_dir)
+    return tuple(unique_dirs)
+
+
+class QueueShards(object):
+    """
+    Distributes messages over several queue directories (e.g. on different
+    disks) by consistent hashing.
+
+    Each queue dir is placed "replicas" times on a hash ring. A message is
+    stored in the queue dir which follows the hash of its routing key on the
+    ring. Adding a queue dir only changes the target for about "1/n" of all
+    keys, the order of the queue dirs does not matter.
+
+    Messages are routed by their Message-ID (not by their recipients) so a
+    few recipients which get most of the messages do not overload a single
+    shard. Messages without a Message-ID are distributed uniformly.
+    """
+    def __init__(self, queue_dirs, replicas=100):
+        self.queue_dirs = parse_queue_dirs(queue_dirs)
+        if not self.queue_dirs:
+            raise ValueError('no queue directory given')
+        ring = []
+        for queue_dir in self.queue_dirs:
+            for replica in range(replicas):
+                point_key = ('%s#%d' % (os.path.normpath(queue_dir), replica)).encode('utf-8')
+                ring.append((_hash(point_key), queue_dir))
+        ring.sort()
+        self._ring_points = [point for point, _ in ring]
+        self._ring_dirs = [queue_dir for _, queue_dir in ring]
+
+    def __len__(self):
+        return len(self.queue_dirs)
+
+    def __eq__(self, other):
+        if not isinstance(other, QueueShards):
+            return NotImplemented
+        return (self.queue_dirs == other.queue_dirs)
+
+    def __hash__(self):
+        return hash(self.queue_dirs)
+
+    def __repr__(self):
+        return 'QueueShards(%r)' % (self.queue_dirs,)
+
+    def shard_for(self, key):
+        "Return the queue dir for the routing key (str/bytes)."
+        if len(self.queue_dirs) == 1:
+            return self.queue_dirs[0]
+        if isinstance(key, str):
+            key = key.encode('utf-8', 'surrogateescape')
+        idx = bisect.bisect(self._ring_points, _hash(key)) % len(self._ring_points)
+        return self._ring_dirs[idx]
+
+    def shard_for_message(self, msg_key=None):
+        """
+        Return the queue dir for a new message. "msg_key" is a stable key of
+        the message (e.g. the Message-ID). Without a key the queue dir is
+        chosen randomly.
+        """
+        if msg_key is None:
+            return random.choice(self.queue_dirs)
+        return self.shard_for(msg_key)
+
+    def find_messages(self, log, queue_folder='new'):
+        "Yield the paths of all messages in \"queue_folder\" of all shards."
+        for queue_dir in self.queue_dirs:
+            yield from find_messages(queue_dir, log=log, queue_folder=queue_folder)
+
+    def message_counts(self):
+        """
+        Return the number of messages per folder ("new": queued,
+        "cur": delivery in progress) summed up over all shards.
+        """
+        counts = {'new': 0, 'cur': 0}
+        for queue_dir in self.queue_dirs:
+            for folder, nr_messages in shard_message_counts(queue_dir).items():
+                counts[folder] += nr_messages
+        return counts
+
+
+def queue_shards(queue_path):
+    """
+    Return a "QueueShards" instance for "queue_path" or None if it is a
+    single queue dir (str/path). Unlike "parse_queue_dirs()" a string is
+    never split.
+    """
+    if isinstance(queue_path, QueueShards):
+        return queue_path
+    if isinstance(queue_path, (str, os.PathLike)):
+        return None
+    return _cached_shards(parse_queue_dirs(queue_path))
+
+def queue_dir_for_message(queue_path, msg_bytes):
+    "Return the queue dir where a new message is stored (see \"QueueShards\")."
+    shards = queue_shards(queue_path)
+    if shards is None:
+        return queue_path
+    return shards.shard_for_message(message_key(msg_bytes))
+
+def message_key(msg_bytes):
+    "Return the Message-ID of the (serialized) message or None."
+    # only parse the message header (the body might be large)
+    header_end = re.search(rb'\r?\n\r?\n', msg_bytes)
+    header_bytes = msg_bytes[:header_end.end()] if header_end else msg_bytes
+    msg_headers = BytesHeaderParser().parsebytes(header_bytes, headersonly=True)
+    msg_id = msg_headers['Message-ID']
+    if not msg_id:
+        return None
+    return str(msg_id).strip() or None
+
+@functools.lru_cache(maxsize=16)
+def _cached_shards(queue_dirs):
+    return QueueShards(queue_dirs)
+
+def shard_message_counts(queue_dir):
+    counts = {}
+    for folder in ('new', 'cur'):
+        folder_paths = [os.path.join(queue_dir, folder)]
+        if folder == 'cur':
+            folder_paths.extend(find_claim_folders(queue_dir))
+        counts[folder] = sum(_count_files(folder_path) for folder_path in folder_paths)
+    return counts
+
+def _count_files(folder_path):
+    try:
+        entries = list(os.scandir(folder_path))
+    except FileNotFoundError:
+        return 0
+    return sum(1 for entry in entries if entry.is_file())
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
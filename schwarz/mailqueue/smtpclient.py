@@ -7,6 +7,7 @@
 import logging
 import re
 import socket
+import time
 from contextlib import contextmanager
 
 from .lib.smtplib_py37 import (
@@ -20,7 +21,7 @@ from .lib.smtplib_py37 import (
 )
 
 
-__all__ = ['SMTPClient', 'SMTPRecipientRefused']
+__all__ = ['SMTPClient', 'SMTPDataError', 'SMTPRecipientRefused', 'SMTPSenderRefused']
 
 class SMTPRecipientRefused(SMTPResponseException):
     def __init__(self, code, msg, recipient):
@@ -33,6 +34,18 @@ class SMTPRecipientRefused(SMTPResponseException):
 class SMTPClient(SMTP):
     def __init__(self, *args, **kwargs):
         self.smtp_log = kwargs.pop('smtp_log', None)
+        # implicit TLS ("SMTPS", usually port 465): the socket is wrapped with
+        # TLS directly after connecting (no STARTTLS).
+        self.ssl_context = kwargs.pop('ssl_context', None)
+        self.tls_session = kwargs.pop('tls_session', None)
+        # optional deadline (as "time.monotonic()" value) for the complete
+        # SMTP session, see ".send()" and ".getreply()"
+        self.deadline = kwargs.pop('deadline', None)
+        self._is_sending_data = False
+        self._msg_transmitted = False
+        # recipients which were not sent in the last ".sendmail()" call
+        # because the server's recipient limit was reached
+        self.deferred_recipients = []
         if self.smtp_log:
             # ensure that "._print_debug()" is called whenever something interesting happens
             self.debuglevel = 1
@@ -41,8 +54,12 @@ class SMTPClient(SMTP):
     # ,------------------------------------------------------------------------
     # copied from "smtplib" shipped with Python 3.7
     # modified to raise SMTPRecipientRefused when ANY recipient was rejected
+    # (unless "allow_partial" is set: then the message is sent to all accepted
+    # recipients and the refused recipients are returned like smtplib does)
+    # and to stop at the server's recipient limit (see ".deferred_recipients")
     # License: Python-2.0 (my changes: public domain or CC-0 - your choice)
-    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=(),
+                 allow_partial=False):
         self.ehlo_or_helo_if_needed()
         esmtp_opts = []
         if isinstance(msg, str):
@@ -61,14 +78,30 @@ class SMTPClient(SMTP):
             raise SMTPSenderRefused(code, resp, from_addr)
         if isinstance(to_addrs, str):
             to_addrs = [to_addrs]
-        for each in to_addrs:
+        self.deferred_recipients = []
+        refused = {}
+        nr_accepted = 0
+        for idx, each in enumerate(to_addrs):
             (code, resp) = self.rcpt(each, rcpt_options)
             if code == 421:
                 self.close()
                 raise SMTPRecipientRefused(code, resp, each)
+            elif (nr_accepted > 0) and _is_recipient_limit(code, resp):
+                # "too many recipients" (RFC 5321, 4.5.3.1.10): send the
+                # message to the accepted recipients, the remaining recipients
+                # must be sent in a new transaction.
+                self.deferred_recipients = list(to_addrs[idx:])
+                break
             elif (code != 250) and (code != 251):
-                self._rset()
-                raise SMTPRecipientRefused(code, resp, each)
+                if not allow_partial:
+                    self._rset()
+                    raise SMTPRecipientRefused(code, resp, each)
+                refused[each] = (code, resp)
+            else:
+                nr_accepted += 1
+        if refused and (nr_accepted == 0):
+            self._rset()
+            raise _all_recipients_refused(refused)
         (code, resp) = self.data(msg)
         if code != 250:
             if code == 421:
@@ -76,8 +109,8 @@ class SMTPClient(SMTP):
             else:
                 self._rset()
             raise SMTPDataError(code, resp)
-        #if we got here then all recipients got our mail
-        return {}
+        #if we got here then all accepted recipients got our mail
+        return refused
     # `------------------------------------------------------------------------
 
     def connect(self, host='localhost', port=0, source_address=None):
@@ -95,6 +128,12 @@ class SMTPClient(SMTP):
         #  - SMTP_SSL does not log "source_address", SMTP always logs it (even if None)
         # I consider complete logging worth the price of a somewhat lengthy
         # method.
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('SMTP deadline exceeded')
+            if (timeout in (None, socket._GLOBAL_DEFAULT_TIMEOUT)) or (remaining < float(timeout)):
+                timeout = remaining
         if self.smtp_log:
             log_tmpl = 'connecting to %(host)s:%(port)s'
             optional = []
@@ -108,19 +147,63 @@ class SMTPClient(SMTP):
                 sport_str = source_port or '<default>'
                 source_str = 'source address=%s:%s' % (shost_str, sport_str)
                 optional.append(source_str)
+            if self.ssl_context is not None:
+                optional.append('implicit TLS')
             if optional:
                 optional_str = ' (%s)' % (', '.join(optional))
                 log_tmpl += optional_str
             self.smtp_log.debug(log_tmpl, {'host': host, 'port': port})
         with disable_debug(self):
-            return super(SMTPClient, self)._get_socket(host, port, timeout)
+            sock = super(SMTPClient, self)._get_socket(host, port, timeout)
+        if self.ssl_context is None:
+            return sock
+        try:
+            return self.ssl_context.wrap_socket(sock,
+                server_hostname = host,
+                session         = self.tls_session,
+            )
+        except:
+            sock.close()
+            raise
 
     def data(self, msg):
         filter_ = lambda r: r.msg.startswith('data:')
-        with filter_log_traces(self, filter_):
-            return super(SMTPClient, self).data(msg)
+        self._is_sending_data = True
+        try:
+            with filter_log_traces(self, filter_):
+                return super(SMTPClient, self).data(msg)
+        finally:
+            self._is_sending_data = False
+            self._msg_transmitted = False
+
+    def set_deadline(self, deadline):
+        # A reused connection might still use a short socket timeout from a
+        # previous deadline.
+        if (self.deadline is not None) and (deadline is None) and (self.sock is not None):
+            self.sock.settimeout(self._regular_timeout())
+        self.deadline = deadline
+
+    def _regular_timeout(self):
+        if self.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            return socket.getdefaulttimeout()
+        return self.timeout
+
+    def _apply_deadline(self):
+        if (self.deadline is None) or (self.sock is None):
+            return
+        if self._msg_transmitted:
+            # The server might have accepted the message already. Aborting
+            # now could lead to duplicate deliveries if the caller falls back
+            # to another transport so we wait (using the regular timeout).
+            self.sock.settimeout(self._regular_timeout())
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout('SMTP deadline exceeded')
+        self.sock.settimeout(remaining)
 
     def send(self, s):
+        self._apply_deadline()
         if self.smtp_log:
             if isinstance(s, bytes):
                 for line_bytes in re.split(b'\r?\n', s.rstrip(bCRLF)):
@@ -136,7 +219,12 @@ class SMTPClient(SMTP):
                 cmd_str = s.rstrip(CRLF)
                 self.smtp_log.debug('=> %s', cmd_str)
         with disable_debug(self):
-            return super(SMTPClient, self).send(s)
+            result = super(SMTPClient, self).send(s)
+        # smtplib's ".data()" sends the actual message (including the final
+        # ".") as bytes, all commands are sent as str.
+        if isinstance(s, bytes) and self._is_sending_data:
+            self._msg_transmitted = True
+        return result
 
     def getreply(self):
         # You might wonder why I'm not simply using "with disable_debug(...)"
@@ -151,6 +239,7 @@ class SMTPClient(SMTP):
         # information and I don't think anyone needs to debug multi-line reply
         # merging done by smtplib).
         filter_ = lambda r: r.msg.startswith('reply: retcode ')
+        self._apply_deadline()
         with filter_log_traces(self, filter_):
             return super(SMTPClient, self).getreply()
 
@@ -179,6 +268,32 @@ class SMTPClient(SMTP):
         self.smtp_log.debug(prefix + params_str)
 
 
+def _is_recipient_limit(code, resp):
+    # "452" is also used for other temporary problems (e.g. "4.2.2" mailbox
+    # full) so only "4.5.3" is a recipient limit if the server uses enhanced
+    # status codes.
+    if code != 452:
+        return False
+    status_code = resp.split(None, 1)[0] if resp else b''
+    if _status_code_regex.match(status_code):
+        return (status_code == b'4.5.3')
+    return True
+
+_status_code_regex = re.compile(br'^\d\.\d{1,3}\.\d{1,3}$')
+
+def _all_recipients_refused(refused):
+    # Retrying later only makes sense if any recipient was refused temporarily
+    # so the exception uses the first 4xx reply (if there is one).
+    replies = list(refused.items())
+    recipient, (code, resp) = replies[0]
+    for each, (each_code, each_resp) in replies:
+        if 400 <= each_code < 500:
+            recipient, code, resp = each, each_code, each_resp
+            break
+    exc = SMTPRecipientRefused(code, resp, recipient)
+    exc.refused_recipients = refused
+    return exc
+
 def _bytes_repr_to_str(value):
     # A common pattern in smtplib is
     #   self._print_debug('reply:', repr(line))
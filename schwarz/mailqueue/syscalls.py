@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+# Thin wrappers for (Linux-specific) system calls which are not exposed by
+# Python's "os" module. Callers must check if a call is available and provide
+# a portable fallback.
+
+import ctypes
+import os
+import platform
+import sys
+
+from .compat import IS_WINDOWS
+
+
+__all__ = [
+    'fsync_directory',
+    'has_renameat2',
+    'rename_noreplace',
+]
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+
+def _raise_errno():
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno))
+
+
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+# syscall numbers for "renameat2()" (only needed if glibc < 2.28)
+_SYS_renameat2 = {
+    'x86_64' : 316,
+    'aarch64': 276,
+    'i686'   : 353,
+    'armv7l' : 382,
+    'ppc64le': 357,
+    's390x'  : 347,
+}
+
+def _load_renameat2():
+    if _libc is None:
+        return None
+    if hasattr(_libc, 'renameat2'):
+        return _libc.renameat2
+    syscall_nr = _SYS_renameat2.get(platform.machine())
+    if syscall_nr is None:
+        return None
+    return lambda *args: _libc.syscall(syscall_nr, *args)
+
+_renameat2 = _load_renameat2()
+
+def has_renameat2():
+    # The kernel (Linux 3.15+) or the file system might still reject the
+    # call (ENOSYS/EINVAL) so callers need a fallback anyway.
+    return _renameat2 is not None
+
+def rename_noreplace(src, dst):
+    """
+    Rename "src" to "dst" in a single (atomic) operation. Raises
+    "FileExistsError" if "dst" exists already.
+    """
+    src_b = os.fsencode(src)
+    dst_b = os.fsencode(dst)
+    if _renameat2(AT_FDCWD, src_b, AT_FDCWD, dst_b, RENAME_NOREPLACE) != 0:
+        _raise_errno()
+
+
+def fsync_directory(path):
+    # Renaming a file only modifies the directory so the new entry is only
+    # durable after fsync'ing the directory. Windows can not open
+    # directories (NTFS journals metadata anyway).
+    if IS_WINDOWS:
+        return
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
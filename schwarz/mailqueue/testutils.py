@@ -3,13 +3,15 @@
 
 import logging
 import os
+import socket
+import threading
 from datetime import datetime as DateTime, timedelta as TimeDelta, timezone
 from email.message import Message
 from io import BytesIO
 from unittest import mock
 
 from pymta import SMTPCommandParser
-from pymta.test_util import BlackholeDeliverer
+from pymta.test_util import BlackholeDeliverer, DebuggingMTA, SMTPTestHelper
 from schwarz.log_utils import ForwardingLogger
 
 from .maildir_utils import move_message
@@ -22,12 +24,29 @@ __all__ = [
     'create_alias_file',
     'create_ini',
     'fake_smtp_client',
+    'FakeClock',
     'info_logger',
     'inject_example_message',
+    'IsolatedSMTPTestHelper',
     'retrieve_sent_message',
     'SocketMock',
+    'ThreadedSMTPServer',
 ]
 
+class FakeClock(object):
+    "Clock for tests (\"time.time()\"/\"time.monotonic()\") which only moves when told so."
+    def __init__(self, now=100.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
 def almost_now(dt):
     return dt - DateTime.now(timezone.utc) < TimeDelta(seconds=1)
 
@@ -134,6 +153,25 @@ def retrieve_sent_message(mta):
     smtp_msg = received_queue.get(block=False)
     return smtp_msg
 
+class IsolatedSMTPTestHelper(SMTPTestHelper):
+    """
+    pymta's "BlackholeDeliverer" stores received messages in a class
+    attribute so all instances of "SMTPTestHelper" share the same queue.
+    This helper uses a separate deliverer class so tests can run several
+    SMTP servers and check which one received a message.
+    """
+    def __init__(self, policy_class=None, authenticator_class=None):
+        super().__init__(authenticator_class=authenticator_class)
+        self.deliverer = type('BlackholeDeliverer', (BlackholeDeliverer,), {})
+        self.mta = DebuggingMTA(
+            self.hostname,
+            self.listen_port,
+            deliverer_class     = self.deliverer,
+            policy_class        = policy_class,
+            authenticator_class = authenticator_class,
+        )
+
+
 def stub_socket_creation(socket_mock):
     connect_override = socket_mock._overrides.get('connect', None)
     def mock_create_connection(host_port, timeout, source_address):
@@ -237,3 +275,72 @@ class SocketMock(object):
         self.reply_data.seek(0, os.SEEK_END)
         self.reply_data.write(reply_bytes)
         self.reply_data.seek(previous_position, os.SEEK_SET)
+
+
+class ThreadedSMTPServer(object):
+    """
+    Minimal SMTP server which handles each connection in a separate thread
+    (pymta's DebuggingMTA serves one connection at a time). Only intended
+    for tests which need concurrent connections.
+    """
+    def __init__(self):
+        self._server_sock = socket.socket()
+        self._server_sock.bind(('127.0.0.1', 0))
+        self._server_sock.listen(64)
+        self.hostname, self.port = self._server_sock.getsockname()
+        self.received_messages = []
+        self.nr_connections = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._accept_connections, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server_sock.close()
+
+    def _accept_connections(self):
+        while True:
+            try:
+                conn, _ = self._server_sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.nr_connections += 1
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _handle_connection(self, conn):
+        with conn, conn.makefile('rb') as conn_fp:
+            reply = lambda line: conn.sendall(line + b'\r\n')
+            reply(b'220 localhost ESMTP')
+            sender, recipients = None, []
+            for line in iter(conn_fp.readline, b''):
+                command = line[:4].upper()
+                if command in (b'EHLO', b'HELO', b'NOOP'):
+                    reply(b'250 localhost')
+                elif command == b'RSET':
+                    sender, recipients = None, []
+                    reply(b'250 ok')
+                elif command == b'MAIL':
+                    sender = line[10:].strip()
+                    reply(b'250 ok')
+                elif command == b'RCPT':
+                    recipients.append(line[8:].strip())
+                    reply(b'250 ok')
+                elif command == b'DATA':
+                    reply(b'354 go ahead')
+                    msg_lines = []
+                    for data_line in iter(conn_fp.readline, b''):
+                        if data_line == b'.\r\n':
+                            break
+                        msg_lines.append(data_line)
+                    with self._lock:
+                        self.received_messages.append((sender, recipients, b''.join(msg_lines)))
+                    sender, recipients = None, []
+                    reply(b'250 queued')
+                elif command == b'QUIT':
+                    reply(b'221 bye')
+                    return
+                else:
+                    reply(b'502 unknown command')
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from unittest import mock
+
+import pytest
+
+from schwarz.mailqueue import (
+    AsyncMessageHandler,
+    AsyncQueueWriter,
+    DebugMailer,
+    MaildirBackend,
+    async_handler,
+    create_maildir_directories,
+    enqueue_message_async,
+    queue_runner,
+)
+from schwarz.mailqueue.queue_runner import MaildirBackedMsg
+from schwarz.mailqueue.testutils import message as example_message
+
+
+@pytest.fixture
+def path_maildir(tmp_path):
+    _path_maildir = os.path.join(str(tmp_path), 'mailqueue')
+    create_maildir_directories(_path_maildir)
+    return _path_maildir
+
+def queued_files(path_maildir):
+    return os.listdir(os.path.join(path_maildir, 'new'))
+
+
+def test_can_enqueue_message_async(path_maildir):
+    msg_path = asyncio.run(enqueue_message_async(example_message(), path_maildir,
+        sender='foo@site.example', recipients=('bar@site.example',)))
+
+    assert queued_files(path_maildir) == [os.path.basename(msg_path)]
+    msg = MaildirBackedMsg(msg_path)
+    assert msg.from_addr == 'foo@site.example'
+    assert msg.to_addrs == ('bar@site.example',)
+
+def test_concurrent_messages_are_stored_in_one_batch(path_maildir):
+    writer = AsyncQueueWriter(path_maildir)
+    batch_sizes = []
+    first_batch_started = threading.Event()
+    continue_writing = threading.Event()
+    real_enqueue_message = async_handler.enqueue_message
+    real_write_messages = async_handler._write_messages
+    def enqueue_message(*args, **kwargs):
+        # a single message is stored directly
+        batch_sizes.append(1)
+        first_batch_started.set()
+        continue_writing.wait(timeout=5)
+        return real_enqueue_message(*args, **kwargs)
+    def write_messages(messages, *args, **kwargs):
+        batch_sizes.append(len(messages))
+        return real_write_messages(messages, *args, **kwargs)
+
+    async def send_messages():
+        first = asyncio.ensure_future(
+            writer.enqueue_message(example_message(), 'foo@site.example', ('bar@site.example',)))
+        await asyncio.get_running_loop().run_in_executor(None, first_batch_started.wait, 5)
+        others = [
+            writer.enqueue_message(example_message(), 'foo@site.example', ('bar@site.example',))
+            for _ in range(10)
+        ]
+        others_future = asyncio.gather(*others)
+        await asyncio.sleep(0)
+        continue_writing.set()
+        return [await first] + list(await others_future)
+
+    with mock.patch.object(async_handler, 'enqueue_message', new=enqueue_message), \
+            mock.patch.object(async_handler, '_write_messages', new=write_messages):
+        msg_paths = asyncio.run(send_messages())
+    writer.shutdown()
+
+    assert batch_sizes == [1, 10]
+    assert sorted(queued_files(path_maildir)) == sorted(os.path.basename(p) for p in msg_paths)
+
+def test_broken_message_does_not_fail_other_messages_in_batch(path_maildir):
+    writer = AsyncQueueWriter(path_maildir)
+    async def send_messages():
+        return await asyncio.gather(
+            writer.enqueue_message(example_message(), 'foo@site.example', ('bar@site.example',)),
+            writer.enqueue_message(example_message(), 'foo@site.example', ('bär@site.example',)),
+            return_exceptions=True,
+        )
+
+    msg_path, error = asyncio.run(send_messages())
+    writer.shutdown()
+
+    assert isinstance(error, UnicodeEncodeError)
+    assert queued_files(path_maildir) == [os.path.basename(msg_path)]
+
+def test_does_not_store_messages_twice_if_publishing_fails(path_maildir):
+    writer = AsyncQueueWriter(path_maildir)
+    messages = [(example_message(), 'foo@site.example', ('bar@site.example',))] * 3
+    # error after the messages were moved to "new"
+    sync_directories = mock.Mock(side_effect=OSError('fsync failed'))
+    batch = [(Future(), message) for message in messages]
+    with mock.patch.object(queue_runner, 'sync_directories', new=sync_directories):
+        writer._write_batch(batch)
+    writer.shutdown()
+
+    assert all(isinstance(future.exception(), OSError) for future, _ in batch)
+    assert len(queued_files(path_maildir)) == 3
+
+def test_rejects_messages_after_shutdown(path_maildir):
+    writer = AsyncQueueWriter(path_maildir)
+    writer.shutdown()
+
+    with pytest.raises(RuntimeError):
+        writer.submit(example_message(), 'foo@site.example', ('bar@site.example',))
+    assert queued_files(path_maildir) == []
+
+@pytest.mark.parametrize('simulate_failed_sending', [True, False])
+def test_async_message_handler(path_maildir, simulate_failed_sending):
+    mailer = DebugMailer(simulate_failed_sending=simulate_failed_sending)
+    handler = AsyncMessageHandler([mailer, MaildirBackend(path_maildir)])
+    async def send_messages():
+        return await asyncio.gather(*[
+            handler.send_message(example_message(), sender='foo@site.example',
+                recipient='bar@site.example')
+            for _ in range(5)
+        ])
+
+    send_results = asyncio.run(send_messages())
+    handler.shutdown()
+
+    assert all(send_results)
+    if simulate_failed_sending:
+        assert set(r.transport for r in send_results) == {'maildir'}
+        assert len(queued_files(path_maildir)) == 5
+    else:
+        assert len(mailer.sent_mails) == 5
+        assert queued_files(path_maildir) == []
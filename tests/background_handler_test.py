@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import gc
+import os
+import threading
+import time
+import weakref
+
+import pytest
+
+from schwarz.mailqueue import (
+    BackgroundMessageHandler,
+    DebugMailer,
+    MaildirBackend,
+    Relay,
+    RelayPool,
+    SendResult,
+    SMTPMailer,
+    background_handler,
+    create_maildir_directories,
+)
+from schwarz.mailqueue.testutils import message as example_message
+
+
+@pytest.fixture
+def path_maildir(tmp_path):
+    _path_maildir = os.path.join(str(tmp_path), 'mailqueue')
+    create_maildir_directories(_path_maildir)
+    return _path_maildir
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def queued_files(path_maildir):
+    return os.listdir(os.path.join(path_maildir, 'new'))
+
+
+def test_delivers_messages_in_background(path_maildir):
+    mailer = DebugMailer()
+    handler = BackgroundMessageHandler(mailer, MaildirBackend(path_maildir))
+    for _ in range(3):
+        send_result = handler.send_message(example_message(), sender='foo@site.example',
+            recipient='bar@site.example')
+        assert send_result
+        assert send_result.transport == 'background'
+    wait_until(lambda: len(mailer.sent_mails) == 3)
+    handler.shutdown()
+
+    assert len(mailer.sent_mails) == 3
+    assert queued_files(path_maildir) == []
+
+def test_stores_message_when_delivery_fails(path_maildir):
+    mailer = DebugMailer(simulate_failed_sending=True)
+    handler = BackgroundMessageHandler(mailer, MaildirBackend(path_maildir))
+    handler.send_message(example_message(), sender='foo@site.example', recipient='bar@site.example')
+    wait_until(lambda: len(queued_files(path_maildir)) == 1)
+    handler.shutdown()
+
+    assert mailer.sent_mails == []
+    assert len(queued_files(path_maildir)) == 1
+
+def test_stores_messages_when_queue_is_full_or_on_shutdown(path_maildir):
+    is_sending = threading.Event()
+    continue_sending = threading.Event()
+    def send_callback(*args):
+        is_sending.set()
+        continue_sending.wait(5)
+        return SendResult(True, queued=False, transport='debug')
+    mailer = DebugMailer(send_callback=send_callback)
+    handler = BackgroundMessageHandler(mailer, MaildirBackend(path_maildir), queue_size=1)
+    send_message = lambda: handler.send_message(example_message(),
+        sender='foo@site.example', recipient='bar@site.example')
+
+    assert send_message().transport == 'background'
+    assert is_sending.wait(5)
+    # worker thread is busy, one message in the in-memory queue
+    assert send_message().transport == 'background'
+    assert handler.pending == 1
+    send_result = send_message()
+    assert send_result.transport == 'maildir'
+    assert len(queued_files(path_maildir)) == 1
+
+    handler.shutdown(timeout=0.1)
+    assert len(queued_files(path_maildir)) == 2
+    continue_sending.set()
+    handler._worker.join(5)
+    assert len(mailer.sent_mails) == 1
+
+def test_does_not_modify_the_mailer(path_maildir):
+    mailer = SMTPMailer('host.example')
+    handler = BackgroundMessageHandler(mailer, MaildirBackend(path_maildir))
+    handler.shutdown()
+
+    assert not mailer.keep_alive
+    assert handler.mailer is not mailer
+    assert handler.mailer.keep_alive
+
+def test_does_not_modify_the_mailers_of_a_relay_pool(path_maildir):
+    mailers = [SMTPMailer('mx1.example'), SMTPMailer('mx2.example')]
+    relay_pool = RelayPool([Relay(mailer) for mailer in mailers])
+    handler = BackgroundMessageHandler(relay_pool, MaildirBackend(path_maildir))
+    handler.shutdown()
+
+    assert not any(mailer.keep_alive for mailer in mailers)
+    assert [relay.mailer for relay in relay_pool.relays] == mailers
+    assert handler.mailer is not relay_pool
+    relay_mailers = [relay.mailer for relay in handler.mailer.relays]
+    assert [mailer.hostname for mailer in relay_mailers] == ['mx1.example', 'mx2.example']
+    assert all(mailer.keep_alive for mailer in relay_mailers)
+
+def test_handler_can_be_garbage_collected_after_shutdown(path_maildir):
+    handler = BackgroundMessageHandler(DebugMailer(), MaildirBackend(path_maildir))
+    handler_ref = weakref.ref(handler)
+    handler.shutdown()
+
+    del handler
+    gc.collect()
+    assert handler_ref() is None
+
+def test_shuts_down_running_handlers_at_exit(path_maildir):
+    handler = BackgroundMessageHandler(DebugMailer(), MaildirBackend(path_maildir))
+    assert handler in background_handler._running_handlers
+
+    # registered with "atexit"
+    background_handler._shutdown_running_handlers()
+    assert not handler._worker.is_alive()
+    assert handler not in background_handler._running_handlers
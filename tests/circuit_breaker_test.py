@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import os
+
+import pytest
+
+from schwarz.mailqueue import (
+    CircuitBreakerTransport,
+    DebugMailer,
+    MaildirBackend,
+    MessageHandler,
+    SendResult,
+    SharedCircuitBreaker,
+    create_maildir_directories,
+)
+from schwarz.mailqueue.message_handler import InMemoryMsg
+from schwarz.mailqueue.testutils import FakeClock
+
+
+@pytest.fixture
+def path_maildir(tmp_path):
+    _path_maildir = os.path.join(str(tmp_path), 'mailqueue')
+    create_maildir_directories(_path_maildir)
+    return _path_maildir
+
+
+def connection_failure():
+    return SendResult(False, queued=False, transport='smtp', phase='connect')
+
+
+def test_shared_breaker_state_is_visible_to_other_instances(tmp_path):
+    path = str(tmp_path / 'breaker.json')
+    clock = FakeClock()
+    breaker = SharedCircuitBreaker(path, failure_threshold=2, reset_timeout=60, clock=clock)
+    breaker.record(connection_failure())
+    assert not breaker.is_open
+    assert breaker.allow_request()
+
+    other = SharedCircuitBreaker(path, failure_threshold=2, reset_timeout=60, clock=clock)
+    other.record(connection_failure())
+    assert breaker.is_open
+    assert not breaker.allow_request()
+
+    # any reply from the server closes the breaker
+    breaker.record(SendResult(False, transport='smtp', phase='recipient', smtp_code=550))
+    assert not other.is_open
+    assert not os.path.exists(path)
+
+def test_shared_breaker_allows_single_probe_after_timeout(tmp_path):
+    path = str(tmp_path / 'breaker.json')
+    clock = FakeClock()
+    breaker = SharedCircuitBreaker(path, failure_threshold=1, reset_timeout=60, clock=clock)
+    breaker.record(connection_failure())
+    assert not breaker.allow_request()
+
+    clock.now += 61
+    assert breaker.allow_request()
+    # only one caller may probe
+    assert not breaker.allow_request()
+    # failed probe: wait another "reset_timeout"
+    breaker.record(connection_failure())
+    clock.now += 30
+    assert not breaker.allow_request()
+    clock.now += 31
+    assert breaker.allow_request()
+    breaker.record(SendResult(True))
+    assert not breaker.is_open
+    assert breaker.allow_request()
+
+def test_shared_breaker_without_probes_stays_open_until_reset(tmp_path):
+    path = str(tmp_path / 'breaker.json')
+    clock = FakeClock()
+    breaker = SharedCircuitBreaker(path, failure_threshold=1, reset_timeout=60,
+        allow_probes=False, clock=clock)
+    breaker.record(connection_failure())
+
+    clock.now += 61
+    assert not breaker.allow_request()
+    # e.g. "mq-run" delivered a message
+    breaker.record(SendResult(True))
+    assert breaker.allow_request()
+
+def test_open_breaker_queues_messages_without_connecting(path_maildir):
+    breaker = SharedCircuitBreaker(os.path.join(path_maildir, 'breaker.json'), failure_threshold=1)
+    attempts = []
+    def send_callback(*args):
+        attempts.append(args)
+        return connection_failure()
+    mailer = DebugMailer(send_callback=send_callback)
+    mh = MessageHandler([CircuitBreakerTransport(mailer, breaker), MaildirBackend(path_maildir)])
+    msg = InMemoryMsg('foo@site.example', ('bar@site.example',), b'Header: value\n\nbody\n')
+
+    assert mh.send_message(msg).queued
+    assert len(attempts) == 1
+    assert breaker.is_open
+
+    msg = InMemoryMsg('foo@site.example', ('bar@site.example',), b'Header: value\n\nbody\n')
+    send_result = mh.send_message(msg)
+    assert send_result.queued
+    assert len(attempts) == 1
+    assert len(os.listdir(os.path.join(path_maildir, 'new'))) == 2
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import os
+import threading
+import time
+
+import pytest
+
+from schwarz.mailqueue import (
+    AIMDConcurrency,
+    DebugMailer,
+    SendResult,
+    create_maildir_directories,
+    send_all_queued_messages,
+)
+from schwarz.mailqueue.testutils import FakeClock, inject_example_message
+
+
+@pytest.fixture
+def path_maildir(tmp_path):
+    _path_maildir = os.path.join(str(tmp_path), 'mailqueue')
+    create_maildir_directories(_path_maildir)
+    return _path_maildir
+
+
+def test_increases_limit_additively():
+    clock = FakeClock()
+    concurrency = AIMDConcurrency(max_limit=4, clock=clock)
+    assert concurrency.limit == 1
+    # 1 -> 2 (one success), 2 -> 3 (two successes), 3 -> 4 (three successes)
+    for _ in range(6):
+        concurrency.record(SendResult(True), started=clock())
+    assert concurrency.limit == 4
+    for _ in range(10):
+        concurrency.record(SendResult(True), started=clock())
+    assert concurrency.limit == 4
+
+@pytest.mark.parametrize('smtp_code', [421, 451, 452])
+def test_decreases_limit_multiplicatively_when_throttled(smtp_code):
+    clock = FakeClock()
+    concurrency = AIMDConcurrency(max_limit=8, initial_limit=8, clock=clock)
+    started = clock()
+    clock.now += 1
+    concurrency.record(SendResult(False, smtp_code=smtp_code), started=started)
+    assert concurrency.limit == 4
+    # deliveries started before the decrease do not decrease the limit again
+    concurrency.record(SendResult(False, smtp_code=smtp_code), started=started)
+    assert concurrency.limit == 4
+
+    for _ in range(3):
+        clock.now += 1
+        concurrency.record(SendResult(False, smtp_code=smtp_code), started=clock())
+    assert concurrency.limit == 1
+
+def test_ignores_other_failures():
+    clock = FakeClock()
+    concurrency = AIMDConcurrency(max_limit=8, initial_limit=4, clock=clock)
+    concurrency.record(SendResult(False, smtp_code=550), started=clock())
+    concurrency.record(SendResult(False), started=clock())
+    assert concurrency.limit == 4
+
+def test_decreases_limit_when_latency_rises():
+    clock = FakeClock()
+    concurrency = AIMDConcurrency(max_limit=8, initial_limit=4, latency_factor=3, clock=clock)
+    started = clock()
+    clock.now += 0.2
+    concurrency.record(SendResult(True), started=started)
+    assert concurrency.limit == 4
+
+    started = clock()
+    clock.now += 1.0
+    concurrency.record(SendResult(True), started=started)
+    assert concurrency.limit == 2
+    assert concurrency.stats()['limit'] == 2
+
+def test_single_fast_delivery_does_not_pin_the_limit():
+    clock = FakeClock()
+    concurrency = AIMDConcurrency(max_limit=4, clock=clock)
+    # e.g. a tiny message, all other messages take much longer
+    started = clock()
+    clock.now += 0.01
+    concurrency.record(SendResult(True), started=started)
+    for _ in range(30):
+        started = clock()
+        clock.now += 0.3
+        concurrency.record(SendResult(True), started=started)
+    assert concurrency.limit == 4
+
+def test_ignores_time_spent_waiting_for_rate_limits():
+    clock = FakeClock()
+    concurrency = AIMDConcurrency(max_limit=8, initial_limit=4, clock=clock)
+    started = clock()
+    clock.now += 0.2
+    concurrency.record(SendResult(True), started=started)
+
+    started = clock()
+    clock.now += 2.2
+    send_result = SendResult(True)
+    send_result.rate_limit_delay = 2.0
+    concurrency.record(send_result, started=started)
+    assert concurrency.limit == 4
+
+def test_runner_can_deliver_messages_concurrently(path_maildir):
+    nr_messages = 20
+    for _ in range(nr_messages):
+        inject_example_message(path_maildir)
+    lock = threading.Lock()
+    in_flight = []
+    max_in_flight = [0]
+    def send_callback(*args):
+        with lock:
+            in_flight.append(1)
+            max_in_flight[0] = max(max_in_flight[0], len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.pop()
+        return SendResult(True, queued=False, transport='debug')
+    mailer = DebugMailer(send_callback=send_callback)
+    concurrency = AIMDConcurrency(max_limit=3)
+
+    send_all_queued_messages(path_maildir, mailer, concurrency=concurrency)
+    assert len(mailer.sent_mails) == nr_messages
+    assert os.listdir(os.path.join(path_maildir, 'new')) == []
+    assert concurrency.limit == 3
+    assert 1 < max_in_flight[0] <= 3
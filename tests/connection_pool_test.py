@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import threading
+from unittest.mock import MagicMock
+
+from schwarz.mailqueue import SMTPMailer
+from schwarz.mailqueue.connection_pool import ConnectionPool
+from schwarz.mailqueue.testutils import FakeClock, ThreadedSMTPServer
+
+
+def test_pool_keeps_at_most_max_size_connections():
+    closed = []
+    pool = ConnectionPool(2, close=closed.append)
+    assert pool.checkout() is None
+    for connection in ('c1', 'c2', 'c3'):
+        pool.checkin(connection)
+    assert len(pool) == 2
+    assert closed == ['c3']
+    # most recently used connection first
+    assert pool.checkout() == 'c2'
+    assert pool.checkout() == 'c1'
+    assert pool.checkout() is None
+
+def test_pool_closes_idle_connections():
+    clock = FakeClock()
+    closed = []
+    pool = ConnectionPool(5, idle_timeout=30, close=closed.append, clock=clock)
+    pool.checkin('c1')
+    clock.now += 20
+    pool.checkin('c2')
+    clock.now += 20
+    assert pool.checkout() == 'c2'
+    assert closed == ['c1']
+    pool.checkin('c2')
+    pool.close_all()
+    assert closed == ['c1', 'c2']
+    assert len(pool) == 0
+
+def test_mailer_checks_pooled_connections_before_use():
+    mailer = SMTPMailer('localhost', pool_size=1)
+    dead_connection = MagicMock(name='dead_connection')
+    dead_connection.noop.side_effect = OSError('connection reset')
+    mailer.pool.checkin(dead_connection)
+    assert mailer._reusable_connection(expires_at=None) is None
+    dead_connection.close.assert_called_once_with()
+
+def test_pooled_mailer_can_be_shared_between_threads():
+    server = ThreadedSMTPServer().start()
+    mailer = SMTPMailer(server.hostname, port=server.port, pool_size=4)
+    nr_threads = 16
+    nr_messages = 10
+    failures = []
+    def send_messages(thread_id):
+        for i in range(nr_messages):
+            recipient = 'r%d-%d@site.example' % (thread_id, i)
+            message = b'Subject: %d/%d\r\n\r\nbody\r\n' % (thread_id, i)
+            if not mailer.send('foo@site.example', (recipient,), message):
+                failures.append(recipient)
+    threads = [threading.Thread(target=send_messages, args=(i,)) for i in range(nr_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    mailer.close()
+    server.stop()
+
+    assert failures == []
+    assert len(server.received_messages) == nr_threads * nr_messages
+    # every message was sent with the correct envelope
+    for sender, recipients, msg_bytes in server.received_messages:
+        thread_id, i = recipients[0][2:].split(b'@')[0].split(b'-')
+        assert msg_bytes.startswith(b'Subject: %s/%s\r\n' % (thread_id, i))
+    # connections were reused
+    assert server.nr_connections < nr_threads * nr_messages / 2
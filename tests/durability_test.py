@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import os
+import stat
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+
+from schwarz.mailqueue import (
+    DebugMailer,
+    MaildirBackend,
+    MessageHandler,
+    create_maildir_directories,
+    enqueue_message,
+    enqueue_messages,
+    send_all_queued_messages,
+    syscalls,
+)
+from schwarz.mailqueue.testutils import message as example_message
+
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/fd'), reason='requires Linux')
+
+@pytest.fixture
+def path_maildir(tmp_path):
+    _path_maildir = os.path.realpath(os.path.join(str(tmp_path), 'mailqueue'))
+    create_maildir_directories(_path_maildir)
+    return _path_maildir
+
+
+# --- crash consistency harness -----------------------------------------------
+# Records all operations which matter for crash consistency. For a power loss
+# after each operation we compute the worst case file system state: Changes
+# which were not fsync'ed might or might not survive, e.g. a new directory
+# entry survives but the file contents are lost.
+
+@contextmanager
+def record_fs_operations():
+    ops = []
+    real_fsync, real_link, real_unlink = os.fsync, os.link, os.unlink
+    real_replace = os.replace
+    real_rename_noreplace = syscalls.rename_noreplace
+    def fsync(fd):
+        st = os.fstat(fd)
+        if stat.S_ISDIR(st.st_mode):
+            ops.append(('sync-dir', os.readlink('/proc/self/fd/%d' % fd)))
+        else:
+            ops.append(('sync-file', st.st_ino))
+        return real_fsync(fd)
+    def link(src, dst, *args, **kwargs):
+        inode = os.stat(src).st_ino
+        real_link(src, dst, *args, **kwargs)
+        dst_dir_fd = kwargs.get('dst_dir_fd')
+        if dst_dir_fd is not None:
+            dst = os.path.join(os.readlink('/proc/self/fd/%d' % dst_dir_fd), dst)
+        ops.append(('link', _dirname(dst), inode))
+    def unlink(path, *args, **kwargs):
+        inode = os.stat(path).st_ino
+        real_unlink(path, *args, **kwargs)
+        ops.append(('unlink', _dirname(path), inode))
+    def rename_noreplace(src, dst):
+        # a rename changes both directories (same as link + unlink but atomic)
+        inode = os.stat(src).st_ino
+        real_rename_noreplace(src, dst)
+        ops.append(('link', _dirname(dst), inode))
+        ops.append(('unlink', _dirname(src), inode))
+    def replace(src, dst):
+        inode = os.stat(src).st_ino
+        real_replace(src, dst)
+        ops.append(('link', _dirname(dst), inode))
+        ops.append(('unlink', _dirname(src), inode))
+    with mock.patch.object(os, 'fsync', new=fsync), \
+            mock.patch.object(os, 'link', new=link), \
+            mock.patch.object(os, 'unlink', new=unlink), \
+            mock.patch.object(os, 'replace', new=replace), \
+            mock.patch.object(syscalls, 'rename_noreplace', new=rename_noreplace):
+        yield ops
+
+def _dirname(path):
+    return os.path.dirname(os.path.realpath(path))
+
+def incomplete_messages_after_power_loss(ops, folder):
+    "Return all crash points where a message in \"folder\" could be incomplete."
+    problems = []
+    for crash_point in range(len(ops) + 1):
+        durable_data = set()
+        visible = set()
+        for op in ops[:crash_point]:
+            if op[0] == 'link' and (op[1] == folder):
+                visible.add(op[2])
+            elif op[0] == 'sync-file':
+                durable_data.add(op[1])
+        incomplete = visible - durable_data
+        if incomplete:
+            problems.append((crash_point, incomplete))
+    return problems
+
+def changes_lost_after_power_loss(ops):
+    "Return all directory changes which might be lost after the operation completed."
+    lost = []
+    for idx, op in enumerate(ops):
+        if op[0] not in ('link', 'unlink'):
+            continue
+        later_ops = ops[idx+1:]
+        is_synced = (('sync-dir', op[1]) in later_ops)
+        if not is_synced:
+            lost.append(op)
+    return lost
+
+
+# --- tests -------------------------------------------------------------------
+@pytest.mark.parametrize('durability', ['file', 'full'])
+def test_enqueued_messages_are_never_incomplete(path_maildir, durability):
+    with record_fs_operations() as ops:
+        enqueue_message(example_message(), path_maildir, 'foo@site.example', ('bar@site.example',),
+            durability=durability)
+    assert incomplete_messages_after_power_loss(ops, os.path.join(path_maildir, 'new')) == []
+
+def test_durability_none_might_expose_incomplete_messages(path_maildir):
+    with record_fs_operations() as ops:
+        enqueue_message(example_message(), path_maildir, 'foo@site.example', ('bar@site.example',),
+            durability='none')
+    assert not any(op[0].startswith('sync') for op in ops)
+    assert incomplete_messages_after_power_loss(ops, os.path.join(path_maildir, 'new')) != []
+
+def test_only_full_durability_persists_enqueued_messages(path_maildir):
+    path_new = os.path.join(path_maildir, 'new')
+    with record_fs_operations() as ops:
+        enqueue_message(example_message(), path_maildir, 'foo@site.example', ('bar@site.example',),
+            durability='file')
+    assert ('link', path_new) in [op[:2] for op in changes_lost_after_power_loss(ops)]
+
+    with record_fs_operations() as ops:
+        enqueue_message(example_message(), path_maildir, 'foo@site.example', ('bar@site.example',),
+            durability='full')
+    assert changes_lost_after_power_loss(ops) == []
+
+@pytest.mark.parametrize('durability', ['file', 'full'])
+def test_batch_enqueue_is_crash_consistent(path_maildir, durability):
+    messages = [(example_message(), 'foo@site.example', ('bar@site.example',))] * 5
+    with record_fs_operations() as ops:
+        enqueue_messages(messages, path_maildir, durability=durability)
+    path_new = os.path.join(path_maildir, 'new')
+    assert incomplete_messages_after_power_loss(ops, path_new) == []
+    assert changes_lost_after_power_loss(ops) == []
+    # each file is fsync'ed (reporting its own I/O errors), "new" only once
+    op_types = [op[0] for op in ops]
+    assert op_types.count('sync-file') == 5
+    assert ops.count(('sync-dir', path_new)) == 1
+
+@pytest.mark.parametrize('simulate_failed_sending', [True, False])
+def test_full_durability_persists_queue_state_after_delivery(path_maildir, simulate_failed_sending):
+    MaildirBackend(path_maildir, durability='full').send(
+        'foo@site.example', ('bar@site.example',), b'Header: value\r\n\r\nbody\r\n')
+    mailer = DebugMailer(simulate_failed_sending=simulate_failed_sending)
+    mh = MessageHandler([mailer])
+    with record_fs_operations() as ops:
+        send_all_queued_messages(path_maildir, mh=mh, durability='full')
+    assert [op[0] for op in ops if op[0] in ('link', 'unlink')]
+    assert changes_lost_after_power_loss(ops) == []
+    if simulate_failed_sending:
+        # message was rewritten (retry counter) to a new file which was
+        # synced before replacing the original message (never torn)
+        path_cur = os.path.join(path_maildir, 'cur')
+        path_new = os.path.join(path_maildir, 'new')
+        op_types = [op[0] for op in ops]
+        idx_sync_file = op_types.index('sync-file')
+        rewritten_inode = ops[idx_sync_file][1]
+        assert ops[idx_sync_file+1] == ('link', path_cur, rewritten_inode)
+        assert ('link', path_new, rewritten_inode) in ops[idx_sync_file+2:]
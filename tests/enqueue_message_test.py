@@ -2,10 +2,23 @@
 # SPDX-License-Identifier: MIT
 
 import os
+from datetime import datetime, timezone
+from unittest import mock
 
 import pytest
 
-from schwarz.mailqueue import DebugMailer, MessageHandler, enqueue_message
+from schwarz.mailqueue import (
+    DebugMailer,
+    MessageHandler,
+    enqueue_message,
+    enqueue_messages,
+    maildir_utils,
+    queue_runner,
+)
+from schwarz.mailqueue.queue_runner import (
+    MaildirBackedMsg,
+    serialize_message_with_queue_data,
+)
 from schwarz.mailqueue.testutils import message as example_message
 
 
@@ -46,6 +59,91 @@ def test_can_store_message_on_disk_before_sending(path_maildir):
     assert len(_msg_files(path_maildir, folder='new')) == 0
     assert len(_msg_files(path_maildir, folder='cur')) == 0
 
+
+@pytest.mark.skipif(not maildir_utils.HAS_O_TMPFILE, reason='requires O_TMPFILE (Linux)')
+def test_enqueue_publishes_anonymous_file_without_tmp_folder(path_maildir):
+    create_tmp = mock.Mock(side_effect=AssertionError('must not use tmp folder'))
+    with mock.patch('mailbox.Maildir._create_tmp', new=create_tmp):
+        md_msg = enqueue_message(example_message(), path_maildir,
+            sender      = 'foo@site.example',
+            recipients  = ('bar@site.example',),
+            in_progress = True,
+            return_msg  = True,
+        )
+    assert md_msg.fp.is_locked()
+    assert _msg_files(path_maildir, folder='cur') == [md_msg.path]
+    assert _msg_files(path_maildir, folder='tmp') == []
+    assert md_msg.to_addrs == ('bar@site.example',)
+    md_msg.fp.close()
+
+def test_enqueue_falls_back_to_tmp_folder_without_o_tmpfile(path_maildir):
+    with mock.patch.object(maildir_utils, 'HAS_O_TMPFILE', new=False):
+        msg_path = enqueue_message(example_message(), path_maildir,
+            sender='foo@site.example', recipients=('bar@site.example',))
+    assert _msg_files(path_maildir, folder='new') == [msg_path]
+    assert _msg_files(path_maildir, folder='tmp') == []
+
+@pytest.mark.parametrize('max_unsynced_files', [256, 3])
+def test_can_enqueue_multiple_messages(path_maildir, max_unsynced_files):
+    messages = []
+    for i in range(20):
+        recipients = ('bar%d@site.example' % i,)
+        messages.append((example_message(), 'foo@site.example', recipients))
+    with mock.patch.object(queue_runner, 'MAX_UNSYNCED_FILES', new=max_unsynced_files):
+        msg_paths = enqueue_messages(iter(messages), path_maildir)
+
+    assert len(msg_paths) == 20
+    assert sorted(msg_paths) == sorted(_msg_files(path_maildir, folder='new'))
+    assert os.listdir(os.path.join(path_maildir, 'tmp')) == []
+    to_addrs = set()
+    for msg_path in msg_paths:
+        msg = MaildirBackedMsg(msg_path)
+        assert msg.start_delivery()
+        assert msg.from_addr == 'foo@site.example'
+        to_addrs.update(msg.to_addrs)
+        msg.fp.close()
+    assert len(to_addrs) == 20
+
+def test_enqueue_messages_does_not_queue_anything_after_error(path_maildir):
+    def messages():
+        yield (example_message(), 'foo@site.example', ('bar@site.example',))
+        raise ValueError('broken message')
+
+    with pytest.raises(ValueError):
+        enqueue_messages(messages(), path_maildir)
+    assert _msg_files(path_maildir, folder='new') == []
+    assert _msg_files(path_maildir, folder='tmp') == []
+
+@pytest.mark.parametrize('has_o_tmpfile', [True, False])
+def test_enqueue_writes_metadata_and_message_without_joining(path_maildir, has_o_tmpfile):
+    msg_bytes = b'Subject: large\r\n\r\n' + (b'x' * 998 + b'\r\n') * 1000
+    queue_date = datetime(2020, 4, 1, 12, 30, tzinfo=timezone.utc)
+    with mock.patch.object(maildir_utils, 'HAS_O_TMPFILE', new=has_o_tmpfile):
+        msg_path = enqueue_message(msg_bytes, path_maildir,
+            sender='foo@site.example', recipients=('bar@site.example',), queue_date=queue_date)
+
+    expected_bytes = serialize_message_with_queue_data(msg_bytes,
+        sender='foo@site.example', recipients=('bar@site.example',), queue_date=queue_date)
+    with open(msg_path, 'rb') as fp:
+        assert fp.read() == expected_bytes
+
+@pytest.mark.skipif(not hasattr(os, 'writev'), reason='requires os.writev()')
+def test_writev_all_handles_partial_writes(tmp_path):
+    real_writev = os.writev
+    def writev(fd, buffers):
+        # simulate a signal interrupting the syscall after a few bytes
+        return real_writev(fd, [bytes(buffers[0][:3])])
+
+    file_path = str(tmp_path / 'msg')
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT)
+    try:
+        with mock.patch.object(os, 'writev', new=writev):
+            maildir_utils.writev_all(fd, (b'meta\r\n', b'', memoryview(b'body')))
+    finally:
+        os.close(fd)
+    with open(file_path, 'rb') as fp:
+        assert fp.read() == b'meta\r\nbody'
+
 # --- internal helpers ----------------------------------------------------
 def _msg_files(path_maildir, folder='new'):
     path = os.path.join(path_maildir, folder)
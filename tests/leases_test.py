@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import logging
+import multiprocessing
+import os
+import time
+from unittest import mock
+
+import pytest
+
+from schwarz.mailqueue import (
+    DebugMailer,
+    SendResult,
+    create_maildir_directories,
+    leases,
+    parse_message_envelope,
+    send_all_queued_messages,
+)
+from schwarz.mailqueue.leases import (
+    LEASES_FOLDER,
+    claim_message,
+    move_claimed_message,
+    recover_expired_leases,
+    remove_claimed_message,
+    renew_lease,
+)
+from schwarz.mailqueue.queue_runner import LeasedMsg
+from schwarz.mailqueue.testutils import inject_example_message
+
+
+@pytest.fixture
+def path_maildir(tmp_path):
+    _path_maildir = os.path.join(str(tmp_path), 'mailqueue')
+    create_maildir_directories(_path_maildir)
+    return _path_maildir
+
+def msg_files(path_maildir, folder='new'):
+    return os.listdir(os.path.join(path_maildir, folder))
+
+def lease_files(path_maildir):
+    return os.listdir(os.path.join(path_maildir, LEASES_FOLDER))
+
+log = logging.getLogger('mailqueue.test')
+
+
+def test_claim_message(path_maildir):
+    msg = inject_example_message(path_maildir)
+    claimed_path = claim_message(msg.path, lease_timeout=60)
+
+    assert msg_files(path_maildir, folder='new') == []
+    assert msg_files(path_maildir, folder='cur') == [os.path.basename(claimed_path)]
+    assert lease_files(path_maildir) == [os.path.basename(claimed_path)]
+    # message was claimed already
+    assert claim_message(msg.path, lease_timeout=60) is None
+    assert lease_files(path_maildir) == [os.path.basename(claimed_path)]
+
+    new_path = move_claimed_message(claimed_path, 'new')
+    assert new_path == msg.path
+    assert msg_files(path_maildir, folder='new') == [os.path.basename(msg.path)]
+    assert lease_files(path_maildir) == []
+
+def test_remove_claimed_message(path_maildir):
+    msg = inject_example_message(path_maildir)
+    claimed_path = claim_message(msg.path, lease_timeout=60)
+
+    assert remove_claimed_message(claimed_path)
+    assert msg_files(path_maildir, folder='cur') == []
+    assert lease_files(path_maildir) == []
+
+def test_recovers_messages_with_expired_lease(path_maildir):
+    msg = inject_example_message(path_maildir)
+    claimed_path = claim_message(msg.path, lease_timeout=60)
+
+    recover_expired_leases(path_maildir, log, lease_timeout=60)
+    assert msg_files(path_maildir, folder='cur') == [os.path.basename(claimed_path)]
+
+    expired = lambda: time.time() + 120
+    recover_expired_leases(path_maildir, log, lease_timeout=60, clock=expired)
+    assert msg_files(path_maildir, folder='new') == [os.path.basename(msg.path)]
+    assert msg_files(path_maildir, folder='cur') == []
+    assert lease_files(path_maildir) == []
+
+def test_renewed_lease_does_not_expire(path_maildir):
+    msg = inject_example_message(path_maildir)
+    claimed_path = claim_message(msg.path, lease_timeout=60)
+    assert renew_lease(claimed_path, lease_timeout=60, clock=lambda: time.time() + 100)
+
+    recover_expired_leases(path_maildir, log, lease_timeout=60, clock=lambda: time.time() + 120)
+    assert msg_files(path_maildir, folder='cur') == [os.path.basename(claimed_path)]
+
+def test_owner_can_not_modify_message_after_lease_expired(path_maildir):
+    msg = inject_example_message(path_maildir)
+    claimed_path = claim_message(msg.path, lease_timeout=60)
+    recover_expired_leases(path_maildir, log, lease_timeout=60, clock=lambda: time.time() + 120)
+    other_claim = claim_message(msg.path, lease_timeout=60)
+    assert other_claim is not None
+
+    # fencing: the old claim is invalid
+    assert not renew_lease(claimed_path, lease_timeout=60)
+    assert not remove_claimed_message(claimed_path)
+    assert move_claimed_message(claimed_path, 'new') is None
+    assert msg_files(path_maildir, folder='cur') == [os.path.basename(other_claim)]
+    assert lease_files(path_maildir) == [os.path.basename(other_claim)]
+
+def test_does_not_recover_message_claimed_while_reading_leases(path_maildir):
+    msg = inject_example_message(path_maildir)
+    claimed_paths = []
+    real_read_leases = leases._read_leases
+    def read_leases(queue_dir):
+        lease_snapshot = real_read_leases(queue_dir)
+        # another runner claims the message before "cur" is scanned
+        claimed_paths.append(claim_message(msg.path, lease_timeout=300))
+        return lease_snapshot
+
+    with mock.patch.object(leases, '_read_leases', new=read_leases):
+        recover_expired_leases(path_maildir, log, lease_timeout=300)
+    claimed_path, = claimed_paths
+    assert msg_files(path_maildir, folder='new') == []
+    assert msg_files(path_maildir, folder='cur') == [os.path.basename(claimed_path)]
+    assert lease_files(path_maildir) == [os.path.basename(claimed_path)]
+
+def test_recovers_expired_messages_from_tmp(path_maildir):
+    msg = inject_example_message(path_maildir)
+    claimed_path = claim_message(msg.path, lease_timeout=60)
+    tmp_path = move_claimed_message(claimed_path, 'tmp')
+    # regular temporary file, e.g. a message which is being enqueued
+    open(os.path.join(path_maildir, 'tmp', 'enqueued'), 'wb').close()
+
+    recover_expired_leases(path_maildir, log, lease_timeout=60, clock=lambda: time.time() + 120)
+    assert msg_files(path_maildir, folder='new') == [os.path.basename(msg.path)]
+    assert msg_files(path_maildir, folder='tmp') == ['enqueued']
+    assert not os.path.exists(tmp_path)
+
+def test_leased_msg_stores_failed_delivery(path_maildir):
+    msg = inject_example_message(path_maildir)
+    leased_msg = LeasedMsg(msg.path, lease_timeout=60)
+    assert leased_msg.start_delivery()
+    assert leased_msg.retries == 0
+
+    leased_msg.retries = 1
+    leased_msg.delivery_failed()
+    assert msg_files(path_maildir, folder='new') == [os.path.basename(msg.path)]
+    assert msg_files(path_maildir, folder='cur') == []
+    assert msg_files(path_maildir, folder='tmp') == []
+    assert lease_files(path_maildir) == []
+    with open(msg.path, 'rb') as fp:
+        assert parse_message_envelope(fp).retries == 1
+
+def test_can_send_messages_with_lease_claims(path_maildir):
+    for _ in range(3):
+        inject_example_message(path_maildir)
+    mailer = DebugMailer()
+
+    send_all_queued_messages(path_maildir, mailer, claim_mode='lease')
+    assert len(mailer.sent_mails) == 3
+    assert msg_files(path_maildir, folder='new') == []
+    assert msg_files(path_maildir, folder='cur') == []
+    assert lease_files(path_maildir) == []
+
+
+def _run_queue(path_maildir, path_log):
+    def record_recipient(fromaddr, toaddrs, message):
+        with open(path_log, 'ab') as log_fp:
+            log_fp.write(b'%s\n' % toaddrs[0].encode('ascii'))
+        return SendResult(True, queued=False, transport='debug')
+    mailer = DebugMailer(send_callback=record_recipient)
+    send_all_queued_messages(path_maildir, mailer, claim_mode='lease')
+
+def test_several_runners_deliver_each_message_once(path_maildir, tmp_path):
+    recipients = [b'user%d@site.example' % i for i in range(100)]
+    for recipient in recipients:
+        inject_example_message(path_maildir, recipient=recipient)
+    path_log = str(tmp_path / 'sent.log')
+
+    mp_context = multiprocessing.get_context('spawn')
+    runners = [
+        mp_context.Process(target=_run_queue, args=(path_maildir, path_log))
+        for _ in range(4)
+    ]
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join(timeout=60)
+        assert runner.exitcode == 0
+    with open(path_log, 'rb') as log_fp:
+        sent_to = log_fp.read().splitlines()
+    assert sorted(sent_to) == sorted(recipients)
+    assert msg_files(path_maildir, folder='new') == []
+    assert msg_files(path_maildir, folder='cur') == []
+    assert lease_files(path_maildir) == []
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import errno
+import os
+from unittest import mock
+
+import pytest
+
+from schwarz.mailqueue import (
+    DebugMailer,
+    create_maildir_directories,
+    maildir_utils,
+    move_message,
+    send_all_queued_messages,
+    syscalls,
+)
+from schwarz.mailqueue.testutils import inject_example_message
+
+
+@pytest.fixture
+def path_maildir(tmp_path):
+    _path_maildir = os.path.join(str(tmp_path), 'mailqueue')
+    create_maildir_directories(_path_maildir)
+    return _path_maildir
+
+def msg_files(path_maildir, folder='new'):
+    return os.listdir(os.path.join(path_maildir, folder))
+
+
+def _renameat2_works(path_maildir):
+    if not syscalls.has_renameat2():
+        return False
+    src = os.path.join(path_maildir, 'tmp', 'probe')
+    open(src, 'wb').close()
+    try:
+        syscalls.rename_noreplace(src, src + '-renamed')
+    except OSError:
+        return False
+    os.unlink(src + '-renamed')
+    return True
+
+
+def test_move_message_uses_single_rename_if_possible(path_maildir):
+    if not _renameat2_works(path_maildir):
+        pytest.skip('renameat2() not supported')
+    msg = inject_example_message(path_maildir)
+    atomic_rename = mock.Mock(side_effect=AssertionError('must use renameat2()'))
+    # no inode checks: "renameat2()" fails if the message was moved already
+    stat = mock.Mock(side_effect=AssertionError('unexpected stat()'))
+    with mock.patch.object(maildir_utils, 'atomic_rename', new=atomic_rename), \
+            mock.patch.object(os, 'stat', new=stat):
+        target_path = move_message(msg.path, target_folder='cur', open_file=False)
+
+    assert msg_files(path_maildir, folder='cur') == [os.path.basename(target_path)]
+    assert msg_files(path_maildir, folder='new') == []
+
+def test_rename_noreplace_does_not_overwrite_existing_file(path_maildir):
+    if not _renameat2_works(path_maildir):
+        pytest.skip('renameat2() not supported')
+    msg = inject_example_message(path_maildir)
+    target_path = os.path.join(path_maildir, 'cur', os.path.basename(msg.path))
+    with open(target_path, 'wb') as fp:
+        fp.write(b'other message')
+
+    with pytest.raises(FileExistsError):
+        syscalls.rename_noreplace(msg.path, target_path)
+    assert move_message(msg.path, target_folder='cur') is None
+    with open(target_path, 'rb') as fp:
+        assert fp.read() == b'other message'
+
+@pytest.mark.parametrize('error', [errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM])
+def test_move_message_falls_back_if_renameat2_is_not_supported(path_maildir, error):
+    msg = inject_example_message(path_maildir)
+    rename_noreplace = mock.Mock(side_effect=OSError(error, os.strerror(error)))
+    with mock.patch.object(maildir_utils, '_renameat2_works', new=True), \
+            mock.patch.object(maildir_utils, '_dirs_without_renameat2', new=set()), \
+            mock.patch.object(syscalls, 'rename_noreplace', new=rename_noreplace):
+        target_path = move_message(msg.path, target_folder='cur', open_file=False)
+        assert msg_files(path_maildir, folder='cur') == [os.path.basename(target_path)]
+
+        # no further "renameat2()" calls after the first failure
+        move_message(target_path, target_folder='new', open_file=False)
+        assert rename_noreplace.call_count == 1
+    assert len(msg_files(path_maildir, folder='new')) == 1
+
+def test_delivers_messages_if_renameat2_is_blocked(path_maildir):
+    # e.g. seccomp filter in a container
+    inject_example_message(path_maildir)
+    rename_noreplace = mock.Mock(side_effect=PermissionError(errno.EPERM, 'blocked'))
+    mailer = DebugMailer()
+    with mock.patch.object(maildir_utils, '_renameat2_works', new=True), \
+            mock.patch.object(maildir_utils, '_dirs_without_renameat2', new=set()), \
+            mock.patch.object(syscalls, 'rename_noreplace', new=rename_noreplace):
+        send_all_queued_messages(path_maildir, mailer)
+    assert len(mailer.sent_mails) == 1
+    assert msg_files(path_maildir, folder='new') == []
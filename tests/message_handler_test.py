@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 # SPDX-License-Identifier: MIT
 
+import logging
 import os
 import shutil
 import uuid
+from datetime import timedelta as TimeDelta
 from unittest.mock import MagicMock
 
 import pytest
@@ -16,7 +18,16 @@ except ImportError:
     SignalRegistry = None
 from testfixtures import LogCapture
 
-from schwarz.mailqueue import DebugMailer, MessageHandler, create_maildir_directories, lock_file
+from schwarz.mailqueue import (
+    DebugMailer,
+    InMemoryMsg,
+    MessageHandler,
+    RetryPolicy,
+    SendResult,
+    create_maildir_directories,
+    dt_now,
+    lock_file,
+)
 from schwarz.mailqueue.compat import IS_WINDOWS
 from schwarz.mailqueue.maildir_utils import find_messages
 from schwarz.mailqueue.message_utils import parse_message_envelope
@@ -196,6 +207,22 @@ def test_can_enqueue_message_with_multiple_recipients_after_failed_sending(path_
         stored_msg = parse_message_envelope(msg_fp)
     assert stored_msg.to_addrs == recipients
 
+def test_passes_deadline_to_supporting_transports(path_maildir):
+    deadlines = []
+    class SlowMailer(DebugMailer):
+        supports_deadline = True
+        def send(self, fromaddr, toaddrs, message, deadline=None):
+            deadlines.append(deadline)
+            return False
+    mh = MessageHandler([SlowMailer(), MaildirBackend(path_maildir)])
+
+    send_result = mh.send_message(example_message(), sender='foo@site.example',
+        recipient='bar@site.example', deadline=0.3)
+    assert send_result.queued
+    assert len(deadlines) == 1
+    assert 0 < deadlines[0] <= 0.3
+    assert len(msg_files(path_maildir, folder='new')) == 1
+
 @pytest.mark.parametrize('delivery_successful', [True, False])
 @pytest.mark.skipif(SignalRegistry is None, reason='requires PuzzlePluginSystem')
 def test_can_notify_plugin_after_delivery(path_maildir, delivery_successful):
@@ -269,6 +296,154 @@ def test_plugin_can_access_number_of_failed_deliveries(path_maildir):
     assert len(tuple(find_messages(path_maildir, log=l_(None)))) == 0
     assert send_result.discarded
 
+def test_moves_message_to_failed_folder_after_max_retries(path_maildir):
+    msg = inject_example_message(path_maildir)
+    mailer = DebugMailer(simulate_failed_sending=True)
+    mh = MessageHandler([mailer], retry_policy=RetryPolicy(max_retries=2))
+
+    send_result = mh.send_message(msg)
+    assert send_result.failure_reason is None
+    assert len(msg_files(path_maildir, folder='new')) == 1
+
+    msg = MaildirBackedMsg(msg_files(path_maildir, folder='new')[0])
+    mh.delivery_log = logging.getLogger('test.delivery_log.%s' % uuid.uuid4())
+    with LogCapture(mh.delivery_log.name) as lc:
+        send_result = mh.send_message(msg)
+    assert not send_result
+    assert send_result.failure_reason == 'too many failed delivery attempts (2)'
+    # the failure reason is only logged
+    log_record, = lc.records
+    expected_log_msg = 'delivery given up, too many failed delivery attempts (2)'
+    assert log_record.getMessage().endswith(expected_log_msg)
+    assert msg_files(path_maildir, folder='new') == []
+    assert msg_files(path_maildir, folder='cur') == []
+    failed_files = msg_files(path_maildir, folder='failed/new')
+    assert len(failed_files) == 1
+    # the message file is moved as it is (no rewrite)
+    with open(failed_files[0], 'rb') as fp:
+        msg_info = parse_message_envelope(fp)
+    assert msg_info.retries == 1
+    assert msg_info.failure_reason is None
+
+def test_moves_old_message_to_failed_folder(path_maildir):
+    queue_date = dt_now() - TimeDelta(days=3)
+    msg = inject_example_message(path_maildir, queue_date=queue_date)
+    mailer = DebugMailer(simulate_failed_sending=True)
+    retry_policy = RetryPolicy(max_queue_age=2 * 24 * 60 * 60)
+    mh = MessageHandler([mailer], retry_policy=retry_policy)
+
+    send_result = mh.send_message(msg)
+    assert send_result.failure_reason.startswith('message too old')
+    assert msg_files(path_maildir, folder='new') == []
+    assert len(msg_files(path_maildir, folder='failed/new')) == 1
+
+def test_does_not_try_to_deliver_expired_messages(path_maildir):
+    queue_date = dt_now() - TimeDelta(days=3)
+    inject_example_message(path_maildir, queue_date=queue_date)
+    inject_example_message(path_maildir, queue_date=dt_now())
+    old_msg, new_msg = sorted([MaildirBackedMsg(path) for path in msg_files(path_maildir)],
+        key=lambda msg: msg.queue_date)
+    mailer = DebugMailer()
+    retry_policy = RetryPolicy(max_retries=2, max_queue_age=2 * 24 * 60 * 60)
+    mh = MessageHandler([mailer], retry_policy=retry_policy)
+
+    send_result = mh.send_message(old_msg)
+    assert not send_result
+    assert send_result.failure_reason.startswith('message too old')
+    assert len(mailer.sent_mails) == 0
+    assert len(msg_files(path_maildir, folder='failed/new')) == 1
+
+    # e.g. "max_retries" was lowered after the last delivery attempt
+    new_msg.retries = 2
+    send_result = mh.send_message(new_msg)
+    assert send_result.failure_reason == 'too many failed delivery attempts (2)'
+    assert len(mailer.sent_mails) == 0
+    assert len(msg_files(path_maildir, folder='failed/new')) == 2
+
+@pytest.mark.parametrize('smtp_code, is_permanent', [(550, True), (451, False)])
+def test_does_not_queue_messages_after_permanent_failure(path_maildir, smtp_code, is_permanent):
+    rejected = lambda *args: SendResult(False, smtp_code=smtp_code, phase='recipient',
+        smtp_reply='5.1.1 user unknown')
+    mailer = DebugMailer(send_callback=rejected)
+    transports = [mailer, MaildirBackend(path_maildir)]
+    mh = MessageHandler(transports, retry_policy=RetryPolicy())
+
+    send_result = mh.send_message(example_message(), sender='foo@site.example',
+        recipient='bar@site.example')
+    if is_permanent:
+        assert not send_result
+        assert send_result.failure_reason == 'permanent failure (recipient): 550 5.1.1 user unknown'
+        assert msg_files(path_maildir, folder='new') == []
+        # the message is not lost
+        failed_path, = msg_files(path_maildir, folder='failed/new')
+        with open(failed_path, 'rb') as msg_fp:
+            failed_msg = parse_message_envelope(msg_fp)
+        assert failed_msg.to_addrs == ('bar@site.example',)
+        assert failed_msg.failure_reason == send_result.failure_reason
+    else:
+        assert send_result.queued
+        assert len(msg_files(path_maildir, folder='new')) == 1
+
+def test_queues_only_temporarily_refused_recipients(path_maildir):
+    refused_recipients = {
+        'baz@site.example': (450, 'mailbox busy'),
+        'qux@site.example': (550, 'user unknown'),
+    }
+    partial_delivery = lambda *args: SendResult(True, queued=False, transport='smtp',
+        refused_recipients=refused_recipients)
+    mailer = DebugMailer(send_callback=partial_delivery)
+    mh = MessageHandler([mailer, MaildirBackend(path_maildir)], retry_policy=RetryPolicy())
+    recipients = ('bar@site.example', 'baz@site.example', 'qux@site.example')
+
+    send_result = mh.send_message(example_message(), sender='foo@site.example',
+        recipients=recipients)
+    assert send_result
+    assert send_result.queued
+    msg_path, = msg_files(path_maildir, folder='new')
+    with open(msg_path, 'rb') as msg_fp:
+        stored_msg = parse_message_envelope(msg_fp)
+    assert stored_msg.to_addrs == ('baz@site.example',)
+
+def test_queues_message_if_only_some_recipients_were_refused_permanently(path_maildir):
+    # no partial delivery: the server refused the first recipient, the other
+    # recipients were not tried at all
+    rejected = lambda *args: SendResult(False, smtp_code=550, phase='recipient')
+    mailer = DebugMailer(send_callback=rejected)
+    mh = MessageHandler([mailer, MaildirBackend(path_maildir)], retry_policy=RetryPolicy())
+
+    send_result = mh.send_message(example_message(), sender='foo@site.example',
+        recipients=('unknown@site.example', 'bar@site.example'))
+    assert send_result.queued
+    assert len(msg_files(path_maildir, folder='new')) == 1
+
+def test_retry_policy_classifies_smtp_replies():
+    retry_policy = RetryPolicy()
+    is_permanent = lambda **kwargs: retry_policy.is_permanent_failure(SendResult(False, **kwargs))
+    assert is_permanent(smtp_code=550, phase='recipient')
+    assert is_permanent(smtp_code=552, phase='data')
+    assert is_permanent(smtp_code=553, phase='sender')
+    assert not is_permanent(smtp_code=450, phase='recipient')
+    assert not is_permanent(smtp_code=421, phase='data')
+    # server/configuration problems
+    assert not is_permanent(smtp_code=554, phase='connect')
+    assert not is_permanent(smtp_code=535, phase='auth')
+    assert not is_permanent(phase='connect')
+    assert not RetryPolicy(retry_permanent_failures=True).is_permanent_failure(
+        SendResult(False, smtp_code=550, phase='recipient'))
+
+def test_retry_policy():
+    retry_policy = RetryPolicy(max_retries=3, max_queue_age=3600)
+    msg = InMemoryMsg('foo@site.example', ('bar@site.example',), b'Subject: test\r\n\r\nbody')
+    assert retry_policy.give_up_reason(msg, SendResult(False)) is None
+    msg.retries = 3
+    assert retry_policy.give_up_reason(msg, SendResult(False)) is not None
+    assert RetryPolicy().give_up_reason(msg, SendResult(False)) is None
+
+    new_msg = InMemoryMsg('foo@site.example', ('bar@site.example',), b'Subject: test\r\n\r\nbody')
+    in_two_hours = lambda: dt_now() + TimeDelta(hours=2)
+    late_policy = RetryPolicy(max_queue_age=3600, clock=in_two_hours)
+    assert late_policy.give_up_reason(new_msg, SendResult(False)) is not None
+
 
 # --- internal helpers ----------------------------------------------------
 def list_all_files(basedir):
@@ -18,6 +18,7 @@ from schwarz.mailqueue import (
     DebugMailer,
     MQAction,
     MQSignal,
+    SendResult,
     create_maildir_directories,
 )
 from schwarz.mailqueue.cli import one_shot_queue_run_main
@@ -53,6 +54,23 @@ def test_mq_run_delivery_without_plugins(failed_sending, tmp_path):
         assert 'foo@site.example => bar@site.example' in log_line
         assert path_queue_log.read_text() == ''
 
+def test_mq_run_returns_error_code_if_relay_is_unavailable(tmp_path):
+    queue_basedir = str(tmp_path / 'mailqueue')
+    create_maildir_directories(queue_basedir)
+    for _ in range(3):
+        inject_example_message(queue_basedir)
+    config_path = create_ini('host.example', port=12345, dir_path=tmp_path)
+    with open(config_path, 'a') as fp:
+        fp.write('\ncircuit_breaker_threshold = 2\n')
+
+    cmd = ['mq-run', f'--config={config_path}', queue_basedir]
+    connection_failed = lambda *args: SendResult(False, phase='connect')
+    mailer = DebugMailer(send_callback=connection_failed)
+    with mock.patch('schwarz.mailqueue.queue_runner.init_smtp_mailer', new=lambda s: mailer):
+        rc = one_shot_queue_run_main(argv=cmd, return_rc_code=True)
+    assert rc == 75
+    assert len(tuple(find_messages(queue_basedir, log=l_(None)))) == 3
+
 
 
 @pytest.mark.skipif(SignalRegistry is None, reason='requires PuzzlePluginSystem')
@@ -2,7 +2,9 @@
 # SPDX-License-Identifier: MIT
 
 import os
+import time
 from datetime import datetime as DateTime, timedelta as TimeDelta
+from unittest import mock
 
 import pytest
 from boltons.timeutils import UTC
@@ -15,12 +17,18 @@ except ImportError:
 from testfixtures import LogCapture
 
 from schwarz.mailqueue import (
+    AIMDConcurrency,
+    CircuitBreaker,
     DebugMailer,
+    RetryPolicy,
+    SendResult,
     create_maildir_directories,
     lock_file,
+    queue_runner,
     send_all_queued_messages,
 )
-from schwarz.mailqueue.queue_runner import MaildirBackedMsg
+from schwarz.mailqueue.compat import IS_WINDOWS
+from schwarz.mailqueue.queue_runner import LeaseRenewer, MaildirBackedMsg, claim_messages
 from schwarz.mailqueue.testutils import inject_example_message
 
 
@@ -37,7 +45,9 @@ def test_can_move_stale_messages_back_to_new(path_maildir):
     mailer = DebugMailer()
     inject_example_message(path_maildir, target_folder='cur')
 
-    send_all_queued_messages(path_maildir, mailer)
+    # Windows: no message locks, claims expire after "lease_timeout"
+    with mock.patch.object(queue_runner, 'IS_WINDOWS', new=True):
+        send_all_queued_messages(path_maildir, mailer)
     assert len(mailer.sent_mails) == 0
     assert len(msg_files(path_maildir, folder='new')) == 0
     assert len(msg_files(path_maildir, folder='cur')) == 1
@@ -45,12 +55,51 @@ def test_can_move_stale_messages_back_to_new(path_maildir):
     dt_stale = DateTime.now() + TimeDelta(hours=1)
     # LogCapture: no logged warning about stale message on the command line
     with LogCapture():
-        with time_machine.travel(dt_stale):
+        with time_machine.travel(dt_stale), \
+                mock.patch.object(queue_runner, 'IS_WINDOWS', new=True):
             send_all_queued_messages(path_maildir, mailer)
     assert len(msg_files(path_maildir, folder='new')) == 0
     assert len(msg_files(path_maildir, folder='cur')) == 0
     assert len(mailer.sent_mails) == 1
 
+@pytest.mark.skipif(IS_WINDOWS, reason='requires file locking')
+def test_recovers_abandoned_messages_immediately(path_maildir):
+    mailer = DebugMailer()
+    # not locked: the process which claimed the message crashed
+    inject_example_message(path_maildir, target_folder='cur')
+
+    # LogCapture: no logged warning about stale message on the command line
+    with LogCapture():
+        send_all_queued_messages(path_maildir, mailer)
+    assert len(mailer.sent_mails) == 1
+    assert len(msg_files(path_maildir, folder='cur')) == 0
+
+@pytest.mark.skipif(IS_WINDOWS, reason='requires file locking')
+def test_never_recovers_messages_which_are_being_delivered(path_maildir):
+    mailer = DebugMailer()
+    msg = inject_example_message(path_maildir, target_folder='cur')
+    locked_msg = lock_file(msg.path, timeout=0.1)
+    # even if the lease was not renewed for a long time
+    one_day_ago = time.time() - 24 * 60 * 60
+    os.utime(msg.path, (one_day_ago, one_day_ago))
+
+    send_all_queued_messages(path_maildir, mailer)
+    assert len(mailer.sent_mails) == 0
+    assert msg_files(path_maildir, folder='cur') == [msg.path]
+    locked_msg.close()
+
+def test_lease_renewer_updates_claimed_messages(path_maildir):
+    msg = inject_example_message(path_maildir)
+    assert msg.start_delivery()
+    one_day_ago = time.time() - 24 * 60 * 60
+    os.utime(msg.fp.name, (one_day_ago, one_day_ago))
+
+    lease_renewer = LeaseRenewer(lease_timeout=60)
+    with lease_renewer.renewing(msg):
+        lease_renewer.renew_all()
+    assert os.stat(msg.fp.name).st_mtime > time.time() - 60
+    msg.fp.close()
+
 def test_can_handle_concurrent_sends(path_maildir):
     mailer = DebugMailer()
     msg = inject_example_message(path_maildir)
@@ -92,6 +141,188 @@ def test_can_handle_failures_and_update_metadata(path_maildir):
     time_since_last_attempt = DateTime.now(UTC) - msg.last_delivery_attempt
     assert abs(time_since_last_attempt) < TimeDelta(seconds=3)
 
+@pytest.mark.skipif(IS_WINDOWS, reason='no message locks on Windows')
+def test_rewrites_queue_data_without_releasing_the_lock(path_maildir):
+    inject_example_message(path_maildir)
+    msg_path, = msg_files(path_maildir, folder='new')
+    msg = MaildirBackedMsg(msg_path)
+    assert msg.start_delivery()
+    inode = os.stat(msg.fp.name).st_ino
+
+    msg.retries = 1
+    msg._rewrite_queue_data()
+    # the rewritten message replaced the original file
+    assert os.stat(msg.fp.name).st_ino != inode
+    assert msg_files(path_maildir, folder='tmp') == []
+    assert lock_file(msg.fp.name, timeout=0.1) is None
+    msg.fp.close()
+    assert MaildirBackedMsg(msg.fp.name).retries == 1
+
+def test_stops_queue_run_when_relay_is_unavailable(path_maildir):
+    for _ in range(10):
+        inject_example_message(path_maildir)
+    delivery_attempts = []
+    def connection_failure(*args):
+        delivery_attempts.append(args)
+        return SendResult(False, queued=False, transport='smtp', phase='connect')
+    mailer = DebugMailer(send_callback=connection_failure)
+    circuit_breaker = CircuitBreaker(failure_threshold=3)
+
+    # LogCapture: no logged error about the unavailable relay on the command line
+    with LogCapture():
+        was_completed = send_all_queued_messages(path_maildir, mailer,
+            circuit_breaker=circuit_breaker)
+    assert not was_completed
+    assert circuit_breaker.is_open
+    assert len(delivery_attempts) == 3
+    # messages which were not tried are left untouched
+    retries = [MaildirBackedMsg(path).retries for path in msg_files(path_maildir, folder='new')]
+    assert sorted(retries) == [0] * 7 + [1] * 3
+
+def test_circuit_breaker_ignores_rejected_messages(path_maildir):
+    for _ in range(5):
+        inject_example_message(path_maildir)
+    rejected = lambda *args: SendResult(False, smtp_code=550, phase='recipient')
+    mailer = DebugMailer(send_callback=rejected)
+
+    was_completed = send_all_queued_messages(path_maildir, mailer,
+        circuit_breaker=CircuitBreaker(failure_threshold=2))
+    assert was_completed
+    assert all(MaildirBackedMsg(p).retries == 1 for p in msg_files(path_maildir, folder='new'))
+
+@pytest.mark.parametrize('concurrency', [None, 3])
+def test_can_claim_messages_in_batches(path_maildir, concurrency):
+    for _ in range(10):
+        inject_example_message(path_maildir)
+    claim_folders = set()
+    def record_claim_folder(from_addr, to_addrs, msg_bytes):
+        claim_folders.update(os.listdir(os.path.join(path_maildir, 'cur')))
+        return SendResult(True, queued=False, transport='debug')
+    mailer = DebugMailer(send_callback=record_claim_folder)
+
+    send_all_queued_messages(path_maildir, mailer, claim_batch_size=4,
+        concurrency=AIMDConcurrency(concurrency) if concurrency else None)
+    assert len(mailer.sent_mails) == 10
+    assert msg_files(path_maildir, folder='new') == []
+    # claim folders are removed after the queue run
+    assert os.listdir(os.path.join(path_maildir, 'cur')) == []
+    assert 1 <= len(claim_folders) <= (concurrency or 1)
+
+def test_releases_claimed_messages_when_queue_run_stops(path_maildir):
+    for _ in range(10):
+        inject_example_message(path_maildir)
+    connection_failure = lambda *args: SendResult(False, transport='smtp', phase='connect')
+    mailer = DebugMailer(send_callback=connection_failure)
+
+    # LogCapture: no logged error about the unavailable relay on the command line
+    with LogCapture():
+        was_completed = send_all_queued_messages(path_maildir, mailer, claim_batch_size=4,
+            circuit_breaker=CircuitBreaker(failure_threshold=2))
+    assert not was_completed
+    assert os.listdir(os.path.join(path_maildir, 'cur')) == []
+    # claimed messages which were not tried are moved back without changes
+    retries = [MaildirBackedMsg(path).retries for path in msg_files(path_maildir, folder='new')]
+    assert sorted(retries) == [0] * 8 + [1] * 2
+
+@pytest.mark.parametrize('claim_mode', ['lock', 'lease'])
+def test_moves_undeliverable_messages_to_failed_folder(path_maildir, claim_mode):
+    for _ in range(3):
+        inject_example_message(path_maildir)
+    mailer = DebugMailer(simulate_failed_sending=True)
+    claim_batch_size = 2 if (claim_mode == 'lock') else 1
+
+    # LogCapture: no logged warnings about abandoned messages on the command line
+    with LogCapture():
+        send_all_queued_messages(path_maildir, mailer, claim_batch_size=claim_batch_size,
+            claim_mode=claim_mode, retry_policy=RetryPolicy(max_retries=1))
+    assert msg_files(path_maildir, folder='new') == []
+    assert os.listdir(os.path.join(path_maildir, 'cur')) == []
+    assert len(msg_files(path_maildir, folder='failed/new')) == 3
+
+def test_does_not_retry_permanently_rejected_messages(path_maildir):
+    for recipient in ('unknown@site.example', 'bar@site.example'):
+        inject_example_message(path_maildir, recipient=recipient)
+    def reject_unknown_user(from_addr, to_addrs, msg_bytes):
+        if to_addrs[0] == 'unknown@site.example':
+            return SendResult(False, smtp_code=550, phase='recipient')
+        return SendResult(False, smtp_code=451, phase='recipient')
+    mailer = DebugMailer(send_callback=reject_unknown_user)
+
+    # LogCapture: no logged warnings about abandoned messages on the command line
+    with LogCapture():
+        send_all_queued_messages(path_maildir, mailer, retry_policy=RetryPolicy())
+    failed_msgs = [MaildirBackedMsg(path) for path in msg_files(path_maildir, folder='failed/new')]
+    assert [msg.to_addrs for msg in failed_msgs] == [('unknown@site.example',)]
+    queued_msgs = [MaildirBackedMsg(path) for path in msg_files(path_maildir, folder='new')]
+    assert [msg.to_addrs for msg in queued_msgs] == [('bar@site.example',)]
+
+def test_claim_skips_messages_locked_by_other_processes(path_maildir):
+    msg_paths = [inject_example_message(path_maildir).path for _ in range(3)]
+    locked_msg = lock_file(msg_paths[1], timeout=0.1)
+
+    claimed = claim_messages(path_maildir, msg_paths, worker_id='worker1')
+    assert len(claimed) == 2
+    claim_path = os.path.join(path_maildir, 'cur', 'worker1')
+    assert sorted(msg.path for msg in claimed) == sorted(msg_files(claim_path, folder=''))
+    assert msg_files(path_maildir, folder='new') == [msg_paths[1]]
+    locked_msg.close()
+    for msg in claimed:
+        msg.release()
+    assert len(msg_files(path_maildir, folder='new')) == 3
+
+def test_can_recover_stale_messages_from_claim_folders(path_maildir):
+    msg_path = inject_example_message(path_maildir).path
+    claimed = claim_messages(path_maildir, [msg_path], worker_id='worker1')
+    # simulate crashed mq-run: lock is released but message is not moved back
+    claimed[0].fp.close()
+
+    mailer = DebugMailer()
+    # LogCapture: no logged warning about stale message on the command line
+    with LogCapture():
+        with mock.patch.object(queue_runner, 'is_stale_msg', new=lambda *args, **kwargs: True):
+            send_all_queued_messages(path_maildir, mailer)
+    assert len(mailer.sent_mails) == 1
+    assert os.listdir(os.path.join(path_maildir, 'cur')) == []
+
+@pytest.mark.skipif(IS_WINDOWS, reason='claim folders of active workers are only detected on Unix')
+def test_keeps_empty_claim_folders_of_active_workers(path_maildir):
+    active_worker = queue_runner._worker_id(1)
+    crashed_worker = '%s.%d.1' % (queue_runner._worker_hostname(), _unused_pid())
+    for worker_id in (active_worker, crashed_worker):
+        os.makedirs(os.path.join(path_maildir, 'cur', worker_id))
+
+    queue_runner.unblock_stale_messages(path_maildir, log=mock.Mock())
+    assert os.listdir(os.path.join(path_maildir, 'cur')) == [active_worker]
+
+def test_claim_messages_recreates_removed_claim_folder(path_maildir):
+    msg_path = inject_example_message(path_maildir).path
+    claim_folder = os.path.join(path_maildir, 'cur', 'worker1')
+    real_move_message = queue_runner.move_message
+    nr_moves = []
+    def move_after_folder_removal(*args, **kwargs):
+        # another runner removed the (empty) claim folder in the meantime
+        if not nr_moves:
+            os.rmdir(claim_folder)
+        nr_moves.append(1)
+        return real_move_message(*args, **kwargs)
+
+    with mock.patch.object(queue_runner, 'move_message', new=move_after_folder_removal):
+        claimed = claim_messages(path_maildir, [msg_path], worker_id='worker1')
+    assert len(claimed) == 1
+    claimed[0].release()
+    assert len(msg_files(path_maildir, folder='new')) == 1
+
+def _unused_pid():
+    pid = 2 ** 22
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return pid
+        except PermissionError:
+            pass
+        pid -= 1
+
 def msg_files(path_maildir, folder='new'):
     path = os.path.join(path_maildir, folder)
     files = []
@@ -99,3 +330,31 @@ def msg_files(path_maildir, folder='new'):
         file_path = os.path.join(path, filename)
         files.append(file_path)
     return files
+
+@pytest.mark.parametrize('claim_mode', ['lock', 'lease'])
+def test_requeues_message_for_refused_recipients(path_maildir, claim_mode):
+    recipients = (b'bar@site.example', b'baz@site.example', b'qux@site.example')
+    inject_example_message(path_maildir, recipients=recipients)
+    def refuse_recipients(from_addr, to_addrs, msg_bytes):
+        refused_recipients = {'baz@site.example': (450, 'mailbox busy')}
+        if 'qux@site.example' in to_addrs:
+            refused_recipients['qux@site.example'] = (550, 'user unknown')
+        if len(refused_recipients) == len(to_addrs):
+            return SendResult(False, smtp_code=450, phase='recipient',
+                refused_recipients=refused_recipients)
+        return SendResult(True, queued=False, transport='smtp',
+            refused_recipients=refused_recipients)
+    mailer = DebugMailer(send_callback=refuse_recipients)
+
+    send_all_queued_messages(path_maildir, mailer, claim_mode=claim_mode,
+        retry_policy=RetryPolicy())
+    queued_msg, = [MaildirBackedMsg(path) for path in msg_files(path_maildir, folder='new')]
+    assert queued_msg.to_addrs == ('baz@site.example',)
+    assert queued_msg.retries == 1
+
+    # still refused: the message stays in the queue
+    send_all_queued_messages(path_maildir, mailer, claim_mode=claim_mode,
+        retry_policy=RetryPolicy())
+    queued_msg, = [MaildirBackedMsg(path) for path in msg_files(path_maildir, folder='new')]
+    assert queued_msg.to_addrs == ('baz@site.example',)
+    assert queued_msg.retries == 2
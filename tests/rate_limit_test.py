@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import pytest
+
+from schwarz.mailqueue import SMTPMailer, TokenBucket
+from schwarz.mailqueue.testutils import FakeClock, fake_smtp_client
+
+
+def test_token_bucket_allows_initial_burst_then_paces():
+    fake_time = FakeClock()
+    bucket = TokenBucket(2, period=1, clock=fake_time, sleep=fake_time.sleep)
+    for _ in range(6):
+        bucket.acquire()
+    assert fake_time.sleeps[:1] == [0.5]
+    # burst of 2 (capacity) and then 2 tokens per second
+    assert fake_time.now - 100 == pytest.approx(2.0)
+
+def test_token_bucket_refills_up_to_capacity():
+    fake_time = FakeClock()
+    bucket = TokenBucket(10, period=60, clock=fake_time, sleep=fake_time.sleep)
+    bucket.acquire(10)
+    assert bucket.tokens == 0
+    fake_time.now += 30
+    assert bucket.tokens == pytest.approx(5)
+    fake_time.now += 3600
+    assert bucket.tokens == 10
+
+def test_token_bucket_can_handle_requests_larger_than_capacity():
+    fake_time = FakeClock()
+    bucket = TokenBucket(100, period=60, clock=fake_time, sleep=fake_time.sleep)
+    assert bucket.acquire(250) == 0
+    # the next request has to wait until the debt (150 tokens) is paid
+    assert bucket.acquire(1) == pytest.approx(151 * 0.6)
+
+def test_token_bucket_does_not_wait_longer_than_max_wait():
+    fake_time = FakeClock()
+    bucket = TokenBucket(1, period=60, clock=fake_time, sleep=fake_time.sleep)
+    assert bucket.acquire(1, max_wait=5) == 0
+    assert bucket.acquire(1, max_wait=5) is None
+    assert fake_time.sleeps == []
+    # no tokens were taken
+    assert bucket.acquire(1, max_wait=60) == pytest.approx(60)
+
+def test_token_bucket_can_release_tokens():
+    fake_time = FakeClock()
+    bucket = TokenBucket(2, period=60, clock=fake_time, sleep=fake_time.sleep)
+    bucket.acquire(2)
+    bucket.release(1)
+    assert bucket.tokens == 1
+    # never more than "capacity" tokens
+    bucket.release(5)
+    assert bucket.tokens == 2
+
+def test_smtp_mailer_fails_fast_if_rate_limit_exceeds_deadline():
+    fake_time = FakeClock()
+    fake_client = fake_smtp_client()
+    mailer = SMTPMailer(client=fake_client, max_messages_per_second=1)
+    mailer.message_rate = TokenBucket(1, period=60, clock=fake_time, sleep=fake_time.sleep)
+    message = b'Header: value\n\nbody\n'
+
+    assert mailer.send('foo@site.example', 'bar@site.example', message)
+    send_result = mailer.send('foo@site.example', 'bar@site.example', message, deadline=5)
+    # the caller can queue the message immediately
+    assert not send_result
+    assert send_result.phase is None
+    assert fake_time.sleeps == []
+    assert fake_client.server.received_messages.qsize() == 1
+
+def test_smtp_mailer_respects_recipient_rate_limit():
+    fake_time = FakeClock()
+    mailer = SMTPMailer(client=fake_smtp_client(), max_recipients_per_minute='2')
+    assert mailer.message_rate is None
+    assert mailer.recipient_rate.rate == 2
+    mailer.recipient_rate = TokenBucket(2, period=60, clock=fake_time, sleep=fake_time.sleep)
+    recipients = ('bar@site.example', 'baz@site.example')
+    message = b'Header: value\n\nbody\n'
+
+    assert mailer.send('foo@site.example', recipients, message)
+    assert fake_time.sleeps == []
+    mailer._client = fake_smtp_client()
+    assert mailer.send('foo@site.example', recipients, message)
+    assert fake_time.sleeps == [pytest.approx(60)]
+
+def test_smtp_mailer_does_not_use_up_message_rate_if_recipient_rate_exceeds_deadline():
+    fake_time = FakeClock()
+    mailer = SMTPMailer(client=fake_smtp_client())
+    mailer.message_rate = TokenBucket(1, period=60, clock=fake_time, sleep=fake_time.sleep)
+    mailer.recipient_rate = TokenBucket(1, period=60, clock=fake_time, sleep=fake_time.sleep)
+    recipients = ('bar@site.example', 'baz@site.example')
+    message = b'Header: value\n\nbody\n'
+
+    mailer.recipient_rate.acquire(1)
+    send_result = mailer.send('foo@site.example', recipients, message, deadline=5)
+    assert not send_result
+    assert fake_time.sleeps == []
+    # the message token was returned to the bucket
+    assert mailer.message_rate.tokens == 1
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import socket
+
+import pytest
+from dotmap import DotMap
+
+from schwarz.mailqueue import (
+    DebugMailer,
+    Relay,
+    RelayPool,
+    SendResult,
+    SMTPMailer,
+    init_smtp_mailer,
+)
+from schwarz.mailqueue.relay_pool import parse_relays
+from schwarz.mailqueue.testutils import FakeClock, IsolatedSMTPTestHelper
+
+
+@pytest.fixture
+def ctx():
+    mta_helpers = [IsolatedSMTPTestHelper() for _ in range(2)]
+    for mta_helper in mta_helpers:
+        mta_helper.start_mta()
+    try:
+        yield DotMap(_dynamic=False, mtas=mta_helpers)
+    finally:
+        for mta_helper in mta_helpers:
+            mta_helper.stop_mta()
+
+
+def test_can_parse_relays():
+    relays_str = 'mx1.example:587:3, mx2.example\n mx3.example::2'
+    assert parse_relays(relays_str) == [
+        ('mx1.example', 587, 3),
+        ('mx2.example', None, 1),
+        ('mx3.example', None, 2),
+    ]
+
+def test_distributes_messages_by_weight():
+    mailers = [DebugMailer(), DebugMailer()]
+    relays = [Relay(mailers[0], weight=3, name='a'), Relay(mailers[1], weight=1, name='b')]
+    pool = RelayPool(relays)
+    for _ in range(8):
+        assert pool.send('foo@site.example', ('bar@site.example',), b'msg')
+    assert len(mailers[0].sent_mails) == 6
+    assert len(mailers[1].sent_mails) == 2
+
+def test_takes_failing_relay_out_of_rotation():
+    clock = FakeClock()
+    connection_failure = lambda *args: SendResult(False, transport='smtp', phase='connect')
+    broken_mailer = DebugMailer(send_callback=connection_failure)
+    mailer = DebugMailer()
+    relays = [Relay(broken_mailer, name='broken'), Relay(mailer, name='ok')]
+    pool = RelayPool(relays, max_failures=2, retry_after=60, clock=clock)
+
+    for _ in range(6):
+        # failover: every message is delivered even if a relay fails
+        assert pool.send('foo@site.example', ('bar@site.example',), b'msg')
+    assert len(mailer.sent_mails) == 6
+    assert [r.name for r in pool.healthy_relays()] == ['ok']
+    # "DebugMailer" records only successful deliveries so use the number
+    # of failures to check that the broken relay is not used anymore.
+    assert relays[0].consecutive_failures == 2
+
+    clock.now += 61
+    assert len(pool.healthy_relays()) == 2
+    broken_mailer.send_callback = None
+    for _ in range(2):
+        pool.send('foo@site.example', ('bar@site.example',), b'msg')
+    assert len(broken_mailer.sent_mails) == 1
+    assert relays[0].consecutive_failures == 0
+
+def test_refused_recipient_does_not_affect_relay_health():
+    clock = FakeClock()
+    mailers = [DebugMailer(), DebugMailer()]
+    refuse_rcpt = lambda *args: SendResult(False, smtp_code=550, phase='recipient')
+    for mailer in mailers:
+        mailer.send_callback = refuse_rcpt
+    relays = [Relay(mailers[0], name='a'), Relay(mailers[1], name='b')]
+    pool = RelayPool(relays, max_failures=2, retry_after=60, clock=clock)
+
+    for _ in range(3):
+        send_result = pool.send('foo@site.example', ('unknown@site.example',), b'msg')
+        # no failover: the other relay would refuse the recipient as well
+        assert not send_result
+        assert send_result.phase == 'recipient'
+    assert len(pool.healthy_relays()) == 2
+    assert [r.consecutive_failures for r in relays] == [0, 0]
+
+    for mailer in mailers:
+        mailer.send_callback = None
+    assert pool.send('foo@site.example', ('bar@site.example',), b'msg')
+
+def test_mailer_failures_without_phase_do_not_affect_relay_health():
+    # e.g. "SMTPMailer" did not connect because of its rate limits
+    not_sent = lambda *args: SendResult(False, transport='smtp')
+    relays = [Relay(DebugMailer(send_callback=not_sent), name='a'), Relay(DebugMailer(), name='b')]
+    pool = RelayPool(relays, max_failures=1, clock=FakeClock())
+
+    send_result = pool.send('foo@site.example', ('bar@site.example',), b'msg')
+    assert not send_result
+    assert len(pool.healthy_relays()) == 2
+    assert relays[1].mailer.sent_mails == []
+
+@pytest.mark.parametrize('weight', [0, -1])
+def test_rejects_invalid_relay_weights(weight):
+    with pytest.raises(ValueError):
+        Relay(DebugMailer(), weight=weight, name='a')
+    with pytest.raises(ValueError):
+        parse_relays('mx1.example:587:%d' % weight)
+
+def test_can_prefer_relay_with_fewer_outstanding_deliveries():
+    relays = [Relay(DebugMailer(), name='busy'), Relay(DebugMailer(), name='idle')]
+    pool = RelayPool(relays, balancing='least-outstanding')
+    relays[0].outstanding = 2
+    assert pool._acquire_relay() is relays[1]
+
+def test_can_deliver_via_multiple_smtp_servers(ctx):
+    unused_port = _unused_port()
+    relays = ['localhost:%d:1' % unused_port]
+    relays += ['%s:%d:1' % (mta.hostname, mta.listen_port) for mta in ctx.mtas]
+    settings = {'smtp_relays': ', '.join(relays), 'smtp_relay_max_failures': '1'}
+    pool = init_smtp_mailer(settings)
+    assert isinstance(pool, RelayPool)
+    assert all(isinstance(relay.mailer, SMTPMailer) for relay in pool.relays)
+
+    for _ in range(4):
+        assert pool.send('foo@site.example', ('bar@site.example',), b'Header: value\n\nbody\n')
+    received = [mta.get_received_messages().qsize() for mta in ctx.mtas]
+    assert sum(received) == 4
+    assert min(received) >= 1
+    assert len(pool.healthy_relays()) == 2
+
+
+# --- internal helpers ----------------------------------------------------
+def _unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
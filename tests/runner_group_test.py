@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import os
+from unittest import mock
+
+import pytest
+
+from schwarz.mailqueue import DebugMailer, create_maildir_directories, send_all_queued_messages
+from schwarz.mailqueue.cli import one_shot_queue_run_main
+from schwarz.mailqueue.compat import IS_WINDOWS
+from schwarz.mailqueue.runner_group import RunnerGroup
+from schwarz.mailqueue.testutils import create_ini, inject_example_message
+
+
+pytestmark = pytest.mark.skipif(IS_WINDOWS, reason='requires file locking')
+
+@pytest.fixture
+def path_maildir(tmp_path):
+    _path_maildir = os.path.join(str(tmp_path), 'mailqueue')
+    create_maildir_directories(_path_maildir)
+    return _path_maildir
+
+def msg_files(path_maildir, folder='new'):
+    return os.listdir(os.path.join(path_maildir, folder))
+
+
+def test_runners_detect_each_other(path_maildir):
+    with RunnerGroup(path_maildir) as runner1:
+        assert runner1.active_runners() == (runner1.runner_id,)
+        with RunnerGroup(path_maildir) as runner2:
+            assert runner1.active_runners() == (runner1.runner_id, runner2.runner_id)
+            assert runner1.started_first()
+            assert not runner2.started_first()
+        assert runner1.active_runners() == (runner1.runner_id,)
+    assert os.listdir(os.path.join(path_maildir, 'runners')) == []
+
+def test_removes_files_of_crashed_runners(path_maildir):
+    crashed_runner = RunnerGroup(path_maildir).join()
+    # lock is released when the process dies
+    crashed_runner._lock.release()
+
+    with RunnerGroup(path_maildir) as runner:
+        assert runner.active_runners() == (runner.runner_id,)
+    assert os.listdir(os.path.join(path_maildir, 'runners')) == []
+
+def test_runners_partition_messages(path_maildir):
+    msg_paths = [inject_example_message(path_maildir).path for _ in range(20)]
+    with RunnerGroup(path_maildir) as runner1, RunnerGroup(path_maildir) as runner2:
+        runner1.refresh()
+        owned_by_1 = set(p for p in msg_paths if runner1.owns(p))
+        owned_by_2 = set(p for p in msg_paths if runner2.owns(p))
+    assert owned_by_1 and owned_by_2
+    assert owned_by_1.isdisjoint(owned_by_2)
+    assert (owned_by_1 | owned_by_2) == set(msg_paths)
+
+def test_queue_run_only_delivers_own_messages(path_maildir):
+    for _ in range(20):
+        inject_example_message(path_maildir)
+    mailer = DebugMailer()
+    with RunnerGroup(path_maildir) as other_runner, RunnerGroup(path_maildir) as runner:
+        send_all_queued_messages(path_maildir, mailer, runner_group=runner)
+        assert 0 < len(mailer.sent_mails) < 20
+        assert all(other_runner.owns(p) for p in msg_files(path_maildir))
+
+def test_queue_run_delivers_messages_of_stopped_runners(path_maildir):
+    for _ in range(20):
+        inject_example_message(path_maildir)
+    other_runner = RunnerGroup(path_maildir).join()
+    runner = RunnerGroup(path_maildir, refresh_interval=3600).join()
+    def stop_other_runner(*args):
+        # the other runner finishes while this runner is still active
+        other_runner.leave()
+        return True
+    mailer = DebugMailer(send_callback=stop_other_runner)
+
+    send_all_queued_messages(path_maildir, mailer, runner_group=runner)
+    runner.leave()
+    assert len(mailer.sent_mails) == 20
+    assert msg_files(path_maildir) == []
+
+@pytest.mark.parametrize('concurrent_runs', ['exit', 'share'])
+def test_mq_run_with_other_active_runner(path_maildir, tmp_path, concurrent_runs):
+    for _ in range(20):
+        inject_example_message(path_maildir)
+    config_path = create_ini('host.example', port=12345, dir_path=tmp_path)
+    with open(config_path, 'a') as fp:
+        fp.write('\nconcurrent_runs = %s\n' % concurrent_runs)
+    mailer = DebugMailer()
+
+    cmd = ['mq-run', f'--config={config_path}', path_maildir]
+    with RunnerGroup(path_maildir):
+        with mock.patch('schwarz.mailqueue.queue_runner.init_smtp_mailer', new=lambda s: mailer):
+            rc = one_shot_queue_run_main(argv=cmd, return_rc_code=True)
+    assert rc == 0
+    if concurrent_runs == 'exit':
+        assert mailer.sent_mails == []
+    else:
+        assert 0 < len(mailer.sent_mails) < 20
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+
+import logging
+import os
+from unittest import mock
+
+import pytest
+
+from schwarz.mailqueue import (
+    DebugMailer,
+    MaildirBackend,
+    QueueShards,
+    enqueue_message,
+    enqueue_messages,
+    parse_queue_dirs,
+)
+from schwarz.mailqueue.cli import one_shot_queue_run_main
+from schwarz.mailqueue.queue_runner import MaildirBackedMsg
+from schwarz.mailqueue.testutils import create_ini, message
+
+
+@pytest.fixture
+def queue_dirs(tmp_path):
+    return tuple(os.path.join(str(tmp_path), 'queue%d' % i) for i in range(3))
+
+def msg_files(queue_dir, folder='new'):
+    path_folder = os.path.join(queue_dir, folder)
+    if not os.path.exists(path_folder):
+        return []
+    return os.listdir(path_folder)
+
+log = logging.getLogger('mailqueue.test')
+
+
+def test_parse_queue_dirs():
+    assert parse_queue_dirs('/var/mq') == ('/var/mq',)
+    assert parse_queue_dirs('/disk1/mq, /disk2/mq\n/disk3/mq') == ('/disk1/mq', '/disk2/mq', '/disk3/mq')  # noqa: E501 (line too long)
+    assert parse_queue_dirs(['/disk1/mq', '/disk1/mq', '/disk2/mq']) == ('/disk1/mq', '/disk2/mq')
+    assert parse_queue_dirs(QueueShards(['/disk1/mq'])) == ('/disk1/mq',)
+
+def test_routes_messages_consistently():
+    shards = QueueShards(['/disk1/mq', '/disk2/mq', '/disk3/mq'])
+    reordered = QueueShards(['/disk3/mq', '/disk1/mq', '/disk2/mq'])
+    msg_keys = ['<%d@site.example>' % i for i in range(300)]
+
+    targets = [shards.shard_for_message(msg_key) for msg_key in msg_keys]
+    assert targets == [reordered.shard_for_message(msg_key) for msg_key in msg_keys]
+    assert set(targets) == set(shards.queue_dirs)
+
+def message_with_id(msg_id):
+    msg = message()
+    msg['Message-ID'] = '<%s>' % msg_id
+    return msg
+
+@pytest.mark.parametrize('with_msg_id', [True, False])
+def test_spreads_messages_for_the_same_recipients_over_all_shards(queue_dirs, with_msg_id):
+    def _message(i):
+        return message_with_id('%d@site.example' % i) if with_msg_id else message()
+    messages = [(_message(i), 'foo@site.example', ['hot@site.example']) for i in range(60)]
+    enqueue_messages(messages, queue_dirs)
+    for i in range(60, 120):
+        enqueue_message(_message(i), queue_dirs, 'foo@site.example', ['hot@site.example'])
+
+    nr_messages = [len(msg_files(queue_dir)) for queue_dir in queue_dirs]
+    assert sum(nr_messages) == 120
+    assert min(nr_messages) > 10
+
+def test_routes_messages_by_message_id(queue_dirs):
+    shards = QueueShards(queue_dirs)
+    msg_ids = ['%d@site.example' % i for i in range(10)]
+    messages = [(message_with_id(msg_id), 'foo@site.example', ['bar@site.example']) for msg_id in msg_ids]  # noqa: E501 (line too long)
+    msg_paths = enqueue_messages(messages, queue_dirs)
+    for msg_id, msg_path in zip(msg_ids, msg_paths):
+        expected_dir = shards.shard_for('<%s>' % msg_id)
+        assert os.path.dirname(os.path.dirname(msg_path)) == expected_dir
+        msg_path = enqueue_message(message_with_id(msg_id), queue_dirs, 'foo@site.example',
+            ['bar@site.example'])
+        assert os.path.dirname(os.path.dirname(msg_path)) == expected_dir
+
+def test_adding_a_shard_moves_few_messages():
+    shards = QueueShards(['/disk1/mq', '/disk2/mq', '/disk3/mq'])
+    more_shards = QueueShards(['/disk1/mq', '/disk2/mq', '/disk3/mq', '/disk4/mq'])
+    keys = ['user%d@site.example' % i for i in range(4000)]
+
+    moved = [key for key in keys if shards.shard_for(key) != more_shards.shard_for(key)]
+    # ideally 1/4 of all messages, all of them moved to the new shard
+    assert 0.15 < (len(moved) / len(keys)) < 0.35
+    assert set(more_shards.shard_for(key) for key in moved) == {'/disk4/mq'}
+
+def test_enqueue_message_into_shards(queue_dirs):
+    shards = QueueShards(queue_dirs)
+    for i in range(30):
+        recipient = 'user%d@site.example' % i
+        msg_path = enqueue_message(message(), list(queue_dirs), 'foo@site.example', [recipient])
+        assert os.path.dirname(os.path.dirname(msg_path)) in queue_dirs
+
+    assert sum(len(msg_files(queue_dir)) for queue_dir in queue_dirs) == 30
+    assert len(list(shards.find_messages(log))) == 30
+    assert shards.message_counts() == {'new': 30, 'cur': 0}
+
+def test_enqueue_messages_into_shards(queue_dirs):
+    recipients = ['user%d@site.example' % i for i in range(30)]
+    # messages are stored as they arrive (generator is consumed only once)
+    messages = ((message(), 'foo@site.example', [recipient]) for recipient in recipients)
+    msg_paths = enqueue_messages(messages, queue_dirs)
+
+    shards = QueueShards(queue_dirs)
+    assert len(msg_paths) == 30
+    # paths are returned in the order of the messages
+    for recipient, msg_path in zip(recipients, msg_paths):
+        assert os.path.dirname(os.path.dirname(msg_path)) in queue_dirs
+        assert MaildirBackedMsg(msg_path).to_addrs == (recipient,)
+    assert shards.message_counts() == {'new': 30, 'cur': 0}
+
+def test_maildir_backend_with_shards(queue_dirs):
+    backend = MaildirBackend(queue_dirs)
+    for i in range(10):
+        backend.send('foo@site.example', ['user%d@site.example' % i], message())
+
+    shards = QueueShards(queue_dirs)
+    assert backend.queue_path == shards
+    assert shards.message_counts()['new'] == 10
+    assert len([queue_dir for queue_dir in queue_dirs if msg_files(queue_dir)]) > 1
+
+def test_mq_run_delivers_messages_from_all_shards(queue_dirs, tmp_path):
+    for i in range(20):
+        enqueue_message(message(), queue_dirs, 'foo@site.example', ['user%d@site.example' % i])
+    config_path = create_ini('host.example', port=12345, dir_path=tmp_path)
+    with open(config_path, 'a') as fp:
+        fp.write('\nqueue_dir = %s\n' % ', '.join(queue_dirs))
+    mailer = DebugMailer()
+
+    cmd = ['mq-run', f'--config={config_path}']
+    with mock.patch('schwarz.mailqueue.queue_runner.init_smtp_mailer', new=lambda s: mailer):
+        rc = one_shot_queue_run_main(argv=cmd, return_rc_code=True)
+    assert rc == 0
+    assert len(mailer.sent_mails) == 20
+    assert QueueShards(queue_dirs).message_counts() == {'new': 0, 'cur': 0}
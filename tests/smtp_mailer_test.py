@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 # SPDX-License-Identifier: MIT
 
+import logging
 import socket
+import ssl
+import threading
+import time
+from unittest import mock
 
 import pytest
 from pymta.api import IMTAPolicy
 from pymta.test_util import DummyAuthenticator
 from schwarz.log_utils.testutils import build_collecting_logger
+from testfixtures import LogCapture
 
-from schwarz.mailqueue import SMTPMailer
+from schwarz.mailqueue import SMTPMailer, build_ssl_context
 from schwarz.mailqueue.testutils import SocketMock, fake_smtp_client, stub_socket_creation
 
 
@@ -49,6 +55,7 @@ def test_can_handle_connection_error():
         msg_was_sent = mailer.send('foo@site.example', 'bar@site.example', message)
 
     assert not msg_was_sent
+    assert msg_was_sent.phase == 'connect'
     assert fake_client.server.received_messages.qsize() == 0
     assert len(logs.buffer) == 1
     expected_msg = '%s (%s)' % (str(exc), exc.__class__.__name__)
@@ -63,7 +70,109 @@ def test_can_handle_smtp_exception_after_from():
     msg_was_sent = mailer.send('foo@site.example', 'bar@site.example', message)
 
     assert not msg_was_sent
+    assert msg_was_sent.phase == 'sender'
+    assert msg_was_sent.smtp_code == 550
     assert fake_client.server.received_messages.qsize() == 0
+    # connection state is unknown after a failure
+    assert fake_client.sock is None
+
+def test_returns_smtp_reply_for_rejected_recipient():
+    reject_rcpt = _build_policy(accept_rcpt_to=False)
+    fake_client = fake_smtp_client(policy=reject_rcpt)
+    mailer = SMTPMailer(client=fake_client)
+    message = b'Header: value\n\nbody\n'
+    msg_was_sent = mailer.send('foo@site.example', 'bar@site.example', message)
+
+    assert not msg_was_sent
+    assert msg_was_sent.phase == 'recipient'
+    assert msg_was_sent.smtp_code == 550
+    assert msg_was_sent.smtp_reply
+    assert fake_client.server.received_messages.qsize() == 0
+
+def test_can_deliver_message_to_accepted_recipients():
+    policy = _build_rcpt_policy({
+        'baz@site.example': (450, 'mailbox busy'),
+        'qux@site.example': (550, 'user unknown'),
+    })
+    fake_client = fake_smtp_client(policy=policy)
+    mailer = SMTPMailer(client=fake_client, partial_delivery=True)
+    message = b'Header: value\n\nbody\n'
+    recipients = ('bar@site.example', 'baz@site.example', 'qux@site.example')
+    msg_was_sent = mailer.send('foo@site.example', recipients, message)
+
+    assert msg_was_sent
+    assert msg_was_sent.refused_recipients == {
+        'baz@site.example': (450, 'mailbox busy'),
+        'qux@site.example': (550, 'user unknown'),
+    }
+    assert fake_client.server.received_messages.qsize() == 1
+    received_msg = fake_client.server.received_messages.get()
+    assert received_msg.smtp_to == ['bar@site.example']
+
+def test_partial_delivery_fails_if_all_recipients_were_refused():
+    policy = _build_rcpt_policy({
+        'bar@site.example': (550, 'user unknown'),
+        'baz@site.example': (450, 'mailbox busy'),
+    })
+    fake_client = fake_smtp_client(policy=policy)
+    mailer = SMTPMailer(client=fake_client, partial_delivery=True)
+    message = b'Header: value\n\nbody\n'
+    recipients = ('bar@site.example', 'baz@site.example')
+    msg_was_sent = mailer.send('foo@site.example', recipients, message)
+
+    assert not msg_was_sent
+    assert msg_was_sent.phase == 'recipient'
+    # temporary failure: the message can be delivered later
+    assert msg_was_sent.smtp_code == 450
+    assert set(msg_was_sent.refused_recipients) == {'bar@site.example', 'baz@site.example'}
+    assert fake_client.server.received_messages.qsize() == 0
+
+def test_sends_large_recipient_lists_in_batches():
+    fake_client = fake_smtp_client()
+    mailer = SMTPMailer(client=fake_client, max_recipients=2)
+    message = b'Header: value\n\nbody\n'
+    recipients = ['user%d@site.example' % i for i in range(5)]
+    msg_was_sent = mailer.send('foo@site.example', recipients, message)
+
+    assert msg_was_sent
+    assert not msg_was_sent.refused_recipients
+    received_msgs = _received_messages(fake_client)
+    assert [msg.smtp_to for msg in received_msgs] == [recipients[:2], recipients[2:4], recipients[4:]]  # noqa: E501 (line too long)
+
+def test_learns_recipient_limit_from_server_reply():
+    fake_client = fake_smtp_client(policy=_build_rcpt_limit_policy(3))
+    mailer = SMTPMailer(client=fake_client)
+    message = b'Header: value\n\nbody\n'
+    recipients = ['user%d@site.example' % i for i in range(7)]
+    msg_was_sent = mailer.send('foo@site.example', recipients, message)
+
+    assert msg_was_sent
+    assert not msg_was_sent.refused_recipients
+    received_msgs = _received_messages(fake_client)
+    assert [msg.smtp_to for msg in received_msgs] == [recipients[:3], recipients[3:6], recipients[6:]]  # noqa: E501 (line too long)
+    assert mailer.max_recipients == 3
+
+def test_refuses_only_recipients_of_failed_batches():
+    class RejectSecondMessage(IMTAPolicy):
+        nr_messages = 0
+        def accept_data(self, message):
+            RejectSecondMessage.nr_messages += 1
+            if RejectSecondMessage.nr_messages == 2:
+                return (False, (451, 'try again later'))
+            return True
+    fake_client = fake_smtp_client(policy=RejectSecondMessage())
+    mailer = SMTPMailer(client=fake_client, max_recipients=2, keep_alive=True)
+    message = b'Header: value\n\nbody\n'
+    recipients = ['user%d@site.example' % i for i in range(5)]
+    msg_was_sent = mailer.send('foo@site.example', recipients, message)
+
+    assert msg_was_sent
+    assert set(msg_was_sent.refused_recipients) == set(recipients[2:])
+    assert msg_was_sent.refused_recipients['user2@site.example'][0] == 451
+    received_msgs = _received_messages(fake_client)
+    assert [msg.smtp_to for msg in received_msgs] == [recipients[:2]]
+    # the connection was closed after the failed batch: not reused
+    assert len(mailer.pool) == 0
 
 
 @pytest.mark.parametrize('auth_type', ['PLAIN', 'LOGIN'])
@@ -82,7 +191,147 @@ def test_can_use_smtp_auth(auth_type):
     received_queue = fake_client.server.received_messages
     assert received_queue.qsize() == 1
 
+def test_reuses_ssl_context_and_tls_session():
+    mailer = SMTPMailer('site.invalid', tls_min_version='TLSv1.2')
+    assert mailer.ssl_context is build_ssl_context(min_version='TLSv1.2')
+    assert mailer.ssl_context.minimum_version == ssl.TLSVersion.TLSv1_2
+    message = b'Header: value\n\nbody\n'
+
+    tls_sessions = []
+    for _ in range(2):
+        fake_client = _fake_starttls_client(tls_sessions)
+        mailer._client = fake_client
+        assert mailer.send('foo@site.example', 'bar@site.example', message)
+        _, starttls_kwargs = fake_client.starttls.call_args
+        assert starttls_kwargs['context'] is mailer.ssl_context
+    first_session, second_session = tls_sessions
+    # second connection should try to resume the TLS session from the first one
+    assert fake_client.starttls.call_args[1]['session'] is first_session
+    assert mailer._tls_session is second_session
+
+
+def test_can_use_implicit_tls():
+    assert SMTPMailer('site.invalid', tls='implicit').port == 465
+    with pytest.raises(ValueError):
+        SMTPMailer('site.invalid', tls='invalid')
+
+    ssl_context = mock.Mock(spec=ssl.SSLContext)
+    ssl_context.wrap_socket.side_effect = lambda sock, **kwargs: sock
+    smtp_log = logging.getLogger('s')
+    with LogCapture() as lc:
+        fake_client = fake_smtp_client(ssl_context=ssl_context, smtp_log=smtp_log)
+        fake_client.starttls = mock.MagicMock()
+        mailer = SMTPMailer(client=fake_client, tls='implicit')
+        message = b'Header: value\n\nbody\n'
+        assert mailer.send('foo@site.example', 'bar@site.example', message)
+
+    _, wrap_kwargs = ssl_context.wrap_socket.call_args
+    assert wrap_kwargs['server_hostname'] == 'site.invalid'
+    fake_client.starttls.assert_not_called()
+    log_messages = [record.getMessage() for record in lc.records]
+    assert log_messages[0] == 'connecting to site.invalid:123 (implicit TLS)'
+    # implicit TLS saves two round trips per connection ("STARTTLS", second "EHLO")
+    smtp_commands = [msg[3:].split(' ', 1)[0] for msg in log_messages if msg.startswith('=> ')]
+    assert smtp_commands[:3] == ['ehlo', 'mail', 'rcpt']
+
+def test_aborts_smtp_session_after_deadline():
+    port, server_thread = _slow_smtp_server(banner_delay=1)
+    mailer = SMTPMailer('127.0.0.1', port=port)
+    start = time.monotonic()
+    send_result = mailer.send('foo@site.example', ('bar@site.example',), b'Header: value\n\nbody\n',
+        deadline=0.2)
+    assert not send_result
+    assert send_result.phase == 'connect'
+    assert time.monotonic() - start < 0.8
+    server_thread.join()
+
+def test_can_use_deadline_with_custom_client():
+    class CustomClient(object):
+        # client without deadline support ("set_deadline()")
+        def __init__(self, client):
+            self._client = client
+        def __getattr__(self, name):
+            if name == 'set_deadline':
+                raise AttributeError(name)
+            return getattr(self._client, name)
+    fake_client = fake_smtp_client()
+    mailer = SMTPMailer(client=CustomClient(fake_client))
+    message = b'Header: value\n\nbody\n'
+    assert mailer.send('foo@site.example', 'bar@site.example', message, deadline=10)
+    assert fake_client.server.received_messages.qsize() == 1
+
+def test_deadline_does_not_abort_after_message_was_transmitted():
+    port, server_thread = _slow_smtp_server(final_reply_delay=0.5)
+    mailer = SMTPMailer('127.0.0.1', port=port)
+    send_result = mailer.send('foo@site.example', ('bar@site.example',), b'Header: value\n\nbody\n',
+        deadline=0.2)
+    # aborting now would lead to duplicate messages if the caller queues
+    # the message after a failed delivery
+    assert send_result
+    server_thread.join()
+
+def test_can_reuse_connection_with_keep_alive():
+    smtp_log, lc = build_collecting_logger()
+    fake_client = fake_smtp_client(smtp_log=smtp_log)
+    mailer = SMTPMailer(client=fake_client, keep_alive=True)
+    message = b'Header: value\n\nbody\n'
+    assert mailer.send('foo@site.example', ('bar@site.example',), message)
+    assert mailer.send('foo@site.example', ('baz@site.example',), message)
+    assert fake_client.server.received_messages.qsize() == 2
+
+    log_messages = [log_record.msg % log_record.args for log_record in lc.records]
+    sent_lines = [msg[3:].split(' ', 1)[0] for msg in log_messages if msg.startswith('=> ')]
+    smtp_commands = [line for line in sent_lines if line in ('ehlo', 'mail', 'noop', 'quit')]
+    assert smtp_commands == ['ehlo', 'mail', 'noop', 'mail']
+    mailer.close()
+    assert fake_client.sock is None
+
+
 # --- internal helpers ----------------------------------------------------
+def _slow_smtp_server(banner_delay=0, final_reply_delay=0):
+    server_sock = socket.socket()
+    server_sock.bind(('127.0.0.1', 0))
+    server_sock.listen(1)
+    server_sock.settimeout(10)
+    def serve():
+        with server_sock:
+            conn, _ = server_sock.accept()
+        with conn, conn.makefile('rb') as conn_fp:
+            time.sleep(banner_delay)
+            try:
+                conn.sendall(b'220 localhost ESMTP\r\n')
+            except OSError:
+                return
+            replies = {b'EHLO': b'250 localhost', b'MAIL': b'250 ok', b'RCPT': b'250 ok',
+                       b'DATA': b'354 go ahead', b'QUIT': b'221 bye'}
+            for line in iter(conn_fp.readline, b''):
+                command = line[:4].upper()
+                if command == b'DATA':
+                    conn.sendall(replies[command] + b'\r\n')
+                    for data_line in iter(conn_fp.readline, b''):
+                        if data_line == b'.\r\n':
+                            break
+                    time.sleep(final_reply_delay)
+                    conn.sendall(b'250 queued\r\n')
+                    continue
+                conn.sendall(replies.get(command, b'502 unknown') + b'\r\n')
+                if command == b'QUIT':
+                    return
+    server_thread = threading.Thread(target=serve, daemon=True)
+    server_thread.start()
+    return server_sock.getsockname()[1], server_thread
+
+def _fake_starttls_client(tls_sessions):
+    fake_client = fake_smtp_client()
+    has_extn = fake_client.has_extn
+    fake_client.has_extn = lambda name: (name == 'starttls') or has_extn(name)
+    def fake_starttls(context, session):
+        tls_session = mock.Mock(name='tls_session')
+        tls_sessions.append(tls_session)
+        fake_client.sock.session = tls_session
+    fake_client.starttls = mock.MagicMock(side_effect=fake_starttls)
+    return fake_client
+
 def _build_policy(**method_results):
     class TempPolicy(IMTAPolicy):
         pass
@@ -92,6 +341,28 @@ def _build_policy(**method_results):
         setattr(TempPolicy, method_name, method)
     return TempPolicy()
 
+def _build_rcpt_policy(rcpt_replies):
+    # "rcpt_replies": custom (code, text) replies for refused recipients
+    class RecipientPolicy(IMTAPolicy):
+        def accept_rcpt_to(self, new_recipient, message):
+            reply = rcpt_replies.get(new_recipient)
+            if reply is None:
+                return True
+            return (False, reply)
+    return RecipientPolicy()
+
+def _build_rcpt_limit_policy(max_recipients):
+    class RecipientLimitPolicy(IMTAPolicy):
+        def accept_rcpt_to(self, new_recipient, message):
+            if len(message.smtp_to) >= max_recipients:
+                return (False, (452, '4.5.3 Too many recipients'))
+            return True
+    return RecipientLimitPolicy()
+
+def _received_messages(fake_client):
+    received_messages = fake_client.server.received_messages
+    return [received_messages.get() for _ in range(received_messages.qsize())]
+
 def _build_overrides(**overrides):
     _overrides = {}
     for method_name, exception in overrides.items():